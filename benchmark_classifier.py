@@ -0,0 +1,107 @@
+import argparse
+import time
+
+import torch
+
+from training.loss import AdaptiveSoftmaxLoss, CrossEntropyLoss
+from training.optimizer import NoamOpt
+from transformer.model import Transformer
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Dense vs adaptive softmax classifier: memory & step time')
+    parser.add_argument('--batch-size', type=int, default=64, help='Number of sentences per batch.')
+    parser.add_argument('--seq-length', type=int, default=40, help='Length of the source & target sentences.')
+    parser.add_argument('--vocab-size', type=int, default=50000, help='Size of the source & target vocabularies.')
+    parser.add_argument('--cutoffs', type=int, nargs='+', default=[2000, 10000],
+                        help='Cluster cutoffs of the adaptive softmax.')
+    parser.add_argument('--steps', type=int, default=20, help='Number of measured steps (after the warmup ones).')
+    parser.add_argument('--warmup', type=int, default=3, help='Number of warmup steps.')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    params = {
+        'd_model': 512,
+        'N': 6,
+        'dropout': 0.1,
+        'src_vocab_size': args.vocab_size,
+        'tgt_vocab_size': args.vocab_size,
+
+        'attention': {
+            'n_head': 8,
+            'd_k': 64,
+            'd_v': 64,
+            'dropout': 0.1},
+
+        'feed-forward': {
+            'd_ff': 2048,
+            'dropout': 0.1
+        }
+    }
+
+    # random batch, without padding (index 0), with Zipf-like token frequencies (the vocab is frequency-sorted)
+    def zipf_tokens(size):
+        return (torch.rand(size, device=device) ** 4 * (args.vocab_size - 1)).long() + 1
+
+    src = zipf_tokens((args.batch_size, args.seq_length))
+    trg = zipf_tokens((args.batch_size, args.seq_length + 1))
+    src_mask, trg_mask = (src != 0).unsqueeze(-2), (trg[:, :-1] != 0).unsqueeze(-2)
+
+    print(f"Batch size: {args.batch_size} | Sequence length: {args.seq_length} | Vocabulary: {args.vocab_size} "
+          f"| Device: {device}")
+    print(f"{'classifier':>10} | {'parameters':>11} | {'step time (s)':>14} | {'peak memory (MB)':>17} "
+          f"| {'decoding (tokens / s)':>22}")
+
+    for name, classifier in [('dense', {'type': 'dense'}),
+                             ('adaptive', {'type': 'adaptive', 'cutoffs': args.cutoffs, 'div_value': 4.0})]:
+        params['classifier'] = classifier
+        model = Transformer(params).to(device)
+        if model.adaptive_softmax:
+            loss_fn = AdaptiveSoftmaxLoss(model.classifier, padding_token=0)
+        else:
+            loss_fn = CrossEntropyLoss(pad_token=0)
+        optimizer = NoamOpt(model, model_size=params['d_model'], factor=1, warmup=2000)
+
+        def training_step():
+            optimizer.zero_grad()
+            outputs = model(src, src_mask, trg[:, :-1], trg_mask)
+            loss_fn(outputs, trg[:, 1:]).backward()
+            optimizer.step()
+
+        model.train()
+        for _ in range(args.warmup):
+            training_step()
+
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        start = time.perf_counter()
+        for _ in range(args.steps):
+            training_step()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        step_time = (time.perf_counter() - start) / args.steps
+        # only measurable per model on GPU (on CPU, the resident set size of the process never decreases)
+        peak_memory = f"{torch.cuda.max_memory_allocated() / 2 ** 20:17.1f}" if torch.cuda.is_available() \
+            else f"{'n/a':>17}"
+
+        model.eval()
+        start = time.perf_counter()
+        with torch.no_grad():
+            # no stop token: always decodes seq_length tokens per sentence
+            model.greedy_search(src, src_mask, start_index=1, max_length=args.seq_length)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        decoding_speed = args.batch_size * args.seq_length / (time.perf_counter() - start)
+
+        n_parameters = sum(p.numel() for p in model.classifier.parameters())
+        print(f"{name:>10} | {n_parameters:11d} | {step_time:14.4f} | {peak_memory} | {decoding_speed:22.1f}")
+
+        del model, optimizer, loss_fn
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
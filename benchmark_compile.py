@@ -0,0 +1,97 @@
+import argparse
+import copy
+import time
+
+import torch
+
+from training.loss import LabelSmoothingLoss
+from training.optimizer import NoamOpt
+from transformer.export import compile_model
+from transformer.model import Transformer
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Eager vs compiled throughput of the Transformer')
+    parser.add_argument('--batch-size', type=int, default=64, help='Number of sentences per batch.')
+    parser.add_argument('--seq-length', type=int, default=40, help='Length of the source & target sentences.')
+    parser.add_argument('--vocab-size', type=int, default=10000, help='Size of the source & target vocabularies.')
+    parser.add_argument('--steps', type=int, default=20, help='Number of measured steps (after the warmup ones).')
+    parser.add_argument('--warmup', type=int, default=3, help='Number of warmup steps (e.g. compilation).')
+    args = parser.parse_args()
+    return args
+
+
+def measure(function, steps: int, warmup: int) -> float:
+    """
+    Returns the average duration (in seconds) of ``function()`` over ``steps`` calls, after ``warmup`` calls.
+    """
+    for _ in range(warmup):
+        function()
+
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(steps):
+        function()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+    return (time.perf_counter() - start) / steps
+
+
+if __name__ == '__main__':
+    args = get_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    params = {
+        'd_model': 512,
+        'N': 6,
+        'dropout': 0.1,
+        'src_vocab_size': args.vocab_size,
+        'tgt_vocab_size': args.vocab_size,
+
+        'attention': {
+            'n_head': 8,
+            'd_k': 64,
+            'd_v': 64,
+            'dropout': 0.1},
+
+        'feed-forward': {
+            'd_ff': 2048,
+            'dropout': 0.1
+        }
+    }
+
+    # random batch, without padding (index 0)
+    src = torch.randint(low=1, high=args.vocab_size, size=(args.batch_size, args.seq_length), device=device)
+    trg = torch.randint(low=1, high=args.vocab_size, size=(args.batch_size, args.seq_length + 1), device=device)
+    src_mask, trg_mask = (src != 0).unsqueeze(-2), (trg[:, :-1] != 0).unsqueeze(-2)
+
+    eager_model = Transformer(params).to(device)
+    compiled_model = compile_model(copy.deepcopy(eager_model))
+
+    print(f"Batch size: {args.batch_size} | Sequence length: {args.seq_length} | Device: {device}")
+    print(f"{'model':>8} | {'training (tokens / s)':>22} | {'decoding (tokens / s)':>22}")
+
+    for name, model in [('eager', eager_model), ('compiled', compiled_model)]:
+        loss_fn = LabelSmoothingLoss(size=args.vocab_size, padding_token=0, smoothing=0.1).to(device)
+        optimizer = NoamOpt(model, model_size=params['d_model'], factor=1, warmup=2000)
+
+        def training_step():
+            optimizer.zero_grad()
+            logits = model(src, src_mask, trg[:, :-1], trg_mask)
+            loss_fn(logits, trg[:, 1:]).backward()
+            optimizer.step()
+
+        def decoding():
+            # no stop token: always decodes seq_length tokens per sentence
+            model.greedy_search(src, src_mask, start_index=1, max_length=args.seq_length)
+
+        model.train()
+        training_time = measure(training_step, args.steps, args.warmup)
+
+        model.eval()
+        decoding_time = measure(decoding, max(1, args.steps // 5), args.warmup)
+
+        n_tokens = args.batch_size * args.seq_length
+        print(f"{name:>8} | {n_tokens / training_time:22.1f} | {n_tokens / decoding_time:22.1f}")
@@ -0,0 +1,264 @@
+import hashlib
+import json
+import os
+import random
+import shutil
+from os.path import exists, join
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+import torch
+from torchtext import data
+
+from dataset.preprocessing import numericalize as numericalize_sentences
+
+# to be incremented whenever the format of the cache (or the preprocessing it stores) changes
+CACHE_VERSION = 1
+
+
+class DatasetCache(object):
+    """
+    Persistent cache of a preprocessed (tokenized, filtered & numericalized) parallel corpus, so that later runs don't
+    re-read & re-tokenize the raw corpus nor rebuild the vocabularies.
+
+    Each split is stored as flat ``int32`` arrays of the source (resp. target) token indices of all its sentences,
+    with an ``offsets`` array giving the position of each sentence in them. These arrays are read through memory
+    maps: only the sentences of the current batch are loaded in RAM. The vocabularies are pickled alongside.
+
+    The cache is kept in a directory named after the preprocessing settings (see :py:func:`directory_name`).
+    """
+
+    def __init__(self, root: str, settings: dict):
+        """
+        Constructor of the :py:class:`DatasetCache` class.
+
+        :param root: Directory in which the caches of the different settings are stored.
+
+        :param settings: JSON-serializable preprocessing settings, e.g. language pair, tokenizers, ``max_length``,
+            ``min_freq``... A cache is only reused for the same settings.
+        """
+        self.settings = dict(settings, version=CACHE_VERSION)
+        self.directory = join(root, self.directory_name(self.settings))
+
+    @staticmethod
+    def directory_name(settings: dict) -> str:
+        """
+        Returns the name of the cache directory for ``settings``: their hash, prefixed by the language pair (if any)
+        for readability.
+        """
+        hashed = hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        return f"{settings.get('language_pair', 'dataset')}-v{settings['version']}-{hashed}"
+
+    def contains(self, splits: Iterable[str]) -> bool:
+        """
+        Returns whether the cache was completely written, with all the ``splits``.
+        """
+        metadata_file = join(self.directory, 'metadata.json')
+        if not exists(metadata_file):
+            return False
+
+        with open(metadata_file) as f:
+            metadata = json.load(f)
+
+        return metadata['settings'] == self.settings and all(name in metadata['splits'] for name in splits)
+
+    def write(self, splits: Dict[str, data.Dataset], src_vocab, trg_vocab,
+              numericalize=numericalize_sentences) -> None:
+        """
+        Writes the cache (replacing any previous one for the same settings).
+
+        :param splits: Datasets of the splits (e.g. ``{'train': ..., 'validation': ...}``), whose examples have
+            ``src`` & ``trg`` lists of tokens.
+
+        :param src_vocab: Vocabulary of the source sentences.
+
+        :param trg_vocab: Vocabulary of the target sentences.
+
+        :param numericalize: Function converting the sentences of a split to ``(tokens, offsets)`` arrays, see
+            :py:func:`dataset.preprocessing.numericalize` (e.g. ``ParallelPreprocessor.numericalize``).
+        """
+        # written in a temporary directory, then moved, so that an interrupted write is never used
+        temporary = self.directory + '.tmp'
+        shutil.rmtree(temporary, ignore_errors=True)
+        os.makedirs(temporary)
+
+        for name, dataset in splits.items():
+            for side, vocab in (('src', src_vocab), ('trg', trg_vocab)):
+                # unknown tokens are mapped to <unk> by the stoi of the torchtext vocabularies
+                tokens, offsets = numericalize([getattr(example, side) for example in dataset.examples], vocab.stoi)
+
+                np.save(join(temporary, f"{name}.{side}.tokens.npy"), tokens)
+                np.save(join(temporary, f"{name}.{side}.offsets.npy"), offsets)
+
+        torch.save({'src': src_vocab, 'trg': trg_vocab}, join(temporary, 'vocabs.pt'))
+
+        # the metadata is written last: it marks the cache as complete
+        with open(join(temporary, 'metadata.json'), 'w') as f:
+            json.dump({'settings': self.settings, 'splits': sorted(splits)}, f)
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.rename(temporary, self.directory)
+
+    def vocabs(self):
+        """
+        Returns the (source, target) vocabularies stored in the cache.
+        """
+        vocabs = torch.load(join(self.directory, 'vocabs.pt'))
+        return vocabs['src'], vocabs['trg']
+
+    def split(self, name: str) -> 'CachedSplit':
+        """
+        Returns the (memory-mapped) split ``name`` of the cache.
+        """
+        return CachedSplit(self.directory, name)
+
+
+class CachedSplit(object):
+    """
+    Memory-mapped split of a :py:class:`DatasetCache`: sentence ``i`` is read from the flat token arrays on access.
+    """
+
+    def __init__(self, directory: str, name: str):
+        self.arrays = {}
+        for side in ('src', 'trg'):
+            self.arrays[side] = (np.load(join(directory, f"{name}.{side}.tokens.npy"), mmap_mode='r'),
+                                 np.load(join(directory, f"{name}.{side}.offsets.npy")))
+
+        # lengths (in tokens) of the sentences, e.g. to bucket them
+        self.src_lengths = np.diff(self.arrays['src'][1])
+        self.trg_lengths = np.diff(self.arrays['trg'][1])
+
+    def __len__(self):
+        return len(self.src_lengths)
+
+    def sentence(self, side: str, i: int) -> np.ndarray:
+        """
+        Returns the token indices of the source (``side='src'``) or target (``side='trg'``) sentence ``i``.
+        """
+        tokens, offsets = self.arrays[side]
+        return tokens[offsets[i]:offsets[i + 1]]
+
+
+class CachedBatch(object):
+    """
+    Batch of a :py:class:`CachedBucketIterator`, with the attributes of the ``torchtext`` batches used by
+    ``IWSLTDatasetBuilder.transposed`` & ``BatchMasker``: ``src`` & ``trg`` of shape (seq_len, batch_size), the
+    ``dataset`` holding the fields (& their vocabularies), and ``batch_size``.
+    """
+
+    def __init__(self, src: torch.Tensor, trg: torch.Tensor, dataset):
+        self.src, self.trg = src, trg
+        self.dataset = dataset
+        self.fields = dataset.fields.keys()
+        self.input_fields = ['src']
+        self.target_fields = ['trg']
+        self.batch_size = src.shape[1]
+
+
+class CachedBucketIterator(object):
+    """
+    Iterator over the batches of a :py:class:`CachedSplit`, behaving as the ``torchtext`` ``BucketIterator`` used
+    by ``IWSLTDatasetBuilder`` (with ``repeat=False``): the sentences are bucketed by length, and, when shuffling,
+    the sentences & batches are shuffled at each epoch. The targets get the start & end tokens, and the batches are
+    padded.
+    """
+
+    def __init__(self, split: CachedSplit, src_field: data.Field, trg_field: data.Field, batch_size: int,
+                 max_tokens: Optional[int] = None, shuffle=False, device='cpu'):
+        """
+        Constructor of the :py:class:`CachedBucketIterator` class.
+
+        :param split: Split to iterate over.
+
+        :param src_field: Field of the source sentences, with its vocabulary (for the padding token).
+
+        :param trg_field: Field of the target sentences, with its vocabulary (for the start, end & padding tokens).
+
+        :param batch_size: Number of sentences per batch.
+
+        :param max_tokens: If not ``None``, the batches are filled up to ``max_tokens`` source + target tokens (padding
+            included) instead, as with ``IWSLTDatasetBuilder.token_budget``.
+
+        :param shuffle: Whether to shuffle the sentences & batches at each epoch (for the training set). Otherwise,
+            the whole split is sorted by length.
+
+        :param device: The device on which to create the batches.
+        """
+        self.split = split
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.device = device
+
+        # mimics a torchtext dataset, for the BatchMasker
+        self.dataset = data.Dataset(examples=[], fields=[('src', src_field), ('trg', trg_field)])
+
+        vocab = trg_field.vocab
+        self.src_padding = src_field.vocab.stoi[src_field.pad_token]
+        self.trg_padding = vocab.stoi[trg_field.pad_token]
+        self.start_index, self.stop_index = vocab.stoi[trg_field.init_token], vocab.stoi[trg_field.eos_token]
+
+    def batches(self) -> List[np.ndarray]:
+        """
+        Returns the indices of the sentences of each batch of an epoch.
+        """
+        # the targets get the start & end tokens
+        src_lengths, trg_lengths = self.split.src_lengths, self.split.trg_lengths + 2
+
+        indices = np.arange(len(self.split))
+        if self.shuffle:
+            np.random.shuffle(indices)
+            # pools of sentences bucketed together, as in torchtext (~100 batches)
+            mean_size = int(np.mean(src_lengths + trg_lengths)) if len(indices) else 1
+            pool_size = 100 * (self.batch_size if self.max_tokens is None else max(1, self.max_tokens // mean_size))
+        else:
+            pool_size = max(len(indices), 1)
+
+        batches = []
+        for start in range(0, len(indices), pool_size):
+            pool = indices[start:start + pool_size]
+            pool = pool[np.lexsort((trg_lengths[pool], src_lengths[pool]))]
+
+            if self.max_tokens is None:
+                batches += [pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size)]
+                continue
+
+            # fill each batch up to the token budget
+            begin, longest_src, longest_trg = 0, 0, 0
+            for i, index in enumerate(pool):
+                new_src, new_trg = max(longest_src, src_lengths[index]), max(longest_trg, trg_lengths[index])
+                if i > begin and (i - begin + 1) * (new_src + new_trg) > self.max_tokens:
+                    batches.append(pool[begin:i])
+                    begin, new_src, new_trg = i, src_lengths[index], trg_lengths[index]
+                longest_src, longest_trg = new_src, new_trg
+            batches.append(pool[begin:])
+
+        if self.shuffle:
+            random.shuffle(batches)
+
+        return batches
+
+    def create_batch(self, indices: np.ndarray) -> CachedBatch:
+        """
+        Reads & pads the sentences ``indices`` into a :py:class:`CachedBatch`.
+        """
+        src_sentences = [self.split.sentence('src', i) for i in indices]
+        trg_sentences = [self.split.sentence('trg', i) for i in indices]
+
+        src = np.full((max(len(s) for s in src_sentences), len(indices)), self.src_padding, dtype=np.int64)
+        trg = np.full((max(len(s) for s in trg_sentences) + 2, len(indices)), self.trg_padding, dtype=np.int64)
+        for j, (src_sentence, trg_sentence) in enumerate(zip(src_sentences, trg_sentences)):
+            src[:len(src_sentence), j] = src_sentence
+            trg[0, j] = self.start_index
+            trg[1:len(trg_sentence) + 1, j] = trg_sentence
+            trg[len(trg_sentence) + 1, j] = self.stop_index
+
+        return CachedBatch(torch.from_numpy(src).to(self.device), torch.from_numpy(trg).to(self.device),
+                           self.dataset)
+
+    def __iter__(self) -> Iterator[CachedBatch]:
+        for indices in self.batches():
+            yield self.create_batch(indices)
+
+    def __len__(self):
+        return len(self.batches())
@@ -2,11 +2,6 @@ import torch
 import numpy as np
 from torch.utils.data import Dataset
 
-if torch.cuda.is_available():
-    device = torch.device('cuda')
-else:
-    device = torch.device('cpu')
-
 
 class CopyTaskDataset(Dataset):
     """
@@ -65,7 +60,7 @@ class Batch:
         if trg is not None:
             self.trg = trg[:, :-1]
             self.trg_y = trg[:, 1:]
-            self.trg_mask = (self.trg != pad).unsqueeze(-2)  # will be ANDed with subsequent_mask(trg.shape[1]) in the forward.
+            self.trg_mask = (self.trg != pad).unsqueeze(-2)  # subsequent positions are hidden by the decoder.
 
     def cuda(self) -> None:
         """
@@ -23,8 +23,10 @@ class BatchMasker(Batch):
             - `src`: the source sequences (e.g. tokenized input sentences),
             - `trg`: the target sequences (e.g. tokenized output sentences),
             - `src_mask`: Mask hiding the padding in `src`
-            - `trg_mask`: Mask hiding both the padding and the subsequent positions in `trg`,
+            - `trg_mask`: Mask hiding the padding in `trg` (the subsequent positions are hidden by the decoder
+              itself, see :py:meth:`make_std_mask` to combine both),
             - `trg_shifted`: Shifted-by-1 targets.
+            - `padding_ratio`: Fraction of the positions of `src` & the target sequences which are padding.
 
         :param batch: The batch to mask out.
         :param padding_token: The token used to pad shorter sequences.
@@ -52,12 +54,21 @@ class BatchMasker(Batch):
             self.trg = self.batch.trg[:, :-1]
             self.trg_shifted = self.batch.trg[:, 1:]  # type: Tensor
 
-            # create mask to hide padding AND future words (subsequent)
-            self.trg_mask = self.make_std_mask(self.trg, trg_padding)
+            # create mask to hide padding: future words are hidden by the decoder self-attention
+            self.trg_mask = (self.trg != trg_padding).unsqueeze(-2)  # type: Tensor
 
             # ntokens is the size of the sentence (excluding padding)
             self.ntokens = (self.trg_shifted != trg_padding).data.sum()
 
+        # fraction of the positions of the batch (source & full target sequences) which are padding
+        n_padding = int((self.src == src_padding).sum())
+        n_positions = self.src.numel()
+        if self.batch.trg is not None:
+            n_padding += int((self.batch.trg == trg_padding).sum())
+            n_positions += self.batch.trg.numel()
+        self.n_padding, self.n_positions = n_padding, n_positions
+        self.padding_ratio = n_padding / max(n_positions, 1)
+
     @property
     def batch_size(self):
         return self.batch.batch_size
@@ -98,7 +109,7 @@ class BatchMasker(Batch):
         target_mask = (target != pad).unsqueeze(-2)
 
         # hide padding and future words
-        target_mask = (target_mask & subsequent_mask(target.shape[-1]).type_as(target_mask.data))
+        target_mask = target_mask & subsequent_mask(target.shape[-1], target.device)
 
         return target_mask
 
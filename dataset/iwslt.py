@@ -1,8 +1,11 @@
+from os.path import join
 from typing import Iterable
 
 from torch.utils import data
 from torchtext import data, datasets
 
+from dataset.cache import CachedBucketIterator, DatasetCache
+from dataset.preprocessing import ParallelPreprocessor, build_vocab
 from dataset.utils import Split
 from dataset.formatter import BatchMasker
 from dataset.language_pairs import LanguagePair
@@ -33,11 +36,31 @@ class IWSLTDatasetBuilder():
             batch.trg.transpose_(0, 1)
             yield batch
 
+    @staticmethod
+    def token_budget():
+        """
+        Returns a ``batch_size_fn`` for the ``torchtext`` iterators, measuring the size of a batch as its number of
+        source + target tokens, padding included (i.e. the number of sentences times the longest source & target).
+        The target sequences are counted with their start & end tokens.
+        """
+        longest = {'src': 0, 'trg': 0}
+
+        def batch_size_fn(example, count: int, size_so_far: int) -> int:
+            # a new batch starts with its first example
+            if count == 1:
+                longest['src'], longest['trg'] = 0, 0
+            longest['src'] = max(longest['src'], len(example.src))
+            longest['trg'] = max(longest['trg'], len(example.trg) + 2)
+            return count * (longest['src'] + longest['trg'])
+
+        return batch_size_fn
+
     @staticmethod
     def build(language_pair: LanguagePair, split: Split, max_length=100, min_freq=2,
               start_token="<s>", eos_token="</s>", blank_token="<blank>",
               batch_size_train=32, batch_size_validation=32,
-              batch_size_test=32, device='cpu'):
+              batch_size_test=32, device='cpu', shared_vocab=False, max_tokens=None, cache=False,
+              n_workers=None, use_nltk=False):
         """
         Initializes an iterator over the IWSLT dataset.
         The iterator then yields batches of size `batch_size`.
@@ -65,12 +88,36 @@ class IWSLTDatasetBuilder():
         :param batch_size_test: Desired size of each testing batch.
         :param device: The device on which to store the batches.
         :type device: str or torch.device
+        :param shared_vocab: Whether to build a single vocabulary on both the source & target sentences, which is
+            then used for both languages (e.g. to tie the embeddings & output projection of the model).
+        :param max_tokens: If not ``None``, the batches of all splits are filled with sentences of similar lengths up to
+            ``max_tokens`` source + target tokens (padding included, see :py:func:`token_budget`), in place of a fixed
+            number of sentences: the ``batch_size_*`` arguments are then ignored. The training batches are shuffled
+            at each epoch.
+        :param cache: Whether to use the persistent cache of the preprocessed dataset (see :py:class:`DatasetCache`):
+            the first run writes it, the following ones (with the same settings) read the numericalized sentences
+            from it, instead of reading, tokenizing & filtering the raw corpus and building the vocabularies. The
+            iterators then yield equivalent batches, but their datasets have no examples.
+        :param n_workers: Number of processes tokenizing, filtering & counting the sentences (see
+            :py:class:`ParallelPreprocessor`). Defaults to the number of CPUs.
+        :param use_nltk: Whether to tokenize with NLTK (the tokenization of the models trained before the
+            ``RegexTokenizer``, see ``LanguagePair.tokenizer``) instead of the ``RegexTokenizer``.
 
         :returns: (train_iterator, validation_iterator, test_iterator,
                    source_field.vocab, target_field.vocab)
         """
+        if cache:
+            dataset_cache = IWSLTDatasetBuilder.dataset_cache(language_pair, max_length, min_freq, start_token,
+                                                              eos_token, blank_token, shared_vocab, use_nltk)
+            splits = [name for name, split_type in [('train', Split.Train), ('validation', Split.Validation),
+                                                    ('test', Split.Test)] if split & split_type]
+            if dataset_cache.contains(splits):
+                return IWSLTDatasetBuilder.build_from_cache(
+                    dataset_cache, split, start_token, eos_token, blank_token,
+                    batch_size_train, batch_size_validation, batch_size_test, device, max_tokens)
+
         # load corresponding tokenizer
-        source_tokenizer, target_tokenizer = language_pair.tokenizer()
+        source_tokenizer, target_tokenizer = language_pair.tokenizer(use_nltk=use_nltk)
         # create pytorchtext data field to generate vocabulary
         source_field = data.Field(tokenize=source_tokenizer, pad_token=blank_token)
         target_field = data.Field(tokenize=target_tokenizer, init_token=start_token,
@@ -86,37 +133,63 @@ class IWSLTDatasetBuilder():
                 pass  # Keep default split setting
             else:
                 settings[key] = None  # Disable split
+        # the raw sentences are read as is, then tokenized & filtered by a pool of processes
+        raw_field = data.RawField()
         # noinspection PyTypeChecker
-        train, validation, *out = datasets.IWSLT.splits(
+        raw_splits = datasets.IWSLT.splits(
             root=ROOT_DATASET_DIR,  # To check if the dataset was already downloaded
             exts=language_pair.extensions(),
-            fields=(source_field, target_field),
-            filter_pred=lambda x: all(len(val) <= max_length for val in (x.src, x.trg)),
+            fields=(raw_field, raw_field),
             **settings
         )
-
-        # Build vocabulary on training set
-        source_field.build_vocab(train, min_freq=min_freq)
-        target_field.build_vocab(train, min_freq=min_freq)
+        preprocessor = ParallelPreprocessor(source_tokenizer, target_tokenizer, max_length=max_length,
+                                            n_workers=n_workers)
+        fields = [('src', source_field), ('trg', target_field)]
+        (train, source_counts, target_counts), *preprocessed = [preprocessor.dataset(raw, fields)
+                                                                 for raw in raw_splits]
+        validation, *out = [dataset for dataset, _, _ in preprocessed]
+
+        # Build vocabulary on training set, from the token counts of the workers
+        if shared_vocab:
+            # built on the target field to include the start & end tokens
+            build_vocab(target_field, source_counts + target_counts, min_freq=min_freq)
+            source_field.vocab = target_field.vocab
+        else:
+            build_vocab(source_field, source_counts, min_freq=min_freq)
+            build_vocab(target_field, target_counts, min_freq=min_freq)
+
+        if cache:
+            cached_splits = {'train': train, 'validation': validation}
+            if split & Split.Test:
+                cached_splits['test'] = out[0]
+            dataset_cache.write(cached_splits, source_field.vocab, target_field.vocab,
+                                numericalize=preprocessor.numericalize)
 
         train_iterator, validation_iterator, test_iterator = None, None, None
 
         def sort_func(x):
             return data.interleave_keys(len(x.src), len(x.trg))
 
+        if max_tokens is not None:
+            batch_size_train = batch_size_validation = batch_size_test = max_tokens
+
+        def batch_size_fn():
+            # one state per iterator
+            return IWSLTDatasetBuilder.token_budget() if max_tokens is not None else None
+
         if split & Split.Train:
             train_iterator = data.BucketIterator(
                 dataset=train, batch_size=batch_size_train, repeat=False,
-                device=device, sort_key=sort_func)
+                device=device, sort_key=sort_func, batch_size_fn=batch_size_fn())
         if split & Split.Validation:
             validation_iterator = data.BucketIterator(
                 dataset=validation, batch_size=batch_size_validation, repeat=False,
-                device=device, sort_key=sort_func)
+                device=device, sort_key=sort_func, batch_size_fn=batch_size_fn())
         if split & Split.Test:
             test, *out = out
             test_iterator = data.BucketIterator(
                 dataset=test, batch_size=batch_size_test, repeat=False,
-                device=device, sort_key=sort_func)
+                device=device, sort_key=sort_func, batch_size_fn=batch_size_fn())
 
         return (
             train_iterator,
@@ -125,3 +198,42 @@ class IWSLTDatasetBuilder():
             source_field.vocab,
             target_field.vocab,
         )
+
+    @staticmethod
+    def dataset_cache(language_pair: LanguagePair, max_length: int, min_freq: int, start_token: str, eos_token: str,
+                      blank_token: str, shared_vocab: bool, use_nltk=False) -> DatasetCache:
+        """
+        Returns the :py:class:`DatasetCache` of the preprocessed dataset for these settings (see :py:func:`build`).
+        """
+        return DatasetCache(join(ROOT_DATASET_DIR, 'cache'), settings={
+            'language_pair': language_pair.name,
+            'tokenizers': [tokenizer.name for tokenizer in language_pair.tokenizer(use_nltk, download=False)],
+            'max_length': max_length,
+            'min_freq': min_freq,
+            'specials': [start_token, eos_token, blank_token],
+            'shared_vocab': shared_vocab,
+        })
+
+    @staticmethod
+    def build_from_cache(dataset_cache: DatasetCache, split: Split, start_token: str, eos_token: str,
+                         blank_token: str, batch_size_train: int, batch_size_validation: int, batch_size_test: int,
+                         device, max_tokens=None):
+        """
+        Creates the iterators & vocabularies returned by :py:func:`build` from a complete :py:class:`DatasetCache`.
+        """
+        source_vocab, target_vocab = dataset_cache.vocabs()
+        source_field = data.Field(pad_token=blank_token)
+        target_field = data.Field(init_token=start_token, eos_token=eos_token, pad_token=blank_token)
+        source_field.vocab, target_field.vocab = source_vocab, target_vocab
+
+        iterators = []
+        for name, split_type, batch_size in [('train', Split.Train, batch_size_train),
+                                             ('validation', Split.Validation, batch_size_validation),
+                                             ('test', Split.Test, batch_size_test)]:
+            iterators.append(CachedBucketIterator(dataset_cache.split(name), source_field, target_field,
+                                                  batch_size=batch_size, max_tokens=max_tokens,
+                                                  shuffle=split_type == Split.Train, device=device)
+                             if split & split_type else None)
+
+        return (*iterators, source_vocab, target_vocab)
+
@@ -1,6 +1,6 @@
 from enum import IntEnum, auto
 
-from dataset.utils import Tokenizer
+from dataset.utils import RegexTokenizer, Tokenizer
 
 
 class LanguagePair(IntEnum):
@@ -9,12 +9,18 @@ class LanguagePair(IntEnum):
     """
     fr_en = auto()
 
-    def tokenizer(self):
+    def tokenizer(self, use_nltk=False, download=True):
+        """
+        Returns the (source, target) tokenizers: the fast :py:class:`RegexTokenizer`, which works offline, or, with
+        ``use_nltk``, the reference NLTK :py:class:`Tokenizer` (downloading its model if ``download``).
+        """
         if self == LanguagePair.fr_en:
-            return (
-                Tokenizer(language='french'),
-                Tokenizer(language='english'),
-            )
+            if use_nltk:
+                return (
+                    Tokenizer(language='french', download=download),
+                    Tokenizer(language='english', download=download),
+                )
+            return RegexTokenizer(language='french'), RegexTokenizer(language='english')
         else:
             raise ValueError()
 
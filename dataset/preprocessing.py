@@ -0,0 +1,170 @@
+import os
+from collections import Counter, OrderedDict
+from functools import partial
+from multiprocessing import Pool
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from torchtext import data
+
+Sentence = List[str]
+
+
+def tokenize_shard(source_tokenizer: Callable[[str], Sentence], target_tokenizer: Callable[[str], Sentence],
+                   max_length: int, pairs: Sequence[Tuple[str, str]]) -> Tuple[List[Tuple[Sentence, Sentence]],
+                                                                             Counter, Counter]:
+    """
+    Tokenizes a shard of (source, target) sentence pairs, keeping the pairs whose sentences both have at most
+    ``max_length`` tokens.
+
+    :returns: The kept pairs of tokenized sentences, and the counts of their source & target tokens.
+    """
+    tokenized, source_counts, target_counts = [], Counter(), Counter()
+    for src, trg in pairs:
+        src, trg = source_tokenizer(src), target_tokenizer(trg)
+        if len(src) <= max_length and len(trg) <= max_length:
+            tokenized.append((src, trg))
+            source_counts.update(src)
+            target_counts.update(trg)
+
+    return tokenized, source_counts, target_counts
+
+
+def numericalize(sentences: Sequence[Sentence], stoi) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Converts tokenized sentences to vocabulary indices.
+
+    :param sentences: The tokenized sentences.
+
+    :param stoi: Mapping of the tokens to their indices, e.g. the ``stoi`` of a ``torchtext`` vocabulary, which maps
+        the unknown tokens to ``<unk>``.
+
+    :returns: (tokens, offsets): the ``int32`` indices of all the tokens of the sentences, one after the other, and the
+        ``int64`` position of each sentence in them (sentence ``i`` is ``tokens[offsets[i]:offsets[i + 1]]``).
+    """
+    lengths = np.fromiter((len(sentence) for sentence in sentences), dtype=np.int64, count=len(sentences))
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    tokens = np.fromiter((stoi[token] for sentence in sentences for token in sentence),
+                         dtype=np.int32, count=int(offsets[-1]))
+    return tokens, offsets
+
+
+def build_vocab(field: data.Field, counts: Counter, min_freq: int) -> None:
+    """
+    Sets the vocabulary of ``field`` from already counted tokens, with the same special tokens as
+    ``Field.build_vocab``.
+    """
+    specials = list(OrderedDict.fromkeys(
+        token for token in [field.unk_token, field.pad_token, field.init_token, field.eos_token] if token is not None
+    ))
+    field.vocab = field.vocab_cls(counts, specials=specials, min_freq=min_freq)
+
+
+class ParallelPreprocessor(object):
+    """
+    Preprocesses a parallel corpus across a pool of processes, map-reduce style: the sentence pairs are split into
+    shards, each shard is tokenized & filtered (resp. numericalized) by a worker, which also counts its tokens, and
+    the results of the shards are merged in order. The vocabularies are then built from the merged counts (see
+    :py:func:`build_vocab`), without iterating over the sentences again.
+
+    The output is the same as with a single process, whatever the number of workers.
+    """
+
+    def __init__(self, source_tokenizer: Callable[[str], Sentence], target_tokenizer: Callable[[str], Sentence],
+                 max_length=100, n_workers: Optional[int] = None, shard_size=5000):
+        """
+        Constructor of the :py:class:`ParallelPreprocessor` class.
+
+        :param source_tokenizer: Tokenizer of the source sentences. Should be picklable, to be sent to the workers.
+
+        :param target_tokenizer: Tokenizer of the target sentences. Should be picklable, to be sent to the workers.
+
+        :param max_length: The pairs with a source or target sentence longer than ``max_length`` tokens are dropped.
+
+        :param n_workers: Number of worker processes. Defaults to the number of CPUs. With 1 worker, everything runs
+            in the current process.
+
+        :param shard_size: Number of sentences per shard: small enough to balance the load between the workers, large
+            enough to amortize the transfer of each shard.
+        """
+        self.source_tokenizer = source_tokenizer
+        self.target_tokenizer = target_tokenizer
+        self.max_length = max_length
+        self.n_workers = n_workers if n_workers is not None else os.cpu_count() or 1
+        self.shard_size = shard_size
+
+    def shards(self, items: Sequence) -> List[Sequence]:
+        """
+        Splits ``items`` into shards of ``shard_size`` consecutive items.
+        """
+        return [items[i:i + self.shard_size] for i in range(0, len(items), self.shard_size)]
+
+    def map(self, function: Callable, shards: List[Sequence]) -> list:
+        """
+        Returns the results of ``function`` (a picklable, e.g. module-level, function) on each of the ``shards``, in
+        order, computed by the pool of workers.
+        """
+        n_workers = min(self.n_workers, len(shards))
+        if n_workers <= 1:
+            return [function(shard) for shard in shards]
+
+        with Pool(n_workers) as pool:
+            # one shard at a time, so that the workers finishing first take the remaining shards
+            return pool.map(function, shards, chunksize=1)
+
+    def tokenize(self, pairs: Sequence[Tuple[str, str]]) -> Tuple[List[Tuple[Sentence, Sentence]], Counter, Counter]:
+        """
+        Tokenizes & filters (source, target) sentence pairs, see :py:func:`tokenize_shard`.
+
+        :returns: The kept pairs of tokenized sentences, and the counts of their source & target tokens.
+        """
+        results = self.map(partial(tokenize_shard, self.source_tokenizer, self.target_tokenizer, self.max_length),
+                           self.shards(pairs))
+
+        tokenized, source_counts, target_counts = [], Counter(), Counter()
+        for shard_tokenized, shard_source_counts, shard_target_counts in results:
+            tokenized += shard_tokenized
+            source_counts.update(shard_source_counts)
+            target_counts.update(shard_target_counts)
+
+        return tokenized, source_counts, target_counts
+
+    def dataset(self, raw: data.Dataset, fields: List[Tuple[str, data.Field]]) -> Tuple[data.Dataset, Counter,
+                                                                                        Counter]:
+        """
+        Tokenizes & filters a dataset of raw (untokenized) sentence pairs, e.g. read with ``RawField``.
+
+        :param raw: Dataset whose examples have ``src`` & ``trg`` strings.
+
+        :param fields: The ``('src', source_field), ('trg', target_field)`` of the returned dataset.
+
+        :returns: The dataset of the kept tokenized pairs, and the counts of their source & target tokens.
+        """
+        tokenized, source_counts, target_counts = self.tokenize([(example.src, example.trg)
+                                                                 for example in raw.examples])
+
+        examples = []
+        for src, trg in tokenized:
+            example = data.Example()
+            example.src, example.trg = src, trg
+            examples.append(example)
+
+        return data.Dataset(examples, fields), source_counts, target_counts
+
+    def numericalize(self, sentences: Sequence[Sentence], stoi) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Converts tokenized sentences to vocabulary indices, as :py:func:`numericalize`, shard by shard.
+        """
+        results = self.map(partial(numericalize, stoi=stoi), self.shards(sentences))
+        if not results:
+            return numericalize([], stoi)
+
+        tokens = np.concatenate([shard_tokens for shard_tokens, _ in results])
+
+        # shift the offsets of each shard by the number of tokens of the previous ones
+        offsets, start = [np.zeros(1, dtype=np.int64)], 0
+        for shard_tokens, shard_offsets in results:
+            offsets.append(shard_offsets[1:] + start)
+            start += len(shard_tokens)
+
+        return tokens, np.concatenate(offsets)
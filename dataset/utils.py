@@ -1,4 +1,7 @@
+import re
 from enum import auto, Flag
+from functools import lru_cache
+from typing import List
 
 import nltk
 
@@ -11,15 +14,25 @@ class Tokenizer(object):
         – whereas “U.K.” should remain one token.
     """
 
-    def __init__(self, language: str):
+    def __init__(self, language: str, download=True):
         """
         Loads the appropriate model from NLTK
 
         :param language: model string id
+        :param download: Whether to download (or update) the model. Disable it to run offline, with the model
+            already installed.
         """
-        nltk.download(info_or_id="punkt", quiet=True)
+        if download:
+            nltk.download(info_or_id="punkt", quiet=True)
         self.language = language
 
+    @property
+    def name(self) -> str:
+        """
+        Identifier of the tokenization (e.g. in the key of the preprocessed dataset cache).
+        """
+        return f"nltk-{nltk.__version__}-word_tokenize-{self.language}"
+
     def __call__(self, text: str):
         """
         tokenize a string in corresponding token
@@ -29,6 +42,139 @@ class Tokenizer(object):
         return nltk.word_tokenize(text, language=self.language)
 
 
+class RegexTokenizer(object):
+    """
+    Fast tokenizer producing (nearly always) the same tokens as :py:class:`Tokenizer` (i.e. ``nltk.word_tokenize``),
+    for the languages of the ``LanguagePair`` (French & English), without NLTK nor its models: it never touches the
+    network.
+
+    ``nltk.word_tokenize`` splits the text into sentences with Punkt, then applies the cascade of regular expressions
+    of the Treebank tokenizer to each sentence. Here, the text is scanned once with a single compiled regular
+    expression, reproducing the Treebank rules:
+
+    - punctuation (``, : ; ? ! ...``), brackets, ``--``, ``@ # $ % &`` & quotes are split off, except the commas &
+      colons followed by a digit (e.g. ``3,5`` or ``10:30``),
+    - the double quotes become two backticks (opening) or two single quotes (closing),
+    - the English contractions are split (``don't`` -> ``do n't``, ``it's`` -> ``it 's``, ``cannot`` ->
+      ``can not``...), the French elisions are kept (``l'homme``),
+    - a period is only split off at the end of a sentence: Punkt's sentence boundaries are approximated with the
+      common abbreviations of each language, initials & numbers followed by a lowercase word.
+
+    The tokens of the most frequent sentences are memoized.
+    """
+
+    # abbreviations after which a period doesn't end the sentence (lowercase, without the period)
+    ABBREVIATIONS = {
+        'english': {'mr', 'mrs', 'ms', 'dr', 'prof', 'st', 'jr', 'sr', 'vs', 'gen', 'col', 'lt', 'sgt', 'rev', 'gov',
+                    'sen', 'rep', 'no', 'vol', 'fig', 'inc', 'ltd', 'co', 'corp', 'dept', 'jan', 'feb', 'aug', 'sept',
+                    'oct', 'nov', 'dec'},
+        'french': {'m', 'mm', 'mme', 'mmes', 'mlle', 'mlles', 'dr', 'pr', 'me', 'st', 'ste', 'mgr', 'cf', 'ex', 'p',
+                   'pp', 'vol', 'no', 'av', 'bd', 'env', 'janv', 'févr', 'avr', 'juil', 'sept', 'oct', 'nov',
+                   'déc'},
+    }
+
+    # characters always split off
+    _SPLIT = r"""[;@#$%&?!\[\](){}<>"«»“”‘’„`]"""
+    # what may follow the period ending a sentence
+    _FINAL_PERIOD_TAIL = r"""[\])}>"'»”’]*(?:\s|$)"""
+    # end of a token
+    _BOUNDARY = rf"""(?=\s|$|{_SPLIT}|[:,](?!\d)|\.\.\.|--|''|\.{_FINAL_PERIOD_TAIL})"""
+    # split English contractions, e.g. don't, it's, we're, students'
+    _CONTRACTION = rf"""(?:n't|N'T|'(?:[sSmMdD]|ll|LL|re|RE|ve|VE)?){_BOUNDARY}"""
+
+    PATTERN = re.compile(rf"""
+        (?P<ellipsis>\.\.\.)
+        |(?P<dashes>--)
+        |(?P<open_quote>[«“‘„]|`+)
+        |(?P<close_quote>[»”’])
+        |(?P<double_quote>"|'')
+        |(?P<punctuation>[;@#$%&?!\[\](){{}}<>]|[:,](?!\d))
+        # first half of cannot, gonna, gotta, wanna, gimme, lemme, more'n, d'ye
+        |(?P<prefix>(?<!\w)(?i:can(?=not\b)|gon(?=na\b)|got(?=ta\b)|wan(?=na\b)|gim(?=me\b)|lem(?=me\b)
+            |mor(?='n\b)|d(?='ye\b)|'t(?=is\b|was\b)))
+        |(?P<contraction>{_CONTRACTION})
+        |(?P<period>\.)
+        |(?P<word>(?:[^\s;@#$%&?!\[\](){{}}<>"«»“”‘’„`:,.'-]|[:,](?=\d)|-(?!-)
+                     |\.(?!\.\.|{_FINAL_PERIOD_TAIL})|'(?!'))+?
+            (?={_BOUNDARY}|{_CONTRACTION}))
+        """, re.VERBOSE)
+
+    def __init__(self, language: str, cache_size=2 ** 16):
+        """
+        Constructor of the :py:class:`RegexTokenizer` class.
+
+        :param language: 'french' or 'english', as for :py:class:`Tokenizer`.
+        :param cache_size: Number of sentences whose tokens are memoized (least recently used first out).
+        """
+        if language not in self.ABBREVIATIONS:
+            raise ValueError(f"Unsupported language '{language}'")
+        self.language = language
+        self.cache_size = cache_size
+        self.abbreviations = self.ABBREVIATIONS[language]
+        self.cached_tokenize = lru_cache(maxsize=cache_size)(self.tokenize)
+
+    @property
+    def name(self) -> str:
+        """
+        Identifier of the tokenization (e.g. in the key of the preprocessed dataset cache).
+        """
+        return f"regex-v1-{self.language}"
+
+    def __getstate__(self):
+        # the memoized tokens are not sent to other processes
+        return {'language': self.language, 'cache_size': self.cache_size}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def ends_sentence(self, word: str, text: str, position: int) -> bool:
+        """
+        Returns whether the period following ``word`` at ``position`` in ``text`` ends a sentence (in which case it is
+        split off), approximating Punkt.
+        """
+        following = text[position + 1:].lstrip(""" \t\n\r\f\v])}>"'»”’""")
+        if not following:
+            # end of the text
+            return True
+
+        if word.lower() in self.abbreviations or '.' in word or (len(word) == 1 and word.isalpha()):
+            return False
+
+        # ordinal numbers, e.g. "le 1. de la liste"
+        return not (word.isdigit() and following[0].islower())
+
+    def tokenize(self, text: str) -> tuple:
+        """
+        Tokenizes ``text`` (not memoized), see :py:func:`__call__`.
+        """
+        tokens, previous_end = [], -1
+        for match in self.PATTERN.finditer(text):
+            kind, token = match.lastgroup, match.group()
+
+            if kind == 'double_quote':
+                start = match.start()
+                token = '``' if start == 0 or text[start - 1] in ' ([{<' else "''"
+            elif kind == 'period' and previous_end == match.start() and tokens \
+                    and not self.ends_sentence(tokens[-1], text, match.start()):
+                # the period of an abbreviation stays in its token
+                tokens[-1] += token
+                previous_end = match.end()
+                continue
+
+            tokens.append(token)
+            previous_end = match.end() if kind == 'word' else -1
+
+        return tuple(tokens)
+
+    def __call__(self, text: str) -> List[str]:
+        """
+        tokenize a string in corresponding token
+        :param text: String to be tokenized.
+        :return: List of tokens.
+        """
+        return list(self.cached_tokenize(text))
+
+
 class Split(Flag):
     Train = auto()
     Validation = auto()
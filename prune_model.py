@@ -0,0 +1,80 @@
+import argparse
+from os.path import dirname
+
+import torch
+
+from dataset.iwslt import IWSLTDatasetBuilder
+from dataset.language_pairs import LanguagePair
+from dataset.utils import Split
+from training.loss import LabelSmoothingLoss
+from transformer.pruning import compute_importance, combined_scores, prune_model
+from try_model import load_checkpoint, load_model, validation_loss
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Structured pruning of the attention heads & feed-forward neurons')
+    parser.add_argument('--model-path', type=str, help='Path to the model to prune.')
+    parser.add_argument('--output-name', type=str, default='model_pruned.pt',
+                        help='Name of the pruned checkpoint, saved next to the model.')
+    parser.add_argument('--head-ratio', type=float, default=0.25,
+                        help='Fraction of the heads to remove in each attention.')
+    parser.add_argument('--neuron-ratio', type=float, default=0.25,
+                        help='Fraction of the hidden neurons to remove in each feed-forward.')
+    parser.add_argument('--entropy-weight', type=float, default=0.5,
+                        help='Weight of the attention entropy in the head scores (vs the gradient importance).')
+    parser.add_argument('--max-batches', type=int, default=None,
+                        help='Maximum number of held-out batches used to score the heads & neurons.')
+    args = parser.parse_args()
+    return args
+
+
+def n_parameters(model: torch.nn.Module) -> int:
+    return sum(p.numel() for p in model.parameters())
+
+
+if __name__ == '__main__':
+    args = get_args()
+    batch_size = 1024
+    checkpoint = load_checkpoint(args.model_path)
+    print("Loading dataset...")
+    _, val_iterator, _, src_vocab, trg_vocab = (
+        IWSLTDatasetBuilder.build(language_pair=LanguagePair.fr_en,
+                                  split=Split.Validation,
+                                  max_length=40, batch_size_train=batch_size,
+                                  use_nltk='vocabs' not in checkpoint)
+    )
+    print(f"Loading model from '{args.model_path}'...")
+    model = load_model(checkpoint, src_vocab, trg_vocab)
+    if torch.cuda.is_available():
+        model = model.cuda()
+
+    loss_fn = LabelSmoothingLoss(size=len(trg_vocab), padding_token=src_vocab.stoi['<blank>'], smoothing=0.)
+    if torch.cuda.is_available():
+        loss_fn = loss_fn.cuda()
+
+    def batches():
+        for batch in IWSLTDatasetBuilder.masked(IWSLTDatasetBuilder.transposed(val_iterator)):
+            if torch.cuda.is_available():
+                batch.cuda()
+            yield batch
+
+    print("Scoring the heads & neurons on the validation set...")
+    importance = compute_importance(model, batches(), loss_fn, max_batches=args.max_batches)
+    scores = combined_scores(importance, entropy_weight=args.entropy_weight)
+
+    pruned = prune_model(model, scores, head_ratio=args.head_ratio, neuron_ratio=args.neuron_ratio)
+
+    print("Computing loss on validation set...")
+    loss, _ = validation_loss(model, val_iterator, loss_fn)
+    pruned_loss, _ = validation_loss(pruned, val_iterator, loss_fn)
+
+    print("Done.")
+    for key, n_heads in pruned._params['attention']['n_heads'].items():
+        print(f"{key} heads: {n_heads}")
+    for key, d_ffs in pruned._params['feed-forward']['d_ffs'].items():
+        print(f"{key} hidden sizes: {d_ffs}")
+    print(f"Parameters: {n_parameters(model)} -> {n_parameters(pruned)}")
+    print(f"Validation loss: {loss:.6f} -> {pruned_loss:.6f}")
+
+    filename = pruned.save(dirname(args.model_path), checkpoint['epoch'], pruned_loss, model_name=args.output_name)
+    print(f"Pruned model saved to '{filename}'.")
@@ -0,0 +1,79 @@
+import argparse
+import io
+import time
+
+import torch
+
+from dataset.iwslt import IWSLTDatasetBuilder
+from dataset.language_pairs import LanguagePair
+from dataset.utils import Split
+from training.loss import LabelSmoothingLoss
+from transformer.quantization import quantize_model, save_quantized
+from try_model import load_checkpoint, load_model, validation_loss
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Int8 dynamic quantization of a trained model, for CPU inference')
+    parser.add_argument('--model-path',
+                        type=str,
+                        help='Path to the (float) model to quantize.')
+    parser.add_argument('--output-path',
+                        type=str,
+                        help='Where to save the quantized model.')
+    args = parser.parse_args()
+    return args
+
+
+def state_dict_size(model: torch.nn.Module) -> int:
+    """
+    Returns the size (in bytes) of the serialized ``state_dict`` of ``model``.
+    """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    batch_size = 1024
+    smoothing = 0.
+    checkpoint = load_checkpoint(args.model_path)
+    print("Loading dataset...")
+    _, val_iterator, _, src_vocab, trg_vocab = (
+        IWSLTDatasetBuilder.build(language_pair=LanguagePair.fr_en,
+                                  split=Split.Validation,
+                                  max_length=40, batch_size_train=batch_size,
+                                  use_nltk='vocabs' not in checkpoint)
+    )
+    print(f"Loading model from '{args.model_path}'...")
+    float_model = load_model(checkpoint, src_vocab, trg_vocab)
+    float_model.eval()
+
+    print("Quantizing model...")
+    quantized_model = quantize_model(float_model)
+    save_quantized(quantized_model, args.output_path, source=args.model_path)
+    print(f"Quantized model saved to '{args.output_path}'.")
+
+    loss_fn = LabelSmoothingLoss(size=len(trg_vocab),
+                                 padding_token=src_vocab.stoi['<blank>'],
+                                 smoothing=smoothing)
+
+    # both models are evaluated on CPU, where the quantized one runs
+    results = {}
+    for name, model in [('float32', float_model), ('int8', quantized_model)]:
+        print(f"Computing loss on validation set ({name})...")
+        start = time.perf_counter()
+        val_loss, n_batches = validation_loss(model, val_iterator, loss_fn, use_cuda=False)
+        elapsed = time.perf_counter() - start
+
+        results[name] = (state_dict_size(model) / 2 ** 20, elapsed / n_batches, val_loss)
+
+    print("Done.")
+    print(f"Batch size: {batch_size} | Smoothing = {smoothing}")
+    print(f"{'model':>8} | {'size (MB)':>10} | {'latency (s / batch)':>20} | {'validation loss':>16}")
+    for name, (size, latency, val_loss) in results.items():
+        print(f"{name:>8} | {size:10.1f} | {latency:20.4f} | {val_loss:16.6f}")
+
+    (float_size, float_latency, float_loss), (size, latency, val_loss) = results['float32'], results['int8']
+    print(f"int8 vs float32: size x{size / float_size:.2f}, latency x{latency / float_latency:.2f}, "
+          f"loss {val_loss - float_loss:+.6f}")
@@ -0,0 +1,50 @@
+import argparse
+import asyncio
+
+import torch
+
+from dataset.language_pairs import LanguagePair
+from serving.server import DynamicBatcher, TranslationServer, Translator
+from transformer.encoder_cache import EncoderCache
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Local HTTP / JSON translation server')
+    parser.add_argument('--model-path',
+                        type=str,
+                        help='Path to the checkpoint of the model (with its vocabularies, as saved by the Trainer).')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on.')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on.')
+    parser.add_argument('--max-batch-size', type=int, default=32, help='Maximum number of sentences per batch.')
+    parser.add_argument('--max-delay', type=float, default=10.,
+                        help='Maximum time (in ms) a sentence waits for its batch to fill up.')
+    parser.add_argument('--bucket-width', type=int, default=5,
+                        help='Width (in tokens) of the source length buckets in which the sentences are batched.')
+    parser.add_argument('--encoder-cache-mb', type=float, default=0.,
+                        help='Size (in MB) of the cache of the encoder outputs of the repeated sentences (0: none).')
+    args = parser.parse_args()
+    return args
+
+
+async def main(args) -> None:
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    encoder_cache = EncoderCache(int(args.encoder_cache_mb * 2 ** 20)) if args.encoder_cache_mb > 0 else None
+    translator = Translator.from_checkpoint(args.model_path, device=device, encoder_cache=encoder_cache)
+
+    source_tokenizer, _ = LanguagePair.fr_en.tokenizer()
+
+    batcher = DynamicBatcher(translator, max_batch_size=args.max_batch_size, max_delay=args.max_delay / 1000,
+                             bucket_width=args.bucket_width)
+    server = await TranslationServer(batcher, source_tokenizer, encoder_cache=encoder_cache).start(args.host,
+                                                                                                  args.port)
+    print(f"Serving '{args.model_path}' on http://{args.host}:{args.port} ({device})...")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batcher.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(get_args()))
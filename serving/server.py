@@ -0,0 +1,350 @@
+import asyncio
+import bisect
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+import torch
+
+from transformer.encoder_cache import EncoderCache
+from transformer.model import Transformer
+
+# upper bounds of the buckets of the histograms
+LATENCY_BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_SIZE_BOUNDS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+class Histogram(object):
+    """
+    Cumulative histogram of observed values (e.g. latencies), with fixed bucket upper bounds.
+    """
+
+    def __init__(self, bounds: Sequence[float]):
+        """
+        Constructor of the :py:class:`Histogram` class.
+
+        :param bounds: Increasing upper bounds of the buckets. A last bucket holds the values above them.
+        """
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value: float) -> None:
+        """
+        Adds ``value`` to the histogram.
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self) -> dict:
+        """
+        Returns the histogram as a JSON-serializable dict: the number of values lower or equal to each bound
+        (``'le'``), their total count & sum.
+        """
+        cumulative, buckets = 0, []
+        for bound, count in zip(self.bounds + ['+Inf'], self.counts):
+            cumulative += count
+            buckets.append({'le': bound, 'count': cumulative})
+
+        return {'buckets': buckets, 'count': self.count, 'sum': self.sum}
+
+
+class Vocabulary(object):
+    """
+    Minimal vocabulary (``itos`` & ``stoi``, as the ``torchtext`` ones) rebuilt from the symbols saved in a
+    checkpoint. Unknown symbols are mapped to ``unk_symbol``.
+    """
+
+    def __init__(self, itos: List[str], unk_symbol="<unk>"):
+        self.itos = itos
+        self.stoi = {symbol: i for i, symbol in enumerate(itos)}
+        self.unk_index = self.stoi.get(unk_symbol, 0)
+
+    def numericalize(self, tokens: List[str]) -> List[int]:
+        return [self.stoi.get(token, self.unk_index) for token in tokens]
+
+
+class Translator(object):
+    """
+    Translates batches of tokenized sentences with a trained ``Transformer``, using greedy decoding.
+    """
+
+    def __init__(self, model: Transformer, src_vocab: Vocabulary, trg_vocab: Vocabulary, device='cpu',
+                 pad_symbol="<blank>", max_length=100, max_length_ratio: Optional[float] = 1.5,
+                 encoder_cache: Optional[EncoderCache] = None):
+        """
+        Constructor of the :py:class:`Translator` class.
+
+        :param model: Model used for the translations.
+
+        :param src_vocab: Vocabulary of the source sentences.
+
+        :param trg_vocab: Vocabulary of the target sentences.
+
+        :param device: Device on which to run the model.
+
+        :param pad_symbol: Padding symbol of both vocabularies.
+
+        :param max_length: Maximum number of tokens of the translations.
+
+        :param max_length_ratio: If not ``None``, caps the length of each translation relatively to the length of
+            the source sentence (see :py:func:`Transformer.greedy_search`).
+
+        :param encoder_cache: If not ``None``, cache of the ``Encoder`` outputs of the repeated source sentences.
+        """
+        self.device = torch.device(device)
+        self.model = model.to(self.device).eval()
+        self.src_vocab, self.trg_vocab = src_vocab, trg_vocab
+        self.pad_symbol = pad_symbol
+        self.max_length, self.max_length_ratio = max_length, max_length_ratio
+        self.encoder_cache = encoder_cache
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint_file: str, **kwargs) -> 'Translator':
+        """
+        Creates a :py:class:`Translator` from a checkpoint written by :py:func:`Transformer.save`, which should
+        contain the params of the model & its vocabularies (as saved by the ``Trainer``). Nothing is downloaded.
+
+        :param checkpoint_file: Path of the checkpoint.
+
+        :param kwargs: Other arguments of the constructor.
+        """
+        checkpoint = torch.load(checkpoint_file, map_location='cpu')
+        if checkpoint.get('vocabs') is None:
+            raise ValueError(f"The checkpoint {checkpoint_file} does not contain the vocabularies of the model.")
+
+        model = Transformer(params=checkpoint['params'])
+        model.load(checkpoint)
+
+        return cls(model, Vocabulary(checkpoint['vocabs']['src']), Vocabulary(checkpoint['vocabs']['trg']),
+                   **kwargs)
+
+    def __call__(self, sentences: List[List[str]]) -> List[str]:
+        """
+        Translates a batch of tokenized sentences.
+
+        :param sentences: List of non-empty lists of tokens.
+
+        :return: List of the translations, whose words are separated by spaces.
+        """
+        pad_index = self.src_vocab.stoi[self.pad_symbol]
+        src = torch.full((len(sentences), max(len(tokens) for tokens in sentences)), pad_index, dtype=torch.long)
+        for i, tokens in enumerate(sentences):
+            src[i, :len(tokens)] = torch.tensor(self.src_vocab.numericalize(tokens), dtype=torch.long)
+
+        src = src.to(self.device)
+        src_mask = (src != pad_index).unsqueeze(-2)
+
+        with torch.no_grad():
+            _, translations = self.model.greedy_decode_batch(src, src_mask, self.trg_vocab,
+                                                             pad_symbol=self.pad_symbol, max_length=self.max_length,
+                                                             max_length_ratio=self.max_length_ratio,
+                                                             encoder_cache=self.encoder_cache)
+
+        return translations
+
+
+class DynamicBatcher(object):
+    """
+    Groups the sentences to translate into batches of similar source lengths (to limit the padding): a batch is
+    translated as soon as it reaches ``max_batch_size`` sentences, or ``max_delay`` seconds after its first sentence
+    arrived.
+
+    The batches are translated on a worker thread, so that the event loop keeps accepting requests meanwhile.
+    """
+
+    def __init__(self, translate: Callable[[List[List[str]]], List[str]], max_batch_size=32, max_delay=0.01,
+                 bucket_width=5):
+        """
+        Constructor of the :py:class:`DynamicBatcher` class.
+
+        :param translate: Function translating a batch of tokenized sentences, e.g. a :py:class:`Translator`.
+
+        :param max_batch_size: Maximum number of sentences per batch.
+
+        :param max_delay: Maximum time (in seconds) a sentence waits for its batch to fill up.
+
+        :param bucket_width: Sentences whose lengths differ by less than ``bucket_width`` tokens (and have the same
+            quotient by it) are batched together.
+        """
+        self.translate = translate
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.bucket_width = bucket_width
+
+        # one worker: the batches are translated one after the other
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        # pending sentences (tokens, future) of each bucket & the timer dispatching them
+        self.buckets = {}  # type: Dict[int, List[Tuple[List[str], asyncio.Future]]]
+        self.timers = {}  # type: Dict[int, asyncio.TimerHandle]
+        # batches being translated: the event loop only keeps weak references to the tasks
+        self.tasks = set()  # type: Set[asyncio.Task]
+
+        self.latency = Histogram(LATENCY_BOUNDS)
+        self.batch_size = Histogram(BATCH_SIZE_BOUNDS)
+
+    async def submit(self, tokens: List[str]) -> str:
+        """
+        Queues a tokenized sentence, and returns its translation once its batch has been translated.
+        """
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+
+        key = len(tokens) // self.bucket_width
+        future = loop.create_future()
+        bucket = self.buckets.setdefault(key, [])
+        bucket.append((tokens, future))
+
+        if len(bucket) >= self.max_batch_size:
+            self.dispatch(key)
+        elif len(bucket) == 1:
+            self.timers[key] = loop.call_later(self.max_delay, self.dispatch, key)
+
+        try:
+            return await future
+        finally:
+            self.latency.observe(time.perf_counter() - start)
+
+    def dispatch(self, key: int) -> None:
+        """
+        Sends the pending sentences of a bucket to the worker thread.
+        """
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+
+        requests = self.buckets.pop(key, [])
+        if requests:
+            self.batch_size.observe(len(requests))
+            task = asyncio.get_running_loop().create_task(self._run(requests))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, requests: List[Tuple[List[str], asyncio.Future]]) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            translations = await loop.run_in_executor(self.executor, self.translate,
+                                                      [tokens for tokens, _ in requests])
+        except Exception as e:
+            for _, future in requests:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), translation in zip(requests, translations):
+            if not future.done():
+                future.set_result(translation)
+
+    def metrics(self) -> dict:
+        """
+        Returns the latency (in seconds, from the submission of a sentence to its translation) & batch size
+        histograms.
+        """
+        return {'latency_seconds': self.latency.to_dict(), 'batch_size': self.batch_size.to_dict()}
+
+    def close(self) -> None:
+        """
+        Stops the worker thread, once the current batch is translated.
+        """
+        self.executor.shutdown(wait=True)
+
+
+class TranslationServer(object):
+    """
+    Local HTTP / JSON translation service:
+
+        - ``POST /translate`` with ``{"text": "..."}`` or ``{"texts": ["...", ...]}`` (or the already tokenized
+          ``{"tokens": [...]}`` / ``{"tokens": [[...], ...]}``) returns ``{"translations": ["...", ...]}``,
+        - ``GET /metrics`` returns the latency & batch size histograms (and the counters of the encoder cache),
+        - ``GET /health`` returns ``{"status": "ok"}``.
+
+    Each request only waits for its own sentences, which are batched with those of the other requests
+    (see :py:class:`DynamicBatcher`).
+    """
+
+    def __init__(self, batcher: DynamicBatcher, tokenizer: Callable[[str], List[str]],
+                 encoder_cache: Optional[EncoderCache] = None):
+        """
+        Constructor of the :py:class:`TranslationServer` class.
+
+        :param batcher: Batcher translating the sentences.
+
+        :param tokenizer: Tokenizer of the source language, for the raw text requests.
+
+        :param encoder_cache: If not ``None``, encoder cache of the translator, whose counters are exported.
+        """
+        self.batcher = batcher
+        self.tokenizer = tokenizer
+        self.encoder_cache = encoder_cache
+
+    async def translate(self, request: dict) -> dict:
+        """
+        Handles the body of a ``POST /translate`` request.
+        """
+        if 'tokens' in request:
+            sentences = request['tokens']
+            if sentences and isinstance(sentences[0], str):
+                sentences = [sentences]
+        elif 'text' in request:
+            sentences = [self.tokenizer(request['text'])]
+        else:
+            sentences = [self.tokenizer(text) for text in request['texts']]
+
+        if not sentences or not all(sentences):
+            raise ValueError("The sentences to translate should not be empty.")
+
+        translations = await asyncio.gather(*(self.batcher.submit(tokens) for tokens in sentences))
+        return {'translations': list(translations)}
+
+    def metrics(self) -> dict:
+        metrics = self.batcher.metrics()
+        if self.encoder_cache is not None:
+            metrics['encoder_cache'] = self.encoder_cache.stats()
+        return metrics
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Handles one HTTP connection (one request, then the connection is closed).
+        """
+        try:
+            method, path, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            if method == 'POST' and path == '/translate':
+                status, response = 200, await self.translate(json.loads(body.decode('utf-8')))
+            elif method == 'GET' and path == '/metrics':
+                status, response = 200, self.metrics()
+            elif method == 'GET' and path == '/health':
+                status, response = 200, {'status': 'ok'}
+            else:
+                status, response = 404, {'error': f"Unknown endpoint: {method} {path}"}
+        except (ValueError, KeyError, TypeError) as e:
+            status, response = 400, {'error': str(e)}
+        except Exception as e:
+            status, response = 500, {'error': str(e)}
+
+        payload = json.dumps(response).encode('utf-8')
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}[status]
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode('latin-1') + payload)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8000) -> asyncio.AbstractServer:
+        """
+        Starts listening on ``host:port`` (``port=0`` picks a free port), and returns the ``asyncio`` server.
+        """
+        return await asyncio.start_server(self.handle, host, port)
@@ -0,0 +1,84 @@
+import argparse
+import time
+
+import torch
+
+from dataset.iwslt import IWSLTDatasetBuilder
+from dataset.language_pairs import LanguagePair
+from dataset.utils import Split
+from transformer.model import Transformer
+from transformer.shortlist import Shortlist, shortlist_recall
+from try_model import default_params
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Vocabulary shortlist for decoding: build it & measure its recall')
+    parser.add_argument('--model-path',
+                        type=str,
+                        help='Path to the model to evaluate.')
+    parser.add_argument('--shortlist-path',
+                        type=str,
+                        help='Where to save the shortlist built on the training set.')
+    parser.add_argument('--n-translations', type=int, default=10, help='Number of translations per source token.')
+    parser.add_argument('--n-frequent', type=int, default=100, help='Number of most frequent target tokens.')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_args()
+    batch_size = 1024
+    use_cuda = torch.cuda.is_available()
+    print("Loading dataset...")
+    train_iterator, val_iterator, _, src_vocab, trg_vocab = (
+        IWSLTDatasetBuilder.build(language_pair=LanguagePair.fr_en,
+                                  split=Split.Train | Split.Validation,
+                                  max_length=40, batch_size_train=batch_size,
+                                  batch_size_validation=batch_size)
+    )
+
+    print("Building shortlist on the training set...")
+    pairs = (([src_vocab.stoi[token] for token in example.src],
+              [trg_vocab.stoi[token] for token in example.trg + ['</s>']])
+             for example in train_iterator.dataset.examples)
+    shortlist = Shortlist.build(pairs, len(src_vocab), len(trg_vocab),
+                                n_translations=args.n_translations, n_frequent=args.n_frequent)
+    shortlist.save(args.shortlist_path)
+    print(f"Shortlist saved to '{args.shortlist_path}'.")
+
+    print(f"Loading model from '{args.model_path}'...")
+    model = Transformer.load_model_from_file(args.model_path, params=default_params(src_vocab, trg_vocab))
+    if use_cuda:
+        model.cuda()
+        shortlist.to('cuda')
+    model.eval()
+
+    def batches():
+        for batch in IWSLTDatasetBuilder.masked(IWSLTDatasetBuilder.transposed(val_iterator)):
+            if use_cuda:
+                batch.cuda()
+            yield batch
+
+    print("Computing recall on validation set...")
+    stop_index = trg_vocab.stoi['</s>']
+    recall, n_candidates = shortlist_recall(model, batches(), shortlist, padding_token=trg_vocab.stoi['<blank>'],
+                                            required=[stop_index])
+
+    # greedy decoding time, with & without shortlist
+    times = {}
+    with torch.no_grad():
+        for name, decoding_shortlist in [('full', None), ('shortlist', shortlist)]:
+            start = time.perf_counter()
+            for batch in batches():
+                model.greedy_decode_batch(batch.src, batch.src_mask, trg_vocab, max_length=40,
+                                          shortlist=decoding_shortlist)
+            if use_cuda:
+                torch.cuda.synchronize()
+            times[name] = time.perf_counter() - start
+
+    print("Done.")
+    print(f"Vocabulary size: {len(trg_vocab)} | Candidates per batch: {n_candidates:.1f} "
+          f"({n_candidates / len(trg_vocab):.1%} of the vocabulary)")
+    print(f"Recall of the full-vocabulary argmax: {recall:.4%}")
+    print(f"Greedy decoding time: full {times['full']:.2f} s, shortlist {times['shortlist']:.2f} s "
+          f"(x{times['shortlist'] / times['full']:.2f})")
@@ -0,0 +1,88 @@
+import argparse
+import time
+
+import torch
+
+from dataset.iwslt import IWSLTDatasetBuilder
+from dataset.language_pairs import LanguagePair
+from dataset.utils import Split
+from transformer.model import Transformer
+from try_model import load_checkpoint, load_model
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Greedy vs speculative decoding with a small draft model')
+    parser.add_argument('--model-path',
+                        type=str,
+                        help='Path to the model to decode with.')
+    parser.add_argument('--draft-path',
+                        type=str,
+                        help='Path to the draft model, trained on the same vocabularies.')
+    parser.add_argument('--n-draft-tokens', type=int, default=4, help='Number of tokens proposed at each step.')
+    parser.add_argument('--batch-size', type=int, default=1, help='Number of sentences decoded together.')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_args()
+    use_cuda = torch.cuda.is_available()
+    max_length = 40
+    checkpoint = load_checkpoint(args.model_path)
+    print("Loading dataset...")
+    _, val_iterator, _, src_vocab, trg_vocab = (
+        IWSLTDatasetBuilder.build(language_pair=LanguagePair.fr_en,
+                                  split=Split.Validation,
+                                  max_length=max_length, batch_size_validation=args.batch_size,
+                                  use_nltk='vocabs' not in checkpoint)
+    )
+
+    print(f"Loading models from '{args.model_path}' & '{args.draft_path}'...")
+    model = load_model(checkpoint, src_vocab, trg_vocab)
+    draft = Transformer.load_model_from_file(args.draft_path)
+    if use_cuda:
+        model.cuda()
+        draft.cuda()
+    model.eval()
+    draft.eval()
+
+    start_index, stop_index = trg_vocab.stoi['<s>'], trg_vocab.stoi['</s>']
+    pad_index = trg_vocab.stoi['<blank>']
+
+    def batches():
+        for batch in IWSLTDatasetBuilder.masked(IWSLTDatasetBuilder.transposed(val_iterator)):
+            if use_cuda:
+                batch.cuda()
+            yield batch
+
+    print("Decoding validation set...")
+    times, n_tokens, n_mismatches, statistics = {'greedy': 0., 'speculative': 0.}, 0, 0, {}
+    with torch.no_grad():
+        for batch in batches():
+            start = time.perf_counter()
+            expected = model.greedy_search(batch.src, batch.src_mask, start_index, stop_index, pad_index,
+                                           max_length=max_length)
+            if use_cuda:
+                torch.cuda.synchronize()
+            times['greedy'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            tokens = model.speculative_search(batch.src, batch.src_mask, draft, start_index, stop_index, pad_index,
+                                              max_length=max_length, n_draft_tokens=args.n_draft_tokens,
+                                              statistics=statistics)
+            if use_cuda:
+                torch.cuda.synchronize()
+            times['speculative'] += time.perf_counter() - start
+
+            # predicted tokens, up to the stop symbol
+            n_tokens += int((expected[:, 1:] != pad_index).sum())
+            n_mismatches += int(tokens.shape != expected.shape or not torch.equal(tokens, expected))
+
+    print("Done.")
+    print(f"Batch size: {args.batch_size} | Draft tokens per step: {args.n_draft_tokens}")
+    print(f"Acceptance rate: {statistics['accepted'] / max(statistics['drafted'], 1):.2%} "
+          f"| Tokens per pass of the model: {n_tokens / statistics['passes']:.2f}")
+    for name, elapsed in times.items():
+        print(f"{name:>11}: {n_tokens / elapsed:10.1f} tokens / s")
+    print(f"Speed-up: x{times['greedy'] / times['speculative']:.2f} "
+          f"| Batches differing from greedy decoding: {n_mismatches}")
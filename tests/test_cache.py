@@ -0,0 +1,76 @@
+import tempfile
+from unittest import TestCase
+
+import torch
+from torchtext import data
+
+from dataset.cache import CachedBucketIterator, DatasetCache
+from dataset.iwslt import IWSLTDatasetBuilder
+
+
+class TestDatasetCache(TestCase):
+    def setUp(self):
+        self.src_field = data.Field(tokenize=str.split, pad_token="<blank>")
+        self.trg_field = data.Field(tokenize=str.split, init_token="<s>", eos_token="</s>", pad_token="<blank>")
+        fields = [('src', self.src_field), ('trg', self.trg_field)]
+
+        pairs = [("le chat", "the cat"), ("un chien noir", "a black dog"), ("le chien", "the dog"),
+                 ("un chat noir et blanc", "a black and white cat"), ("bonjour", "hello")]
+        self.dataset = data.Dataset([data.Example.fromlist(pair, fields) for pair in pairs], fields)
+        self.src_field.build_vocab(self.dataset)
+        self.trg_field.build_vocab(self.dataset)
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings = {'language_pair': 'fr_en', 'max_length': 40, 'min_freq': 1}
+        self.cache = DatasetCache(self.directory.name, self.settings)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_write_read(self):
+        self.assertFalse(self.cache.contains(['train']))
+        self.cache.write({'train': self.dataset}, self.src_field.vocab, self.trg_field.vocab)
+
+        self.assertTrue(self.cache.contains(['train']))
+        self.assertFalse(self.cache.contains(['train', 'test']))
+        self.assertFalse(DatasetCache(self.directory.name, dict(self.settings, min_freq=2)).contains(['train']))
+
+        src_vocab, trg_vocab = self.cache.vocabs()
+        self.assertEqual(src_vocab.itos, self.src_field.vocab.itos)
+
+        split = self.cache.split('train')
+        self.assertEqual(len(split), 5)
+        for i, example in enumerate(self.dataset.examples):
+            self.assertEqual([src_vocab.itos[token] for token in split.sentence('src', i)], example.src)
+            self.assertEqual([trg_vocab.itos[token] for token in split.sentence('trg', i)], example.trg)
+
+    def test_iterator(self):
+        self.cache.write({'train': self.dataset}, self.src_field.vocab, self.trg_field.vocab)
+        split = self.cache.split('train')
+
+        iterator = CachedBucketIterator(split, self.src_field, self.trg_field, batch_size=2, shuffle=True)
+        batches = list(iterator)
+        self.assertEqual(sorted(batch.batch_size for batch in batches), [1, 2, 2])
+
+        trg_vocab = self.trg_field.vocab
+        translations = set()
+        for batch in batches:
+            # same layout as the torchtext batches: (seq_len, batch_size)
+            self.assertEqual(batch.src.shape[1], batch.batch_size)
+            for column in batch.trg.t().tolist():
+                words = [trg_vocab.itos[token] for token in column if trg_vocab.itos[token] != "<blank>"]
+                self.assertEqual((words[0], words[-1]), ("<s>", "</s>"))
+                translations.add(' '.join(words[1:-1]))
+        self.assertEqual(translations, {' '.join(example.trg) for example in self.dataset.examples})
+
+        # as consumed by the Trainer
+        for batch in IWSLTDatasetBuilder.masked(IWSLTDatasetBuilder.transposed(iterator)):
+            # (batch_size, seq_len) & targets shifted by one position
+            self.assertEqual(batch.src.shape[0], batch.trg.shape[0])
+            self.assertEqual(batch.trg_shifted.shape, batch.trg.shape)
+            self.assertTrue(torch.equal(batch.trg_shifted[:, :-1], batch.trg[:, 1:]))
+
+        # token budget: padded source + target tokens
+        iterator = CachedBucketIterator(split, self.src_field, self.trg_field, batch_size=2, max_tokens=16)
+        for batch in iterator:
+            self.assertLessEqual(batch.src.numel() + batch.trg.numel(), 16)
@@ -0,0 +1,60 @@
+import tempfile
+from types import SimpleNamespace
+from unittest import TestCase
+
+import torch
+
+from training.distillation import TeacherCache, DistillationLoss
+from training.loss import LabelSmoothingLoss
+
+
+class TestDistillation(TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.vocab_size = 20
+
+        # 3 sentences, with some padding (index 0)
+        src = torch.randint(low=1, high=self.vocab_size, size=(3, 7))
+        src[1, 5:] = 0
+        trg = torch.randint(low=1, high=self.vocab_size, size=(3, 6))
+        trg[2, 3:] = 0
+        self.batch = SimpleNamespace(src=src, trg=trg[:, :-1], trg_shifted=trg[:, 1:])
+
+    def test_teacher_cache(self):
+        logits = torch.randn((3, 5, self.vocab_size))
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = TeacherCache(directory, k=4)
+            self.assertIsNone(cache.lookup(self.batch, padding_token=0))
+
+            values, indices = cache.store(self.batch, logits, padding_token=0)
+            self.assertEqual(len(cache), 3)
+            cache.flush()
+
+            # the cache is reloaded from the disk, and doesn't depend on the order of the sentences
+            cache = TeacherCache(directory, k=4)
+            order = torch.tensor([2, 0, 1])
+            shuffled = SimpleNamespace(src=self.batch.src[order], trg=self.batch.trg[order],
+                                       trg_shifted=self.batch.trg_shifted[order])
+            cached_values, cached_indices = cache.lookup(shuffled, padding_token=0)
+
+        mask = (shuffled.trg_shifted != 0).unsqueeze(-1)
+        self.assertTrue(torch.equal(cached_indices, indices[order] * mask))
+        self.assertTrue(torch.allclose(cached_values, values[order] * mask, atol=1e-2))
+
+    def test_distillation_loss(self):
+        base_loss = LabelSmoothingLoss(size=self.vocab_size, padding_token=0, smoothing=0.1)
+        logits = torch.randn((3, 5, self.vocab_size))
+        teacher_values, teacher_indices = logits.topk(self.vocab_size, dim=-1)
+
+        # only the base loss
+        loss = DistillationLoss(base_loss, padding_token=0, alpha=0.)
+        self.assertTrue(torch.allclose(loss(logits, self.batch.trg_shifted, teacher_values, teacher_indices),
+                                       base_loss(logits, self.batch.trg_shifted)))
+
+        # the student has the same distribution as the teacher: no divergence
+        loss = DistillationLoss(base_loss, padding_token=0, alpha=1., temperature=2.)
+        self.assertAlmostEqual(loss(logits, self.batch.trg_shifted, teacher_values, teacher_indices).item(), 0.,
+                               places=5)
+        self.assertGreater(loss(torch.randn_like(logits), self.batch.trg_shifted, teacher_values,
+                                teacher_indices).item(), 0.)
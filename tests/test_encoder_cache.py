@@ -0,0 +1,45 @@
+import torch
+
+from tests.test_model import SmallTransformerTestCase
+from transformer.encoder_cache import EncoderCache
+
+
+class TestEncoderCache(SmallTransformerTestCase):
+    def test_mixed_batch(self):
+        """
+        A batch mixing cached & new sentences (with a different padded length) should be decoded as without cache.
+        """
+        cache = EncoderCache(max_bytes=2 ** 20)
+        with torch.no_grad():
+            cache.encode(self.transformer, self.src[:4], self.src_mask[:4])
+            self.assertEqual(cache.stats()['misses'], 4)
+
+            # sentences 0-3 are cached, 4-7 are not: the first one is shorter than the padded length
+            src = torch.cat([self.src, torch.zeros((8, 3), dtype=torch.long)], dim=1)
+            src_mask = (src != 0).unsqueeze(-2)
+            memory = cache.encode(self.transformer, src, src_mask)
+            expected = self.transformer.encode(src, src_mask)
+
+            tokens = self.transformer.greedy_search(src, src_mask, start_index=1, stop_index=2, max_length=10,
+                                                    encoder_cache=cache)
+            expected_tokens = self.transformer.greedy_search(src, src_mask, start_index=1, stop_index=2,
+                                                             max_length=10)
+
+        self.assertTrue(torch.allclose(memory * src_mask.transpose(1, 2), expected * src_mask.transpose(1, 2),
+                                       atol=1e-5))
+        self.assertTrue(torch.equal(tokens, expected_tokens))
+        self.assertEqual(cache.stats(), {'hits': 4 + 8, 'misses': 4 + 4, 'evictions': 0, 'entries': 8,
+                                         'bytes': 4 * int(src_mask.sum()) * self.params['d_model']})
+
+    def test_eviction(self):
+        # room for the memories of 2 sentences of 11 tokens
+        cache = EncoderCache(max_bytes=2 * 11 * self.params['d_model'] * 4)
+        with torch.no_grad():
+            for i in (1, 2, 1, 3):
+                cache.encode(self.transformer, self.src[i:i + 1], self.src_mask[i:i + 1])
+
+        # sentence 2 was the least recently used one
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertIn(cache.sentence_key(self.src[1]), cache.entries)
+        self.assertNotIn(cache.sentence_key(self.src[2]), cache.entries)
+        self.assertEqual(cache.bytes, 2 * 11 * self.params['d_model'] * 4)
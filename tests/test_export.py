@@ -0,0 +1,24 @@
+import os
+import tempfile
+
+import torch
+
+from tests.test_model import SmallTransformerTestCase
+from transformer.export import export_model, load_exported
+
+
+class TestExport(SmallTransformerTestCase):
+    def test_export_model(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = export_model(self.transformer, os.path.join(directory, 'transformer.pt2'))
+            exported = load_exported(filename)
+
+        # other sizes than the example inputs used for the export
+        trg = torch.randint(low=1, high=self.params["tgt_vocab_size"], size=(8, 13))
+        trg_mask = torch.ones_like(trg, dtype=torch.bool).unsqueeze(-2)
+
+        with torch.no_grad():
+            expected = self.transformer(self.src, self.src_mask, trg, trg_mask)
+            logits = exported(self.src, self.src_mask, trg, trg_mask)
+
+        self.assertTrue(torch.allclose(logits, expected, atol=1e-5))
@@ -1,8 +1,12 @@
 from os import getenv
+from types import SimpleNamespace
 from unittest import TestCase, skipIf
 
+from torchtext import data
+
 from dataset.iwslt import IWSLTDatasetBuilder
 from dataset.language_pairs import LanguagePair
+from dataset.formatter import BatchMasker
 from dataset.utils import Split
 
 
@@ -50,4 +54,32 @@ class TestIWSLT(TestCase):
         self.assertIsNone(test_iterator)
         self.assertIsNotNone(val_iterator)
         print(len(list(val_iterator)))
-        pass
\ No newline at end of file
+        pass
+
+    @skipIf(len(getenv("CI", "")) > 0, "skipping slow tests on CI")
+    def test_build_token_budget_batches(self):
+        max_tokens = 2000
+
+        dataset_iterator, _, _, _, _ = (
+            IWSLTDatasetBuilder.build(language_pair=LanguagePair.fr_en,
+                                      split=Split.Train,
+                                      max_length=40, max_tokens=max_tokens)
+        )
+        for i, batch in enumerate(IWSLTDatasetBuilder.masked(IWSLTDatasetBuilder.transposed(dataset_iterator))):
+            self.assertLessEqual(batch.src.numel() + batch.batch.trg.numel(), max_tokens)
+            self.assertLess(batch.padding_ratio, 0.5)
+            if i == 10:
+                break
+
+
+class TestTokenBudget(TestCase):
+    def test_batches(self):
+        # source & target lengths (the targets get 2 more tokens)
+        lengths = [(3, 2), (4, 4), (2, 1), (10, 8), (1, 1)]
+        examples = [SimpleNamespace(src=['a'] * src, trg=['b'] * trg) for src, trg in lengths]
+
+        batches = list(data.batch(examples, 20, IWSLTDatasetBuilder.token_budget()))
+
+        # 2 * (4 + 6) = 20 tokens, then each sentence alone: adding the next one would exceed the budget
+        self.assertEqual([[len(example.src) for example in batch] for batch in batches], [[3, 4], [2], [10], [1]])
+
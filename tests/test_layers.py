@@ -0,0 +1,26 @@
+from unittest import TestCase
+
+import torch
+
+from transformer.layers import LayerNormalization
+
+
+class TestLayerNormalization(TestCase):
+    def test_backends(self):
+        """
+        Both backends share the same parameters and should only differ by the placement of epsilon.
+        """
+        x = torch.randn((8, 10, 64)) * 3 + 1
+
+        norm = LayerNormalization(64)
+        norm.a_2.data.uniform_(0.5, 1.5)
+        norm.b_2.data.uniform_(-0.5, 0.5)
+
+        mean, std = x.mean(dim=-1, keepdim=True), x.std(dim=-1, keepdim=True)
+        expected = norm.a_2 * (x - mean) / (std + norm.eps) + norm.b_2
+
+        # the exact backend reproduces the original equation
+        self.assertTrue(torch.equal(norm(x), expected))
+
+        norm.fused = True
+        self.assertTrue(torch.allclose(norm(x), expected, atol=1e-5))
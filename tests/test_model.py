@@ -1,6 +1,10 @@
 import torch
 from unittest import TestCase
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+from training.loss import AdaptiveSoftmaxLoss, CrossEntropyLoss, LabelSmoothingLoss
 from transformer.model import Transformer
+from transformer.utils import subsequent_mask
 
 
 class TestEncoder(TestCase):
@@ -48,3 +52,308 @@ class TestEncoder(TestCase):
         self.assertEqual(logits.shape, torch.Size([batch_size, output_sequence_length, params['tgt_vocab_size']]))
         # check no nan values
         self.assertEqual(torch.isnan(logits).sum(), 0)
+
+
+class SmallTransformerTestCase(TestCase):
+    """
+    Instantiates a small ``Transformer`` (in inference mode) and a batch of random source sentences.
+    """
+    def setUp(self):
+        torch.manual_seed(0)
+
+        self.params = {
+            'd_model': 64,
+            'src_vocab_size': 100,
+            'tgt_vocab_size': 120,
+
+            'N': 2,
+            'dropout': 0.1,
+
+            'attention': {'n_head': 4,
+                          'd_k': 16,
+                          'd_v': 16,
+                          'dropout': 0.1},
+
+            'feed-forward': {'d_ff': 128,
+                             'dropout': 0.1},
+        }
+        self.transformer = Transformer(self.params)
+        self.transformer.eval()
+
+        # create a batch of random samples, with some padding (pad_token=0) at the end of the first sentence
+        self.src = torch.randint(low=1, high=self.params["src_vocab_size"], size=(8, 11))
+        self.src[0, 7:] = 0
+        self.src_mask = (self.src != 0).unsqueeze(-2)
+
+
+class TestIncrementalDecoding(SmallTransformerTestCase):
+    def test_cached_decoder_matches_full_recompute(self):
+        """
+        Feeding the target tokens one at a time through the cached ``Decoder`` should give the same outputs
+        as feeding the whole target sequence at once (with the subsequent mask).
+        """
+        trg = torch.randint(low=1, high=self.params["tgt_vocab_size"], size=(8, 9))
+
+        with torch.no_grad():
+            memory = self.transformer.encode(self.src, self.src_mask)
+
+            full = self.transformer.decoder(x=self.transformer.embed_target(trg), memory=memory,
+                                            self_mask=subsequent_mask(trg.shape[1]), memory_mask=self.src_mask)
+
+            cache = self.transformer.decoder.init_cache()
+            steps = [self.transformer.decoder(x=self.transformer.embed_target(trg[:, i:i + 1], offset=i),
+                                              memory=memory, self_mask=None, memory_mask=self.src_mask,
+                                              cache=cache)
+                     for i in range(trg.shape[1])]
+
+        self.assertEqual(len(cache), self.params['N'])
+        self.assertEqual(cache[0]['self_attn']['keys'].shape, torch.Size([8, 4, trg.shape[1], 16]))
+        self.assertEqual(cache[0]['memory_attn']['keys'].shape, torch.Size([8, 4, self.src.shape[1], 16]))
+        self.assertTrue(torch.allclose(torch.cat(steps, dim=1), full, atol=1e-5))
+
+    def test_greedy_search_parity(self):
+        cached = self.transformer.greedy_search(self.src, self.src_mask, start_index=1, max_length=12,
+                                                use_cache=True)
+        recomputed = self.transformer.greedy_search(self.src, self.src_mask, start_index=1, max_length=12,
+                                                    use_cache=False)
+
+        self.assertEqual(cached.shape, torch.Size([8, 13]))
+        self.assertTrue(torch.equal(cached, recomputed))
+
+
+class TestBeamSearch(SmallTransformerTestCase):
+    def test_n_best(self):
+        tokens, scores = self.transformer.beam_search(self.src, self.src_mask, start_index=1, stop_index=2,
+                                                      beam_size=5, max_length=10, n_best=3)
+
+        self.assertEqual(tokens.shape[:2], torch.Size([8, 3]))
+        self.assertLessEqual(tokens.shape[2], 11)
+        self.assertTrue((tokens[:, :, 0] == 1).all())
+        self.assertEqual(scores.shape, torch.Size([8, 3]))
+
+        # hypotheses should be sorted by decreasing score
+        self.assertTrue((scores[:, :-1] >= scores[:, 1:]).all())
+
+    def test_beam_size_one_is_greedy(self):
+        """
+        With only one hypothesis per sentence, beam search should pick the same tokens as greedy search
+        (up to the first stop symbol).
+        """
+        stop_index = 2
+        tokens, _ = self.transformer.beam_search(self.src, self.src_mask, start_index=1, stop_index=stop_index,
+                                                 beam_size=1, max_length=10)
+        greedy = self.transformer.greedy_search(self.src, self.src_mask, start_index=1, max_length=10)
+
+        for beam_row, greedy_row in zip(tokens[:, 0], greedy):
+            length = beam_row.shape[0]
+            stops = (beam_row == stop_index).nonzero()
+            if len(stops) > 0:
+                length = stops[0].item() + 1
+            self.assertTrue(torch.equal(beam_row[:length], greedy_row[:length]))
+
+
+class TestGreedySearch(SmallTransformerTestCase):
+    def test_early_stopping(self):
+        """
+        Finished sentences should be padded, and the prefixes should match the predictions without early stopping.
+        """
+        pad_index = 0
+        full = self.transformer.greedy_search(self.src, self.src_mask, start_index=1, max_length=10)
+
+        # use the token predicted at the 3rd step of the first sentence as stop symbol
+        stop_index = full[0, 3].item()
+        tokens = self.transformer.greedy_search(self.src, self.src_mask, start_index=1, stop_index=stop_index,
+                                                pad_index=pad_index, max_length=10)
+
+        self.assertEqual(tokens.shape[0], 8)
+        self.assertLessEqual(tokens.shape[1], 11)
+
+        for row, full_row in zip(tokens, full):
+            stops = (row == stop_index).nonzero()
+            length = stops[0].item() + 1 if len(stops) > 0 else row.shape[0]
+            self.assertTrue(torch.equal(row[:length], full_row[:length]))
+            self.assertTrue((row[length:] == pad_index).all())
+
+    def test_length_ratio(self):
+        tokens = self.transformer.greedy_search(self.src, self.src_mask, start_index=1, pad_index=0, max_length=20,
+                                                max_length_ratio=0.5, max_length_offset=1)
+
+        # the longest sentences have 11 tokens: at most ceil(0.5 * 11) + 1 = 7 predicted tokens
+        self.assertEqual(tokens.shape, torch.Size([8, 8]))
+
+        # the first sentence only has 7 tokens: at most ceil(0.5 * 7) + 1 = 5 predicted tokens
+        self.assertTrue((tokens[0, 6:] == 0).all())
+
+
+class TestTiedEmbeddings(SmallTransformerTestCase):
+    def test_tied_embeddings(self):
+        params = dict(self.params, src_vocab_size=120, tie_embeddings=True)
+        tied = Transformer(params)
+
+        weight = tied.src_embeddings[0].embeddings.weight
+        self.assertIs(tied.trg_embeddings[0].embeddings.weight, weight)
+        self.assertIs(tied.classifier.linear1.weight, weight)
+
+        # the shared matrix is only counted once
+        n_params = sum(p.numel() for p in self.transformer.parameters())
+        n_tied_params = sum(p.numel() for p in tied.parameters())
+        self.assertEqual(n_params - n_tied_params, 100 * 64 + 120 * 64)
+
+        # still tied after loading a checkpoint
+        tied.load_state_dict(Transformer(params).state_dict())
+        self.assertIs(tied.classifier.linear1.weight, tied.trg_embeddings[0].embeddings.weight)
+
+    def test_different_vocab_sizes(self):
+        with self.assertRaises(ValueError):
+            Transformer(dict(self.params, tie_embeddings=True))
+
+
+class TestActivationCheckpointing(SmallTransformerTestCase):
+    def test_same_gradients(self):
+        """
+        Recomputing the activations of some layers during the backward pass should not change the gradients.
+        """
+        params = dict(self.params, checkpointing={'encoder': True, 'decoder': [-1]})
+        checkpointed = Transformer(params)
+        self.assertEqual(checkpointed.encoder.checkpoint_layers, {0, 1})
+        self.assertEqual(checkpointed.decoder.checkpoint_layers, {1})
+
+        checkpointed.load_state_dict(self.transformer.state_dict())
+        self.transformer.train()
+
+        trg = torch.randint(low=1, high=self.params["tgt_vocab_size"], size=(8, 9))
+        trg_mask = torch.ones_like(trg).unsqueeze(-2)
+
+        gradients = []
+        for model in (self.transformer, checkpointed):
+            # no dropout in both models
+            for module in model.modules():
+                if isinstance(module, torch.nn.Dropout):
+                    module.p = 0.
+            model(self.src, self.src_mask, trg, trg_mask).sum().backward()
+            gradients.append([p.grad for p in model.parameters()])
+
+        for grad, checkpointed_grad in zip(*gradients):
+            self.assertTrue(torch.allclose(grad, checkpointed_grad, atol=1e-5))
+
+
+class TestAdaptiveSoftmax(SmallTransformerTestCase):
+    def setUp(self):
+        super(TestAdaptiveSoftmax, self).setUp()
+
+        self.adaptive = Transformer(dict(self.params, classifier={'type': 'adaptive', 'cutoffs': [20, 60]}))
+        self.adaptive.eval()
+
+    def test_loss(self):
+        """
+        The adaptive softmax loss should be the cross-entropy of its full log-probabilities, ignoring the padding.
+        """
+        trg = torch.randint(low=1, high=self.params["tgt_vocab_size"], size=(8, 10))
+        trg[0, 6:] = 0
+        trg_mask = (trg[:, :-1] != 0).unsqueeze(-2)
+
+        with torch.no_grad():
+            decoder_output = self.adaptive(self.src, self.src_mask, trg[:, :-1], trg_mask)
+            self.assertEqual(decoder_output.shape, (8, 9, self.params['d_model']))
+
+            loss = AdaptiveSoftmaxLoss(self.adaptive.classifier, padding_token=0)(decoder_output, trg[:, 1:])
+            log_probs = self.adaptive.classifier(decoder_output)
+            expected = CrossEntropyLoss(pad_token=0)(log_probs, trg[:, 1:])
+
+        self.assertTrue(torch.allclose(log_probs.exp().sum(dim=-1), torch.ones(8, 9), atol=1e-5))
+        self.assertTrue(torch.allclose(loss, expected, atol=1e-5))
+
+    def test_decoding(self):
+        """
+        Greedy search should predict the argmax of the full log-probabilities, and beam search should run as well.
+        """
+        with torch.no_grad():
+            tokens = self.adaptive.greedy_search(self.src, self.src_mask, start_index=1, max_length=10,
+                                                 use_cache=False)
+            memory = self.adaptive.encode(self.src, self.src_mask)
+            out = self.adaptive.decoder(x=self.adaptive.embed_target(tokens[:, :-1]), memory=memory,
+                                        self_mask=None, memory_mask=self.src_mask)
+            expected = self.adaptive.classifier(out).argmax(dim=-1)
+            self.adaptive.beam_search(self.src, self.src_mask, start_index=1, stop_index=2, beam_size=3,
+                                      max_length=5)
+
+        self.assertTrue(torch.equal(tokens[:, 1:], expected))
+
+
+class DeviceRecorder(TorchDispatchMode):
+    """
+    Records the devices of all the tensors created by the operations run in its context.
+    """
+    def __init__(self):
+        super(DeviceRecorder, self).__init__()
+        self.devices = set()
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        outputs = func(*args, **(kwargs or {}))
+        self.devices.update(t.device for t in tree_flatten(outputs)[0] if isinstance(t, torch.Tensor))
+        return outputs
+
+
+class TestDeviceAgnostic(SmallTransformerTestCase):
+    def test_no_tensor_on_unexpected_device(self):
+        """
+        The forward pass & the loss of a model moved to a device (here the meta device, which allocates nothing)
+        should only create tensors on this device.
+        """
+        device = torch.device('meta')
+        model = Transformer(self.params).to(device)
+        loss_fn = LabelSmoothingLoss(size=self.params["tgt_vocab_size"], padding_token=0, smoothing=0.1)
+
+        trg = torch.randint(low=1, high=self.params["tgt_vocab_size"], size=(8, 10))
+        src, src_mask, trg = self.src.to(device), self.src_mask.to(device), trg.to(device)
+        trg_mask = (trg[:, :-1] != 0).unsqueeze(-2)
+
+        for mode in ('train', 'eval'):
+            getattr(model, mode)()
+            with DeviceRecorder() as recorder:
+                logits = model(src, src_mask, trg[:, :-1], trg_mask)
+                loss = loss_fn(logits, trg[:, 1:])
+
+            self.assertEqual(recorder.devices, {device})
+            self.assertEqual(loss.device, device)
+
+
+class TestSpeculativeSearch(SmallTransformerTestCase):
+    def test_same_as_greedy(self):
+        """
+        Speculative decoding should predict the same tokens as greedy search, whatever the draft model.
+        """
+        # a draft identical to the model accepts all its proposals
+        identical = Transformer(self.params)
+        identical.load_state_dict(self.transformer.state_dict())
+        # a smaller draft model, with a different initialization
+        small = Transformer(dict(self.params, N=1))
+
+        with torch.no_grad():
+            expected = self.transformer.greedy_search(self.src, self.src_mask, start_index=1, stop_index=2,
+                                                      max_length=12)
+
+            for draft in (identical.eval(), small.eval()):
+                statistics = {}
+                tokens = self.transformer.speculative_search(self.src, self.src_mask, draft, start_index=1,
+                                                             stop_index=2, max_length=12, n_draft_tokens=3,
+                                                             statistics=statistics)
+                self.assertTrue(torch.equal(tokens, expected))
+
+        # at most one pass of the Decoder per predicted token
+        self.assertLessEqual(statistics['accepted'], statistics['drafted'])
+        self.assertLessEqual(statistics['passes'], 12)
+
+    def test_all_accepted(self):
+        identical = Transformer(self.params)
+        identical.load_state_dict(self.transformer.state_dict())
+
+        statistics = {}
+        with torch.no_grad():
+            expected = self.transformer.greedy_search(self.src, self.src_mask, start_index=1, max_length=12)
+            tokens = self.transformer.speculative_search(self.src, self.src_mask, identical.eval(), start_index=1,
+                                                         max_length=12, n_draft_tokens=3, statistics=statistics)
+
+        self.assertTrue(torch.equal(tokens, expected))
+        # 12 tokens in 3 passes, each accepting the 3 proposals and adding the prediction following them
+        self.assertEqual(statistics, {'drafted': 8 * 3 * 3, 'accepted': 8 * 3 * 3, 'passes': 3})
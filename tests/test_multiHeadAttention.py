@@ -1,7 +1,7 @@
 from unittest import TestCase
 
 import torch
-from transformer.attention import MultiHeadAttention
+from transformer.attention import MultiHeadAttention, capture_attention_weights
 
 
 class TestMultiHeadAttention(TestCase):
@@ -23,3 +23,61 @@ class TestMultiHeadAttention(TestCase):
         self.assertEqual(output.shape, values.shape)
         # check no nan values
         self.assertEqual(torch.isnan(output).sum(), 0)
+
+    def test_fused_projections(self):
+        """
+        The fused layouts should load the weights of the separate projections, and give the same outputs.
+        """
+        batch_size, sequence_length, d_model = 16, 10, 64
+
+        x = torch.randn((batch_size, sequence_length, d_model))
+        memory = torch.randn((batch_size, sequence_length + 3, d_model))
+
+        separate = MultiHeadAttention(n_head=4, d_model=d_model, d_k=16, d_v=16)
+        fused_qkv = MultiHeadAttention(n_head=4, d_model=d_model, d_k=16, d_v=16, fused='qkv')
+        fused_kv = MultiHeadAttention(n_head=4, d_model=d_model, d_k=16, d_v=16, fused='kv')
+
+        fused_qkv.load_state_dict(separate.state_dict())
+        fused_kv.load_state_dict(separate.state_dict())
+        self.assertEqual(fused_qkv.w_qkv.weight.shape, torch.Size([3 * 64, d_model]))
+        self.assertEqual(fused_kv.w_kvs.weight.shape, torch.Size([2 * 64, d_model]))
+
+        for module in (separate, fused_qkv, fused_kv):
+            module.eval()
+
+        with torch.no_grad():
+            # self-attention
+            expected = separate(x, x, x)
+            self.assertTrue(torch.allclose(fused_qkv(x, x, x), expected, atol=1e-5))
+            self.assertTrue(torch.allclose(fused_kv(x, x, x), expected, atol=1e-5))
+
+            # memory-attention
+            expected = separate(x, memory, memory)
+            self.assertTrue(torch.allclose(fused_qkv(x, memory, memory), expected, atol=1e-5))
+            self.assertTrue(torch.allclose(fused_kv(x, memory, memory), expected, atol=1e-5))
+
+        # converting back to the separate layout should give back the original weights
+        converted = MultiHeadAttention(n_head=4, d_model=d_model, d_k=16, d_v=16)
+        converted.load_state_dict(fused_qkv.state_dict())
+        for name, param in separate.state_dict().items():
+            self.assertTrue(torch.equal(converted.state_dict()[name], param))
+
+    def test_capture_attention_weights(self):
+        x = torch.randn((4, 10, 64))
+        multi_attention = MultiHeadAttention(n_head=4, d_model=64, d_k=16, d_v=16, block_size=4)
+
+        # the weights are not kept by default
+        multi_attention(x, x, x)
+        self.assertFalse(hasattr(multi_attention.attention, 'attention_weights'))
+
+        attention_weights = {}
+        with capture_attention_weights(multi_attention, attention_weights):
+            multi_attention(x, x, x)
+
+        self.assertEqual(list(attention_weights.keys()), ['attention'])
+        self.assertEqual(attention_weights['attention'].shape, torch.Size([4, 4, 10, 10]))
+        self.assertFalse(attention_weights['attention'].requires_grad)
+        self.assertTrue(torch.allclose(attention_weights['attention'].sum(dim=-1), torch.ones((4, 4, 10))))
+
+        # the sink is removed when exiting the context manager
+        self.assertIsNone(multi_attention.attention.attention_sink)
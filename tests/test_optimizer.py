@@ -0,0 +1,32 @@
+from unittest import TestCase
+
+import torch
+import torch.nn as nn
+
+from training.optimizer import NoamOpt
+
+
+class TestNoamOpt(TestCase):
+    def test_float32_master_weights(self):
+        torch.manual_seed(0)
+        model = nn.Linear(16, 8)
+        low_precision_model = nn.Linear(16, 8).bfloat16()
+        low_precision_model.load_state_dict(model.state_dict())
+
+        # float32 parameters are optimized directly
+        self.assertEqual(NoamOpt(model, model_size=16, warmup=10).master_params, [])
+
+        optimizer = NoamOpt(low_precision_model, model_size=16, warmup=10)
+        self.assertEqual(len(optimizer.master_params), 2)
+
+        for _ in range(3):
+            optimizer.zero_grad()
+            low_precision_model(torch.randn(4, 16).bfloat16()).float().pow(2).mean().backward()
+            optimizer.step()
+
+        for p, master in optimizer.master_params:
+            self.assertEqual(master.dtype, torch.float32)
+            self.assertEqual(p.dtype, torch.bfloat16)
+            self.assertTrue(torch.equal(p, master.bfloat16()))
+            # the updates are small compared to the bfloat16 resolution: kept in the master weights only
+            self.assertFalse(torch.equal(master, master.bfloat16().float()))
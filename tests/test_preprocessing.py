@@ -0,0 +1,53 @@
+from unittest import TestCase
+
+import numpy as np
+from torchtext import data
+
+from dataset.preprocessing import ParallelPreprocessor, build_vocab, numericalize
+
+
+class TestParallelPreprocessor(TestCase):
+    def setUp(self):
+        words = ["le", "chat", "chien", "noir", "un", "blanc", "et", "the", "cat", "dog", "black", "a", "white"]
+        rng = np.random.RandomState(0)
+        self.pairs = [(' '.join(rng.choice(words, rng.randint(1, 8))), ' '.join(rng.choice(words, rng.randint(1, 8))))
+                      for _ in range(500)]
+
+    def test_tokenize(self):
+        serial = ParallelPreprocessor(str.split, str.split, max_length=5, n_workers=1, shard_size=64)
+        parallel = ParallelPreprocessor(str.split, str.split, max_length=5, n_workers=4, shard_size=64)
+
+        tokenized, source_counts, target_counts = serial.tokenize(self.pairs)
+        self.assertEqual(parallel.tokenize(self.pairs), (tokenized, source_counts, target_counts))
+
+        # filtered on the length of both sentences, in order
+        expected = [(src.split(), trg.split()) for src, trg in self.pairs
+                    if len(src.split()) <= 5 and len(trg.split()) <= 5]
+        self.assertEqual(tokenized, expected)
+        self.assertEqual(sum(source_counts.values()), sum(len(src) for src, _ in expected))
+        self.assertEqual(target_counts['cat'], sum(trg.count('cat') for _, trg in expected))
+
+    def test_build_vocab(self):
+        preprocessor = ParallelPreprocessor(str.split, str.split, max_length=5, n_workers=4, shard_size=64)
+        fields = [('src', data.Field(tokenize=str.split, pad_token="<blank>")),
+                  ('trg', data.Field(tokenize=str.split, init_token="<s>", eos_token="</s>", pad_token="<blank>"))]
+        raw = data.Dataset([data.Example.fromlist(pair, [('src', data.RawField()), ('trg', data.RawField())])
+                            for pair in self.pairs], fields)
+        dataset, _, target_counts = preprocessor.dataset(raw, fields)
+
+        target_field = fields[1][1]
+        build_vocab(target_field, target_counts, min_freq=2)
+        expected = data.Field(tokenize=str.split, init_token="<s>", eos_token="</s>", pad_token="<blank>")
+        expected.build_vocab(dataset.trg, min_freq=2)
+        self.assertEqual(target_field.vocab.itos, expected.vocab.itos)
+
+    def test_numericalize(self):
+        sentences = [pair[0].split() for pair in self.pairs]
+        stoi = {word: i for i, word in enumerate(sorted({word for sentence in sentences for word in sentence}))}
+
+        tokens, offsets = ParallelPreprocessor(str.split, str.split, n_workers=4, shard_size=64).numericalize(
+            sentences, stoi)
+        self.assertEqual((tokens.dtype, offsets.dtype), (np.int32, np.int64))
+        np.testing.assert_array_equal(tokens, numericalize(sentences, stoi)[0])
+        for i, sentence in enumerate(sentences):
+            self.assertEqual(tokens[offsets[i]:offsets[i + 1]].tolist(), [stoi[word] for word in sentence])
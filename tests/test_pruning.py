@@ -0,0 +1,57 @@
+from types import SimpleNamespace
+
+import torch
+
+from tests.test_model import SmallTransformerTestCase
+from training.loss import LabelSmoothingLoss
+from transformer.model import Transformer
+from transformer.pruning import compute_importance, combined_scores, prune_model
+
+
+class TestPruning(SmallTransformerTestCase):
+    def setUp(self):
+        super(TestPruning, self).setUp()
+
+        trg = torch.randint(low=1, high=self.params["tgt_vocab_size"], size=(8, 10))
+        self.batch = SimpleNamespace(src=self.src, src_mask=self.src_mask, trg=trg[:, :-1],
+                                     trg_mask=(trg[:, :-1] != 0).unsqueeze(-2), trg_shifted=trg[:, 1:])
+        self.loss_fn = LabelSmoothingLoss(size=self.params["tgt_vocab_size"], padding_token=0, smoothing=0.1)
+
+    def test_compute_importance(self):
+        importance = compute_importance(self.transformer, [self.batch] * 2, self.loss_fn)
+
+        # 3 attentions & 2 feed-forwards for each of the N = 2 layers
+        self.assertEqual(len(importance), 5 * 2)
+        self.assertEqual(importance['decoder.layers.1.memory_attn']['gradient'].shape, (4,))
+        self.assertEqual(importance['encoder.layers.0.feed_forward']['gradient'].shape, (128,))
+
+        entropy = importance['encoder.layers.0.self_attention']['entropy']
+        self.assertTrue(((entropy >= 0) & (entropy <= 1)).all())
+
+        # the parameters get no gradient
+        self.assertTrue(all(p.grad is None and p.requires_grad for p in self.transformer.parameters()))
+
+    def test_prune_model(self):
+        scores = combined_scores(compute_importance(self.transformer, [self.batch], self.loss_fn))
+
+        # keeping all the heads & neurons doesn't change the outputs
+        unpruned = prune_model(self.transformer, scores)
+        with torch.no_grad():
+            expected = self.transformer(self.batch.src, self.batch.src_mask, self.batch.trg, self.batch.trg_mask)
+            logits = unpruned(self.batch.src, self.batch.src_mask, self.batch.trg, self.batch.trg_mask)
+        self.assertTrue(torch.allclose(logits, expected, atol=1e-5))
+
+        pruned = prune_model(self.transformer, scores, head_ratio=0.5, neuron_ratio=0.25)
+        self.assertEqual(pruned._params['attention']['n_heads'],
+                         {'encoder.self_attention': [2, 2], 'decoder.self_attn': [2, 2], 'decoder.memory_attn': [2, 2]})
+        self.assertEqual(pruned._params['feed-forward']['d_ffs'],
+                         {'encoder.feed_forward': [96, 96], 'decoder.feed_forward': [96, 96]})
+        self.assertEqual(pruned.decoder.layers[0].self_attn.w_qs.weight.shape, (2 * 16, 64))
+        self.assertEqual(pruned.encoder.layers[1].feed_forward.linear_2.weight.shape, (64, 96))
+
+        # the original model is left untouched
+        self.assertEqual(self.transformer.encoder.layers[0].self_attention.n_head, 4)
+
+        # a model with the same sizes is created from the params (e.g. to load a checkpoint)
+        loaded = Transformer(pruned._params)
+        loaded.load_state_dict(pruned.state_dict())
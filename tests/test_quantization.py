@@ -0,0 +1,34 @@
+import os
+import tempfile
+
+import torch
+import torch.nn as nn
+import torch.ao.nn.quantized.dynamic as nnqd
+
+from tests.test_model import SmallTransformerTestCase
+from transformer.quantization import quantize_model, quantizable_layers, save_quantized, load_quantized
+
+
+class TestQuantization(SmallTransformerTestCase):
+    def test_quantize_model(self):
+        quantized = quantize_model(self.transformer)
+
+        # the float model is left untouched
+        self.assertTrue(all(isinstance(self.transformer.get_submodule(name), nn.Linear)
+                            for name in quantizable_layers(self.transformer)))
+        # 4 layers per attention & 2 per feed-forward in each of the N = 2 encoder / decoder layers, and the classifier
+        self.assertEqual(len(quantizable_layers(quantized)), (4 + 2) * 2 + (4 + 4 + 2) * 2 + 1)
+        for name in quantizable_layers(quantized):
+            self.assertIsInstance(quantized.get_submodule(name), nnqd.Linear)
+
+        expected = self.transformer.greedy_search(self.src, self.src_mask, start_index=1, max_length=10)
+        tokens = quantized.greedy_search(self.src, self.src_mask, start_index=1, max_length=10)
+        self.assertEqual(tokens.shape, expected.shape)
+
+        # same results after saving & loading the quantized model
+        with tempfile.TemporaryDirectory() as directory:
+            filename = save_quantized(quantized, os.path.join(directory, 'quantized.pt'))
+            loaded = load_quantized(filename)
+
+        self.assertTrue(torch.equal(loaded.greedy_search(self.src, self.src_mask, start_index=1, max_length=10),
+                                    tokens))
@@ -22,3 +22,56 @@ class TestScaledDotProductAttention(TestCase):
         self.assertEqual(output.shape, values.shape)
         # check no nan values
         self.assertEqual(torch.isnan(output).sum(), 0)
+
+    def test_chunked_attention(self):
+        """
+        Computing the attention by blocks should give the same outputs & gradients as the full computation.
+        """
+        batch_size, n_head, sequence_length, d_k = 4, 2, 10, 8
+
+        queries = torch.randn((batch_size, n_head, sequence_length, d_k), requires_grad=True)
+        keys = torch.randn((batch_size, n_head, sequence_length + 3, d_k), requires_grad=True)
+        values = torch.randn((batch_size, n_head, sequence_length + 3, d_k), requires_grad=True)
+
+        # hide the padding of the first sample & the future positions
+        mask = torch.ones((batch_size, 1, sequence_length, sequence_length + 3), dtype=torch.bool)
+        mask[0, :, :, 6:] = 0
+        mask = mask & torch.ones((sequence_length, sequence_length + 3), dtype=torch.bool).tril(3)
+
+        full = ScaledDotProductAttention(attn_dropout=0.)
+        chunked = ScaledDotProductAttention(attn_dropout=0., block_size=3)
+
+        for m in (None, mask):
+            expected = full(queries, keys, values, mask=m)
+            expected_grads = torch.autograd.grad(expected.sum(), (queries, keys, values))
+
+            output = chunked(queries, keys, values, mask=m)
+            grads = torch.autograd.grad(output.sum(), (queries, keys, values))
+
+            self.assertTrue(torch.allclose(output, expected, atol=1e-5))
+            for grad, expected_grad in zip(grads, expected_grads):
+                self.assertTrue(torch.allclose(grad, expected_grad, atol=1e-5))
+
+    def test_causal(self):
+        """
+        Hiding the subsequent positions with ``causal`` should be equivalent to passing them in the mask, both for the
+        full & the chunked computations.
+        """
+        batch_size, n_head, sequence_length, d_k = 4, 2, 10, 8
+
+        queries = torch.randn((batch_size, n_head, sequence_length, d_k))
+        keys = torch.randn((batch_size, n_head, sequence_length + 3, d_k))
+        values = torch.randn((batch_size, n_head, sequence_length + 3, d_k))
+
+        padding_mask = torch.ones((batch_size, 1, 1, sequence_length + 3), dtype=torch.bool)
+        padding_mask[0, ..., 6:] = 0
+        # the queries are the last positions of the keys sequence
+        mask = padding_mask & torch.ones((sequence_length, sequence_length + 3), dtype=torch.bool).tril(3)
+
+        expected = ScaledDotProductAttention(attn_dropout=0.)(queries, keys, values, mask=mask)
+
+        for block_size in (None, 3):
+            causal = ScaledDotProductAttention(attn_dropout=0., block_size=block_size, causal=True)
+            output = causal(queries, keys, values, mask=padding_mask)
+
+            self.assertTrue(torch.allclose(output, expected, atol=1e-5))
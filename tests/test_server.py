@@ -0,0 +1,86 @@
+import asyncio
+import json
+import tempfile
+
+from unittest import TestCase
+
+from serving.server import DynamicBatcher, Histogram, TranslationServer, Translator
+from tests.test_model import SmallTransformerTestCase
+
+
+class TestHistogram(TestCase):
+    def test_observe(self):
+        histogram = Histogram([1, 10])
+        for value in (0.5, 1, 3, 20):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.to_dict(), {'buckets': [{'le': 1, 'count': 2}, {'le': 10, 'count': 3},
+                                                           {'le': '+Inf', 'count': 4}],
+                                               'count': 4, 'sum': 24.5})
+
+
+class TestTranslationServer(SmallTransformerTestCase):
+    def setUp(self):
+        super(TestTranslationServer, self).setUp()
+
+        specials = ['<unk>', '<blank>', '<s>', '</s>']
+        self.transformer.vocabs = {'src': specials + [f"s{i}" for i in range(self.params['src_vocab_size'] - 4)],
+                                   'trg': specials + [f"t{i}" for i in range(self.params['tgt_vocab_size'] - 4)]}
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = self.transformer.save(directory, epoch_idx=0, loss_value=0.)
+            self.translator = Translator.from_checkpoint(filename, max_length=10)
+
+        self.sentences = [[f"s{i}" for i in range(length)] + ["unknown"] for length in (3, 4, 4, 3, 4, 9)]
+
+    def test_dynamic_batching(self):
+        """
+        The sentences should be batched by length, and translated as if one by one.
+        """
+        batcher = DynamicBatcher(self.translator, max_batch_size=4, max_delay=0.05, bucket_width=8)
+
+        async def translate_all():
+            return await asyncio.gather(*(batcher.submit(tokens) for tokens in self.sentences))
+
+        translations = asyncio.run(translate_all())
+        batcher.close()
+
+        self.assertEqual(translations, [self.translator([tokens])[0] for tokens in self.sentences])
+        # sentences of 4 & 5 tokens are batched together (4 at once, then 1 after the delay), the one of 10 alone
+        self.assertEqual(batcher.batch_size.counts[:4], [2, 0, 1, 0])
+        self.assertEqual(batcher.latency.count, 6)
+
+    def test_http(self):
+        batcher = DynamicBatcher(self.translator, max_batch_size=8, max_delay=0.01)
+        server = TranslationServer(batcher, tokenizer=str.split)
+
+        async def request(port: int, method: str, path: str, body: dict = None):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            payload = json.dumps(body).encode() if body is not None else b''
+            writer.write(f"{method} {path} HTTP/1.1\r\nContent-Length: {len(payload)}\r\n\r\n".encode() + payload)
+            response = await reader.read()
+            writer.close()
+            status_line, _, content = response.decode().partition('\r\n\r\n')
+            return int(status_line.split(' ')[1]), json.loads(content)
+
+        async def run():
+            listening = await server.start(port=0)
+            port = listening.sockets[0].getsockname()[1]
+            responses = await asyncio.gather(
+                request(port, 'POST', '/translate', {'texts': [' '.join(tokens) for tokens in self.sentences]}),
+                request(port, 'POST', '/translate', {'tokens': self.sentences[0]}),
+                request(port, 'POST', '/translate', {'texts': ['']}),
+                request(port, 'GET', '/nothing'))
+            metrics = await request(port, 'GET', '/metrics')
+            listening.close()
+            await listening.wait_closed()
+            return responses, metrics
+
+        responses, (status, metrics) = asyncio.run(run())
+        batcher.close()
+
+        expected = [self.translator([tokens])[0] for tokens in self.sentences]
+        self.assertEqual(responses[0], (200, {'translations': expected}))
+        self.assertEqual(responses[1], (200, {'translations': expected[:1]}))
+        self.assertEqual([response[0] for response in responses[2:]], [400, 404])
+        self.assertEqual(metrics['latency_seconds']['count'], 7)
@@ -0,0 +1,40 @@
+import torch
+
+from tests.test_model import SmallTransformerTestCase
+from transformer.shortlist import Shortlist
+
+
+class TestShortlist(SmallTransformerTestCase):
+    def test_build(self):
+        # source token i is always translated by target token i + 10, target token 1 is in every sentence: it is one of
+        # the frequent tokens, so it is not a translation of 3 (even if its Dice score is also 1)
+        pairs = [([1, 2, 3], [1, 11, 12, 13]), ([2, 3], [1, 12, 13]), ([3, 4], [1, 13, 14])]
+        shortlist = Shortlist.build(pairs, src_vocab_size=5, trg_vocab_size=20, n_translations=1, n_frequent=1,
+                                    chunk_size=2)
+
+        self.assertEqual(shortlist.translations.squeeze(1).tolist(), [-1, 11, 12, 13, 14])
+        self.assertEqual(shortlist.frequent.tolist(), [1])
+
+        candidates = shortlist.candidates(torch.tensor([[2, 4], [0, 0]]), required=[2])
+        self.assertEqual(candidates.tolist(), [1, 2, 12, 14])
+
+    def test_greedy_search(self):
+        vocab_size = self.params["tgt_vocab_size"]
+
+        # all the tokens are candidates: same predictions as without shortlist
+        shortlist = Shortlist(translations=torch.full((self.params["src_vocab_size"], 1), -1, dtype=torch.long),
+                              frequent=torch.arange(vocab_size))
+        with torch.no_grad():
+            expected = self.transformer.greedy_search(self.src, self.src_mask, start_index=1, stop_index=2,
+                                                      max_length=10)
+            tokens = self.transformer.greedy_search(self.src, self.src_mask, start_index=1, stop_index=2,
+                                                    max_length=10, shortlist=shortlist)
+        self.assertTrue(torch.equal(tokens, expected))
+
+        # only the candidates (and the stop token) can be predicted
+        shortlist = Shortlist(translations=torch.full((self.params["src_vocab_size"], 1), 7, dtype=torch.long),
+                              frequent=torch.tensor([5, 6]))
+        with torch.no_grad():
+            tokens = self.transformer.greedy_search(self.src, self.src_mask, start_index=1, stop_index=2,
+                                                    max_length=10, shortlist=shortlist)
+        self.assertTrue(all(token in (2, 5, 6, 7) for token in tokens[:, 1:].flatten().tolist()))
@@ -0,0 +1,81 @@
+import pickle
+from difflib import SequenceMatcher
+from os import getenv
+from unittest import TestCase, skipIf
+
+from torchtext import data, datasets
+
+from dataset.iwslt import ROOT_DATASET_DIR
+from dataset.language_pairs import LanguagePair
+from dataset.utils import RegexTokenizer
+
+
+class TestRegexTokenizer(TestCase):
+    def test_english(self):
+        tokenizer = RegexTokenizer('english')
+        # outputs of nltk.word_tokenize
+        cases = {
+            "Hello, world! I don't think it's 3,5 or 10:30.":
+                ['Hello', ',', 'world', '!', 'I', 'do', "n't", 'think', 'it', "'s", '3,5', 'or', '10:30', '.'],
+            'He said "hello." Then he left.':
+                ['He', 'said', '``', 'hello', '.', "''", 'Then', 'he', 'left', '.'],
+            "The students' books (cannot) -- gonna be...":
+                ['The', 'students', "'", 'books', '(', 'can', 'not', ')', '--', 'gon', 'na', 'be', '...'],
+            "I'm here; you're there & we'll see what $5 costs?":
+                ['I', "'m", 'here', ';', 'you', "'re", 'there', '&', 'we', "'ll", 'see', 'what', '$', '5', 'costs',
+                 '?'],
+            "Mr. Smith went to Washington. It was 1990.":
+                ['Mr.', 'Smith', 'went', 'to', 'Washington', '.', 'It', 'was', '1990', '.'],
+        }
+        for text, tokens in cases.items():
+            self.assertEqual(tokenizer(text), tokens)
+
+    def test_french(self):
+        tokenizer = RegexTokenizer('french')
+        cases = {
+            "M. Dupont a dit : « C'est l'homme qu'il faut », aujourd'hui.":
+                ['M.', 'Dupont', 'a', 'dit', ':', '«', "C'est", "l'homme", "qu'il", 'faut', '»', ',', "aujourd'hui",
+                 '.'],
+            "Il y a 2,5 millions d'habitants. En 2010, c'était différent.":
+                ['Il', 'y', 'a', '2,5', 'millions', "d'habitants", '.', 'En', '2010', ',', "c'était", 'différent',
+                 '.'],
+            "Peut-être… Non !": ['Peut-être…', 'Non', '!'],
+        }
+        for text, tokens in cases.items():
+            self.assertEqual(tokenizer(text), tokens)
+
+    def test_memoization(self):
+        tokenizer = RegexTokenizer('english', cache_size=2)
+        tokens = tokenizer("Hello world.")
+        # the memoized tokens are not altered through the returned lists
+        tokens.append('!')
+        self.assertEqual(tokenizer("Hello world."), ['Hello', 'world', '.'])
+        self.assertEqual(tokenizer.cached_tokenize.cache_info().hits, 1)
+
+        # picklable, e.g. for the workers of the ParallelPreprocessor
+        copy = pickle.loads(pickle.dumps(tokenizer))
+        self.assertEqual(copy("Hello world."), ['Hello', 'world', '.'])
+        self.assertEqual(copy.name, tokenizer.name)
+
+    @skipIf(len(getenv("CI", "")) > 0, "skipping slow tests on CI")
+    def test_conformance(self):
+        """
+        Token-level agreement with nltk.word_tokenize on the IWSLT validation set.
+        """
+        raw_field = data.RawField()
+        _, validation, *_ = datasets.IWSLT.splits(root=ROOT_DATASET_DIR, exts=LanguagePair.fr_en.extensions(),
+                                                  fields=(raw_field, raw_field), test=None)
+
+        tokenizers = zip(LanguagePair.fr_en.tokenizer(), LanguagePair.fr_en.tokenizer(use_nltk=True))
+        for side, (tokenizer, reference) in zip(('src', 'trg'), tokenizers):
+            n_tokens, n_matching, n_identical = 0, 0, 0
+            for example in validation.examples:
+                text = getattr(example, side)
+                tokens, expected = tokenizer(text), reference(text)
+                n_tokens += len(expected)
+                n_matching += sum(block.size for block in
+                                  SequenceMatcher(a=tokens, b=expected, autojunk=False).get_matching_blocks())
+                n_identical += tokens == expected
+
+            self.assertGreater(n_matching / n_tokens, 0.995, msg=reference.language)
+            self.assertGreater(n_identical / len(validation.examples), 0.97, msg=reference.language)
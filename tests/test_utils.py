@@ -0,0 +1,37 @@
+from collections import defaultdict
+from types import SimpleNamespace
+from unittest import TestCase
+
+import torch
+
+from transformer.utils import detokenize, subsequent_mask
+
+
+class TestDetokenize(TestCase):
+    def test_detokenize(self):
+        itos = ['<unk>', '<blank>', '<s>', '</s>', 'hello', 'world', '!']
+        vocab = SimpleNamespace(itos=itos, stoi=defaultdict(int, {s: i for i, s in enumerate(itos)}))
+
+        tokens = torch.tensor([[2, 4, 5, 6, 3, 1, 1],
+                               [2, 5, 3, 4, 4, 4, 4],
+                               [2, 4, 4, 4, 4, 4, 4]])
+
+        sentences = detokenize(tokens, vocab, stop_symbol='</s>', ignored_symbols=('<s>', '<blank>'))
+
+        self.assertEqual(sentences, ['hello world !', 'world', 'hello hello hello hello hello hello'])
+
+
+class TestSubsequentMask(TestCase):
+    def test_subsequent_mask(self):
+        mask = subsequent_mask(5)
+
+        self.assertEqual(mask.shape, (1, 5, 5))
+        self.assertEqual(mask.dtype, torch.bool)
+        self.assertTrue(torch.equal(mask[0], torch.ones((5, 5), dtype=torch.bool).tril()))
+
+        # the mask is only built once & sliced afterwards
+        self.assertEqual(subsequent_mask(3).data_ptr(), mask.data_ptr())
+        self.assertTrue(torch.equal(subsequent_mask(3)[0], mask[0, :3, :3]))
+
+        # longer sequences than the cached mask
+        self.assertTrue(torch.equal(subsequent_mask(300)[0], torch.ones((300, 300), dtype=torch.bool).tril()))
@@ -3,6 +3,7 @@ import logging
 import logging.config
 import os
 import random
+import resource
 from datetime import datetime
 from os.path import join
 
@@ -12,10 +13,12 @@ from google.cloud import storage
 from dataset.iwslt import IWSLTDatasetBuilder
 from dataset.language_pairs import LanguagePair
 from dataset.utils import Split
-from training.loss import LabelSmoothingLoss, CrossEntropyLoss
+from training.distillation import TeacherCache, DistillationLoss
+from training.loss import AdaptiveSoftmaxLoss, LabelSmoothingLoss, CrossEntropyLoss
 from training.optimizer import NoamOpt
 from training.statistics_collector import StatisticsCollector
 from transformer.model import Transformer
+from transformer.utils import detokenize
 
 HYPERTUNER = None
 
@@ -46,6 +49,12 @@ class Trainer(object):
                               numpy_seed=params["settings"]["numpy_seed"],
                               random_seed=params["settings"]["random_seed"])
 
+        # numerical precision of the forward & backward passes: 'fp32' or 'bf16' (autocast, with float32 weights)
+        self.precision = params["training"].get("precision", "fp32")
+        if self.precision not in ("fp32", "bf16"):
+            raise ValueError(f"Unknown precision: {self.precision}, expected 'fp32' or 'bf16'.")
+        self.logger.info(f"Training with {self.precision} precision.")
+
         # Initialize TensorBoard and statistics collection.
         self.initialize_statistics_collection()
 
@@ -74,6 +83,11 @@ class Trainer(object):
                 blank_token=params["dataset"]["pad_token"],
                 batch_size_train=params["training"]["train_batch_size"],
                 batch_size_validation=params["training"]["valid_batch_size"],
+                shared_vocab=params["dataset"].get("shared_vocab", False),
+                max_tokens=params["training"].get("max_tokens"),
+                cache=params["dataset"].get("cache", False),
+                # to resume the training of a model tokenized with NLTK (checkpoints without vocabularies)
+                use_nltk=params["dataset"].get("use_nltk", False),
             )
         )
 
@@ -101,6 +115,8 @@ class Trainer(object):
 
         # can now instantiate model
         self.model = Transformer(params["model"])  # type: Transformer
+        # saved in the checkpoints, to translate raw text with them (see serve.py)
+        self.model.vocabs = {'src': list(self.src_vocab.itos), 'trg': list(self.trg_vocab.itos)}
 
         if params["training"].get("multi_gpu", False):
             self.model = torch.nn.DataParallel(self.model)
@@ -126,7 +142,14 @@ class Trainer(object):
         self.save_intermediate = params["training"].get("save_intermediate", False)
 
         # instantiate loss
-        if "smoothing" in params["training"]:
+        model = self.model.module if self.multi_gpu else self.model
+        if model.adaptive_softmax:
+            # the model returns the decoder outputs, which the loss feeds to the adaptive softmax classifier
+            self.loss_fn = AdaptiveSoftmaxLoss(model.classifier, padding_token=self.trg_padding)
+            self.logger.info(f"Using AdaptiveSoftmaxLoss, with cutoffs {params['model']['classifier']['cutoffs']}.")
+            if params["training"].get("smoothing"):
+                self.logger.warning("Label smoothing is not supported with the adaptive softmax, ignoring it.")
+        elif "smoothing" in params["training"]:
             self.loss_fn = LabelSmoothingLoss(size=self.trg_vocab_size,
                                               padding_token=self.src_padding,
                                               smoothing=params["training"]["smoothing"])
@@ -136,6 +159,13 @@ class Trainer(object):
             self.loss_fn = CrossEntropyLoss(pad_token=self.src_padding)
             self.logger.info("Using CrossEntropyLoss.")
 
+        # distillation: the model (student) also learns from the outputs of a trained (teacher) model
+        self.teacher, self.teacher_cache = None, None
+        if params.get("distillation") is not None:
+            if model.adaptive_softmax:
+                raise ValueError("Distillation requires the dense classifier, got the adaptive softmax.")
+            self.initialize_distillation(params["distillation"])
+
         # instantiate optimizer
         self.optimizer = NoamOpt(model=self.model,
                                  model_size=params["model"]["d_model"],
@@ -176,6 +206,9 @@ class Trainer(object):
             # ensure train mode for the model
             self.model.train()
 
+            # padding of the training batches over the epoch
+            n_padding, n_positions = 0, 0
+
             for i, batch in enumerate(
                 IWSLTDatasetBuilder.masked(
                     IWSLTDatasetBuilder.transposed(
@@ -188,15 +221,22 @@ class Trainer(object):
                 # 1. reset all gradients
                 self.optimizer.zero_grad()
 
+                # measure the peak memory of each step separately
+                self.reset_peak_memory()
+
                 # Convert batch to CUDA.
                 if torch.cuda.is_available():
                     batch.cuda()
 
-                # 2. Perform forward pass.
-                logits = self.model(batch.src, batch.src_mask, batch.trg, batch.trg_mask)
+                with self.autocast():
+                    # 2. Perform forward pass.
+                    logits = self.model(batch.src, batch.src_mask, batch.trg, batch.trg_mask)
 
-                # 3. Evaluate loss function.
-                loss = self.loss_fn(logits, batch.trg_shifted)
+                    # 3. Evaluate loss function.
+                    if self.teacher is None:
+                        loss = self.loss_fn(logits, batch.trg_shifted)
+                    else:
+                        loss = self.distillation_loss(logits, batch.trg_shifted, *self.teacher_outputs(batch))
 
                 # 4. Backward gradient flow.
                 loss.backward()
@@ -206,6 +246,10 @@ class Trainer(object):
                 self.training_stat_col['loss'] = loss.item()
                 self.training_stat_col['episode'] = episode
                 self.training_stat_col['src_seq_length'] = batch.src.shape[1]
+                self.training_stat_col['peak_memory'] = self.peak_memory()
+                self.training_stat_col['batch_size'] = batch.batch_size
+                self.training_stat_col['padding_ratio'] = batch.padding_ratio
+                n_padding, n_positions = n_padding + batch.n_padding, n_positions + batch.n_positions
                 self.training_stat_col.export_to_csv()
 
                 # 4.2. Exports statistics to the logger.
@@ -217,6 +261,13 @@ class Trainer(object):
                 # 5. Perform optimization step.
                 self.optimizer.step()
 
+            self.logger.info(f"Padding ratio of the training batches over epoch {epoch + 1}: "
+                             f"{n_padding / max(n_positions, 1):.2%}")
+
+            if self.teacher_cache is not None:
+                self.teacher_cache.flush()
+                self.logger.info(f"{len(self.teacher_cache)} sentences in the teacher cache.")
+
             # save model at end of each epoch if indicated:
             if self.save_intermediate:
                 if self.multi_gpu:
@@ -228,6 +279,7 @@ class Trainer(object):
             # validate the model on the validation set
             self.model.eval()
             val_loss = 0.
+            val_loss_fp32 = 0.
 
             with torch.no_grad():
                 for i, batch in enumerate(
@@ -240,17 +292,25 @@ class Trainer(object):
                     if torch.cuda.is_available():
                         batch.cuda()
 
-                    # 1. Perform forward pass.
-                    logits = self.model(batch.src, batch.src_mask, batch.trg, batch.trg_mask)
+                    with self.autocast():
+                        # 1. Perform forward pass.
+                        logits = self.model(batch.src, batch.src_mask, batch.trg, batch.trg_mask)
 
-                    # 2. Evaluate loss function.
-                    loss = self.loss_fn(logits, batch.trg_shifted)
+                        # 2. Evaluate loss function.
+                        loss = self.loss_fn(logits, batch.trg_shifted)
 
                     # Accumulate loss
                     val_loss += loss.item()
 
+                    # 2.1 Also evaluate the loss in full precision, to compare both loss curves
+                    if self.precision != "fp32":
+                        logits = self.model(batch.src, batch.src_mask, batch.trg, batch.trg_mask)
+                        val_loss_fp32 += self.loss_fn(logits, batch.trg_shifted).item()
+
             # 3.1 Collect loss, episode: Log only one point per validation (for now)
             self.validation_stat_col['loss'] = val_loss / (i + 1)
+            if self.precision != "fp32":
+                self.validation_stat_col['loss_fp32'] = val_loss_fp32 / (i + 1)
             self.validation_stat_col['episode'] = episode
 
             # 3.1. Export to csv.
@@ -294,6 +354,104 @@ class Trainer(object):
 
         return val_loss
 
+    def initialize_distillation(self, params: dict) -> None:
+        """
+        Sets up the distillation of a trained (teacher) model into the model being trained (student), with:
+
+            - ``params['teacher_checkpoint']``: Checkpoint of the teacher, loaded with
+              ``Transformer.load_model_from_file``. It should use the same vocabularies as the student.
+            - ``params['alpha']``: Weight of the distillation loss vs. the loss on the ground truth. Default: 0.5.
+            - ``params['temperature']``: Softmax temperature of the distillation loss. Default: 1.
+            - ``params['top_k']``: Number of teacher logits kept per position. Default: 8.
+            - ``params['cache_dir']``: Directory of the teacher outputs cache (see :py:class:`TeacherCache`), so that
+              the teacher is only run during the first epoch. Default: ``teacher_cache`` in the log directory.
+
+        """
+        self.teacher = Transformer.load_model_from_file(params["teacher_checkpoint"], logger=self.logger)
+        if self.teacher._params["tgt_vocab_size"] != self.trg_vocab_size:
+            raise ValueError(f"The teacher vocabulary ({self.teacher._params['tgt_vocab_size']} tokens) does not "
+                             f"match the student one ({self.trg_vocab_size} tokens).")
+
+        self.teacher.eval()
+        for p in self.teacher.parameters():
+            p.requires_grad_(False)
+        if torch.cuda.is_available():
+            self.teacher = self.teacher.cuda()
+
+        self.teacher_cache = TeacherCache(params.get("cache_dir", join(self.log_dir, "teacher_cache")),
+                                          k=params.get("top_k", 8))
+        self.distillation_loss = DistillationLoss(self.loss_fn, padding_token=self.trg_padding,
+                                                  alpha=params.get("alpha", 0.5),
+                                                  temperature=params.get("temperature", 1.0))
+        self.logger.info(f"Distilling the teacher model from {params['teacher_checkpoint']}, "
+                         f"with {len(self.teacher_cache)} sentences already in the teacher cache.")
+
+    def teacher_outputs(self, batch):
+        """
+        Returns the top-k logits of the teacher for ``batch`` (and their indices), from the teacher cache when
+        possible, otherwise by running the teacher.
+        """
+        outputs = self.teacher_cache.lookup(batch, self.trg_padding)
+        if outputs is None:
+            with torch.no_grad():
+                logits = self.teacher(batch.src, batch.src_mask, batch.trg, batch.trg_mask)
+            outputs = self.teacher_cache.store(batch, logits, self.trg_padding)
+
+        return outputs
+
+    @staticmethod
+    def reset_peak_memory() -> None:
+        """
+        Resets the peak memory statistics read by :py:func:`peak_memory`, at the beginning of a training step.
+        """
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+            return
+
+        try:
+            # resets the peak resident set size (VmHWM) of the process, on Linux
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            pass  # not supported: peak_memory falls back to the peak since the start of the process
+
+    @staticmethod
+    def peak_memory() -> float:
+        """
+        Returns the peak memory use (in MB) since the last :py:func:`reset_peak_memory`, i.e. of the current training
+        step, e.g. to assess the effect of the activation checkpointing:
+
+            - On GPU, the maximum memory allocated by tensors,
+            - On CPU, the maximum resident set size of the process (which also includes the model, optimizer state,
+              dataset...). Where it can't be reset (outside of Linux), this is the maximum since the start of the
+              process, which never decreases: the steps, or runs with & without checkpointing, then have to be
+              compared in separate processes.
+        """
+        if torch.cuda.is_available():
+            return torch.cuda.max_memory_allocated() / 2 ** 20
+
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        # in kilobytes
+                        return int(line.split()[1]) / 2 ** 10
+        except OSError:
+            pass
+
+        # in kilobytes on Linux, bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+    def autocast(self) -> torch.autocast:
+        """
+        Returns the autocast context in which to run the forward pass & loss computation, according to the
+        training precision. The model weights (& optimizer state) stay in float32.
+
+        The backward pass should be run outside of this context: it uses the same precision as the forward pass.
+        """
+        device_type = "cuda" if torch.cuda.is_available() else "cpu"
+        return torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=self.precision == "bf16")
+
     def configure_logging(self, training_problem_name: str, logger_config=None) -> None:
         """
         Takes care of the initialization of logging-related objects:
@@ -395,6 +553,9 @@ class Trainer(object):
         self.training_stat_col.add_statistic('loss', '{:12.10f}')
         self.training_stat_col.add_statistic('episode', '{:06d}')
         self.training_stat_col.add_statistic('src_seq_length', '{:02d}')
+        self.training_stat_col.add_statistic('peak_memory', '{:.1f}')
+        self.training_stat_col.add_statistic('batch_size', '{:04d}')
+        self.training_stat_col.add_statistic('padding_ratio', '{:.4f}')
 
         # Create the csv file to store the training statistics.
         self.training_batch_stats_file = self.training_stat_col.initialize_csv_file(
@@ -408,6 +569,8 @@ class Trainer(object):
         # add default statistics
         self.validation_stat_col.add_statistic('epoch', '{:02d}')
         self.validation_stat_col.add_statistic('loss', '{:12.10f}')
+        if self.precision != "fp32":
+            self.validation_stat_col.add_statistic('loss_fp32', '{:12.10f}')
         self.validation_stat_col.add_statistic('episode', '{:06d}')
 
         # Create the csv file to store the validation statistics.
@@ -513,7 +676,9 @@ if __name__ == '__main__':
             "epochs": 3,
             "train_batch_size": 1024,
             "valid_batch_size": 1024,
+            "max_tokens": None,  # e.g. 25000: token budget of the batches, in place of the batch sizes
             "smoothing": 0.1,
+            "precision": "fp32",
             "load_trained_model": False,
             "trained_model_checkpoint": ""
         },
@@ -541,7 +706,8 @@ if __name__ == '__main__':
             "min_freq": 2,
             "start_token": "<s>",
             "eos_token": "</s>",
-            "pad_token": "<blank>"
+            "pad_token": "<blank>",
+            "cache": True  # reuse the preprocessed dataset of the previous runs, see DatasetCache
 
         },
 
@@ -550,6 +716,12 @@ if __name__ == '__main__':
             'N': 6,
             'dropout': 0.1,
 
+            'checkpointing': {
+                'encoder': False,
+                'decoder': False},
+
+            'classifier': {'type': 'dense'},
+
             'attention': {
                 'n_head': 8,
                 'd_k': 64,
@@ -572,20 +744,19 @@ if __name__ == '__main__':
     if torch.cuda.is_available():
         batch.cuda()
 
-    if trainer.multi_gpu:
-        prediction = trainer.model.module.greedy_decode(batch.src[0].unsqueeze(0),
-                                                        batch.src_mask[0], trainer.trg_vocab,
-                                                        start_symbol="<s>", stop_symbol="</s>",
-                                                        max_length=15)
-    else:
-        prediction = trainer.model.greedy_decode(batch.src[0].unsqueeze(0), batch.src_mask[0],
-                                                 trainer.trg_vocab, start_symbol="<s>",
-                                                 stop_symbol="</s>",
-                                                 max_length=params["dataset"]["max_seq_length"])
-
-    target, target_sentence = "", batch.trg[0]
-    for i in target_sentence:
-        target += trainer.trg_vocab.itos[i] + " "
-
-    print("Trying to predict: {}".format(target))
-    print("Got: {}".format(prediction))
+    model = trainer.model.module if trainer.multi_gpu else trainer.model
+    model.eval()
+
+    # decode the whole batch at once, in the training precision
+    with trainer.autocast():
+        predictions, scores = model.beam_search(batch.src, batch.src_mask,
+                                                start_index=trainer.trg_vocab.stoi["<s>"],
+                                                stop_index=trainer.trg_vocab.stoi["</s>"],
+                                                beam_size=4,
+                                                max_length=params["dataset"]["max_seq_length"])
+
+    targets = detokenize(batch.trg, trainer.trg_vocab)
+    translations = detokenize(predictions[:, 0], trainer.trg_vocab)
+
+    print("Trying to predict: {}".format(targets[0]))
+    print("Got: {} (score: {:.4f})".format(translations[0], scores[0, 0].item()))
@@ -0,0 +1,206 @@
+import hashlib
+import os
+from os.path import exists, getsize, join
+from typing import Optional, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch import Tensor
+
+
+class TeacherCache(object):
+    """
+    Disk cache of the outputs of a teacher model, so that its forward pass is only computed once per training sentence
+    (e.g. during the first epoch of a distillation).
+
+    Only the ``k`` largest logits of each target position are kept (in a compact format: float16 values & int32
+    indices), in two flat binary files read through memory maps. The position of the logits of each sentence in these
+    files is indexed by a hash of its source & target tokens, so that the cache does not depend on the order of the
+    batches (which are shuffled at each epoch).
+    """
+
+    def __init__(self, directory: str, k=8):
+        """
+        Constructor of the :py:class:`TeacherCache` class. Reuses the cache found in ``directory``, if any.
+
+        :param directory: Directory in which to store the cache.
+
+        :param k: Number of logits to keep per target position.
+        """
+        os.makedirs(directory, exist_ok=True)
+
+        self.k = k
+        self.values_file = join(directory, 'values.bin')
+        self.indices_file = join(directory, 'indices.bin')
+        self.index_file = join(directory, 'index.pt')
+
+        # sentence key -> (offset, length), in number of target positions
+        self.index = {}
+        if exists(self.index_file):
+            saved = torch.load(self.index_file)
+            if saved['k'] != k:
+                raise ValueError(f"The teacher cache in {directory} was created with k={saved['k']}, not k={k}.")
+            self.index = saved['index']
+
+        # number of positions in the files (possibly more than indexed, if the index was not flushed)
+        self.n_positions = getsize(self.values_file) // (2 * k) if exists(self.values_file) else 0
+
+        # memory maps on the files, (re)opened when needed
+        self._values, self._indices = None, None
+
+    @staticmethod
+    def sentence_key(src: Tensor, trg: Tensor) -> bytes:
+        """
+        Returns the key of a sentence, from its source & target tokens (without padding).
+        """
+        hashed = hashlib.sha1(src.cpu().numpy().astype(np.int32).tobytes())
+        hashed.update(b'|')
+        hashed.update(trg.cpu().numpy().astype(np.int32).tobytes())
+        return hashed.digest()
+
+    def batch_keys(self, batch, padding_token: int):
+        """
+        Returns the keys of the sentences of ``batch``, and their target lengths.
+        """
+        keys, lengths = [], []
+        for src, trg, trg_shifted in zip(batch.src, batch.trg, batch.trg_shifted):
+            keys.append(self.sentence_key(src[src != padding_token], trg_shifted[trg_shifted != padding_token]))
+            lengths.append(int((trg_shifted != padding_token).sum()))
+
+        return keys, lengths
+
+    def lookup(self, batch, padding_token: int) -> Optional[Tuple[Tensor, Tensor]]:
+        """
+        Returns the cached teacher outputs for ``batch``, if all its sentences are cached.
+
+        :param batch: Masked batch (see :py:class:`BatchMasker`).
+
+        :param padding_token: Padding token.
+
+        :return: ``None``, or (values, indices) of shape (batch_size, seq_length, k): the ``k`` largest teacher logits
+            (as float32) & their indices (as int64) at each target position. Zeros at the padded positions.
+        """
+        keys, _ = self.batch_keys(batch, padding_token)
+        if not all(key in self.index for key in keys):
+            return None
+
+        if self._values is None:
+            self._values = np.memmap(self.values_file, dtype=np.float16, mode='r').reshape(-1, self.k)
+            self._indices = np.memmap(self.indices_file, dtype=np.int32, mode='r').reshape(-1, self.k)
+
+        batch_size, seq_length = batch.trg_shifted.shape
+        values = np.zeros((batch_size, seq_length, self.k), dtype=np.float16)
+        indices = np.zeros((batch_size, seq_length, self.k), dtype=np.int32)
+        for i, key in enumerate(keys):
+            offset, length = self.index[key]
+            values[i, :length] = self._values[offset:offset + length]
+            indices[i, :length] = self._indices[offset:offset + length]
+
+        device = batch.trg_shifted.device
+        return torch.from_numpy(values).float().to(device), torch.from_numpy(indices).long().to(device)
+
+    def store(self, batch, logits: Tensor, padding_token: int) -> Tuple[Tensor, Tensor]:
+        """
+        Caches the teacher outputs for the sentences of ``batch`` which are not cached yet.
+
+        :param batch: Masked batch (see :py:class:`BatchMasker`).
+
+        :param logits: Teacher logits for ``batch``, of shape (batch_size, seq_length, vocabulary_size).
+
+        :param padding_token: Padding token.
+
+        :return: (values, indices) of shape (batch_size, seq_length, k), as returned by :py:func:`lookup`.
+        """
+        values, indices = logits.float().topk(self.k, dim=-1)
+
+        keys, lengths = self.batch_keys(batch, padding_token)
+        cpu_values = values.half().cpu().numpy()
+        cpu_indices = indices.int().cpu().numpy()
+
+        with open(self.values_file, 'ab') as values_file, open(self.indices_file, 'ab') as indices_file:
+            for i, (key, length) in enumerate(zip(keys, lengths)):
+                if key in self.index:
+                    continue
+                values_file.write(cpu_values[i, :length].tobytes())
+                indices_file.write(cpu_indices[i, :length].tobytes())
+                self.index[key] = (self.n_positions, length)
+                self.n_positions += length
+
+        # the memory maps don't see the appended data
+        self._values, self._indices = None, None
+
+        return values, indices
+
+    def flush(self) -> None:
+        """
+        Saves the index of the cache, e.g. at the end of each epoch.
+        """
+        torch.save({'k': self.k, 'index': self.index}, self.index_file)
+
+    def __len__(self):
+        """
+        Returns the number of cached sentences.
+        """
+        return len(self.index)
+
+
+class DistillationLoss(nn.Module):
+    """
+    Word-level knowledge distillation loss (see https://arxiv.org/abs/1606.07947), mixed with a base loss on the
+    ground truth tokens (e.g. :py:class:`LabelSmoothingLoss`):
+
+    .. math::
+
+        loss = \\alpha \\cdot T^2 \\cdot KL(p_{teacher} || p_{student}) + (1 - \\alpha) \\cdot base\\_loss
+
+    Where the distributions are softened by the temperature :math:`T`. The teacher distribution is restricted to
+    (and renormalized over) its ``k`` largest logits, as stored by :py:class:`TeacherCache`.
+    """
+
+    def __init__(self, base_loss: nn.Module, padding_token: int, alpha=0.5, temperature=1.0):
+        """
+        Constructor of the :py:class:`DistillationLoss` class.
+
+        :param base_loss: Loss on the ground truth tokens, taking the logits & the targets.
+
+        :param padding_token: Padding token, whose positions are ignored.
+
+        :param alpha: Weight of the distillation term, in [0, 1].
+
+        :param temperature: Softmax temperature applied to both the teacher & student logits.
+        """
+        assert 0.0 <= alpha <= 1.0, "The distillation weight should be in [0, 1], got {}.".format(alpha)
+
+        # call base constructor
+        super(DistillationLoss, self).__init__()
+
+        self.base_loss = base_loss
+        self.padding_token = padding_token
+        self.alpha = alpha
+        self.temperature = temperature
+
+    def forward(self, x: Tensor, targets: Tensor, teacher_values: Tensor, teacher_indices: Tensor) -> Tensor:
+        """
+        Forward pass of the :py:class:`DistillationLoss`.
+
+        :param x: predictions of the student (i.e. raw class scores), of shape [batch_size, seq_length, vocabulary_size]
+
+        :param targets: Ground truth tokens indices, of shape [batch_size, seq_length]
+
+        :param teacher_values: Largest logits of the teacher, of shape [batch_size, seq_length, k]
+
+        :param teacher_indices: Indices of these logits, of shape [batch_size, seq_length, k]
+
+        :return: loss value
+        """
+        # (in full precision, even if the logits come from an autocast region)
+        student_log_probs = torch.log_softmax(x.float() / self.temperature, dim=-1).gather(-1, teacher_indices)
+        teacher_log_probs = torch.log_softmax(teacher_values.float() / self.temperature, dim=-1)
+
+        # KL divergence at each position, averaged over the non-padding ones
+        kl = (teacher_log_probs.exp() * (teacher_log_probs - student_log_probs)).sum(dim=-1)
+        mask = targets != self.padding_token
+        distillation_loss = (kl * mask).sum() / mask.sum().clamp_min(1) * self.temperature ** 2
+
+        return self.alpha * distillation_loss + (1 - self.alpha) * self.base_loss(x, targets)
@@ -2,12 +2,6 @@ import torch
 import torch.nn as nn
 from torch import Tensor
 
-# if CUDA available, moves computations to GPU
-if torch.cuda.is_available():
-    device = torch.device('cuda')
-else:
-    device = torch.device('cpu')
-
 
 class CrossEntropyLoss(nn.Module):
     """
@@ -40,10 +34,11 @@ class CrossEntropyLoss(nn.Module):
         batch_size, seq_len, vocabulary_size = x.size()
 
         # flatten out tensors for simplicity
-        outputs_flat = x.view(batch_size * seq_len, vocabulary_size)
-        targets_flat = targets.view(batch_size * seq_len)
+        outputs_flat = x.reshape(batch_size * seq_len, vocabulary_size)
+        targets_flat = targets.reshape(batch_size * seq_len)
 
-        batch_loss = self.criterion(outputs_flat, targets_flat)
+        # computed in full precision, even if the logits come from a bfloat16 autocast region
+        batch_loss = self.criterion(outputs_flat.float(), targets_flat)
 
         return batch_loss
 
@@ -109,15 +104,6 @@ class LabelSmoothingLoss(nn.Module):
         self.confidence = 1.0 - smoothing
         self.smoothing = smoothing / (size - 2)  # exclude pad and true label
 
-        # create & save a tensor of size (1, size) containing the smoothing value everywhere
-        # will be used as a basis to create label-smoothed targets:
-        # - simply have to add confidence at true index and ignore padding
-        smoothed_targets = torch.full(size=(size,), fill_value=self.smoothing, device=device)
-
-        # smoothed_targets[self.padding_token] = 0
-
-        self.register_buffer('smoothed_targets', smoothed_targets.unsqueeze(0))  # (1, size)
-
     def forward(self, x, targets) -> Tensor:
         """
         Forward pass of the LabelSmoothingLoss.
@@ -132,13 +118,16 @@ class LabelSmoothingLoss(nn.Module):
 
         batch_size, seq_len, vocabulary_size = x.size()
 
-        # go through LogSoftmax layer and flatten out the tensors for simplicity
-        outputs_log_softmax = self.log_softmax(x)
+        # go through LogSoftmax layer (in full precision, even if the logits come from a bfloat16 autocast region)
+        # and flatten out the tensors for simplicity
+        outputs_log_softmax = self.log_softmax(x.float())
         outputs_flat = outputs_log_softmax.view(batch_size * seq_len, vocabulary_size)
         targets_flat = targets.contiguous().view(batch_size * seq_len)
 
-        # repeat the smoothed_targets tensor as necessary to match batch size
-        smoothed_targets = self.smoothed_targets.repeat(targets_flat.size(0), 1)
+        # create a tensor containing the smoothing value everywhere, on the device of the predictions
+        # used as a basis for the label-smoothed targets: simply have to add confidence at true index and ignore padding
+        smoothed_targets = torch.full(size=(targets_flat.size(0), vocabulary_size), fill_value=self.smoothing,
+                                      dtype=outputs_flat.dtype, device=outputs_flat.device)
         # smoothed_targets: (batch_size * seq_len, vocabulary_size)
 
         # Copies self.confidence into smoothed_targets at indices specified by targets_flats
@@ -157,3 +146,40 @@ class LabelSmoothingLoss(nn.Module):
         del smoothed_targets, targets_flat
 
         return loss
+
+
+class AdaptiveSoftmaxLoss(nn.Module):
+    """
+    Negative log-likelihood loss of the :py:class:`AdaptiveOutputClassifier`: unlike :py:class:`CrossEntropyLoss`, it
+    takes the ``Decoder`` outputs (as returned by the ``Transformer`` using this classifier), and only computes the
+    log-probabilities of the target tokens, cluster by cluster, instead of the scores of the whole vocabulary.
+
+    Label smoothing is not supported, as it would require the scores of the whole vocabulary.
+    """
+    def __init__(self, classifier: nn.Module, padding_token: int):
+        """
+        Constructor of the :py:class:`AdaptiveSoftmaxLoss` class.
+
+        :param classifier: ``AdaptiveOutputClassifier`` of the model (its parameters are shared with the model).
+
+        :param padding_token: Padding token to ignore during loss computation.
+        """
+        # call base constructor
+        super(AdaptiveSoftmaxLoss, self).__init__()
+
+        self.classifier = classifier
+        self.padding_token = padding_token
+
+    def forward(self, x, targets) -> Tensor:
+        """
+        Forward pass of the :py:class:`AdaptiveSoftmaxLoss`.
+
+        :param x: Outputs of the ``Decoder``, of shape [batch_size, seq_length, d_model].
+
+        :param targets: Ground truth tokens indices, of shape [batch_size, seq_length]
+
+        :return: loss, averaged over the non-padding positions.
+        """
+        mask = targets != self.padding_token
+
+        return self.classifier.loss(x[mask], targets[mask]) / mask.sum().clamp_min(1)
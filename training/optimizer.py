@@ -18,6 +18,10 @@ class NoamOpt(object):
 
     This corresponds to increasing the learning rate linearly for the first `warmup_steps` training steps,
     and decreasing it thereafter proportionally to the inverse square root of the step number.
+
+    The optimizer always updates float32 master weights: when training under ``torch.autocast``, those are the
+    model parameters themselves. If some parameters are stored in lower precision (e.g. after ``model.bfloat16()``),
+    a float32 copy of them is optimized instead, and copied back into the model after each step.
     """
 
     def __init__(self, model: torch.nn.Module, model_size=512, lr=0., betas=(0.9, 0.98), eps=1e-9, factor=2, warmup=4000, step=0):
@@ -43,8 +47,13 @@ class NoamOpt(object):
             to ensure the consistency of the learning rate decay with respect to ``warmup``.
         """
 
-        self.optimizer = torch.optim.Adam(params=filter(lambda p: p.requires_grad, model.parameters()), lr=lr,
-                                          betas=betas, eps=eps)
+        # (model parameter, float32 master copy) pairs, for the parameters not stored in float32
+        self.master_params = [(p, p.detach().float().requires_grad_()) for p in model.parameters()
+                              if p.requires_grad and p.dtype != torch.float32]
+        masters = {id(p): master for p, master in self.master_params}
+
+        self.optimizer = torch.optim.Adam(params=[masters.get(id(p), p) for p in model.parameters() if p.requires_grad],
+                                          lr=lr, betas=betas, eps=eps)
         self._step = step
         self.warmup = warmup
         self.factor = factor
@@ -66,9 +75,18 @@ class NoamOpt(object):
             p['lr'] = rate
         self._rate = rate
 
+        # the gradients of the low precision parameters are applied in float32 to their master weights
+        for p, master in self.master_params:
+            master.grad = None if p.grad is None else p.grad.float()
+
         # perform optimization step
         self.optimizer.step()
 
+        # copy the updated master weights back into the model
+        with torch.no_grad():
+            for p, master in self.master_params:
+                p.copy_(master)
+
     def rate(self) -> float:
         """
         Compute updated learning rate based on step index and formula.
@@ -79,3 +97,5 @@ class NoamOpt(object):
 
     def zero_grad(self):
         self.optimizer.zero_grad()
+        for p, _ in self.master_params:
+            p.grad = None
@@ -1,7 +1,22 @@
+from contextlib import contextmanager
+from typing import Callable, Optional, Union
+
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 from torch import Tensor
+from torch.utils.checkpoint import checkpoint
+
+from transformer.utils import subsequent_mask
+
+
+def _upcast(x: Tensor) -> Tensor:
+    """
+    Casts half-precision tensors (e.g. produced under ``torch.autocast``) to float32, so that the softmax is
+    computed in full precision. Other tensors are returned as is.
+    """
+    return x.float() if x.dtype in (torch.float16, torch.bfloat16) else x
 
 
 class ScaledDotProductAttention(nn.Module):
@@ -24,20 +39,41 @@ class ScaledDotProductAttention(nn.Module):
 
         Attention(Q,K,V) = softmax(\\frac{Q \\cdot K^T}{\sqrt{d_k}}) \\cdot V
 
+    If ``block_size`` is set, the attention can be computed by blocks of queries & keys, without ever materializing
+    the whole (seq_length x seq_length) scores matrix: the softmax is computed in a streaming fashion over the blocks of
+    keys, by keeping track of the running maximum & sum of the exponentiated scores
+    (see https://arxiv.org/abs/1805.02867).
+
+    If ``causal`` is set, each query can only attend to the keys at the same or previous positions, without the
+    callers having to build a (batch_size x seq_length x seq_length) mask combining the padding & subsequent masks.
+
     """
 
-    def __init__(self, attn_dropout=0.1):
+    def __init__(self, attn_dropout=0.1, block_size: Optional[int] = None, causal=False):
         """
         Constructor for the ``ScaledDotProductAttention`` class.
 
         :param attn_dropout: dropout probability.
         :type attn_dropout: float (default = 0.1)
 
+        :param block_size: If not ``None``, size of the blocks of queries & keys used when one of the sequences is
+            longer than it. Peak memory is then proportional to ``block_size`` rather than to the sequence lengths.
+
+        :param causal: Whether to hide the subsequent positions (see :py:func:`transformer.utils.subsequent_mask`).
+            When there are fewer queries than keys (incremental decoding), the queries are assumed to be the last
+            positions of the sequence.
+
         """
 
         # call base constructor
         super(ScaledDotProductAttention, self).__init__()
 
+        self.block_size = block_size
+        self.causal = causal
+
+        # if not None, called with the attention weights at each forward pass (see capture_attention_weights)
+        self.attention_sink = None  # type: Optional[Callable[[Tensor], None]]
+
         # instantiate dropout layer
         self.dropout = nn.Dropout(attn_dropout)
 
@@ -64,7 +100,17 @@ class ScaledDotProductAttention(nn.Module):
 
         :return: Results of attention weights applied to the values. Shape should be (batch_size, seq_length, d_v)
 
+        .. note::
+
+            The attention weights are not kept once the forward pass is done, unless an ``attention_sink`` is set
+            (see :py:func:`capture_attention_weights`). In that case, the attention is never computed by blocks.
+
         """
+        if self.block_size is not None and self.attention_sink is None \
+                and max(queries.shape[-2], keys.shape[-2]) > self.block_size:
+            # the attention weights are never materialized
+            return self._chunked_attention(queries, keys, values, mask)
+
         # get dimension d_k
         d_k = queries.shape[-1]
 
@@ -75,12 +121,130 @@ class ScaledDotProductAttention(nn.Module):
             # Will be normalized to 0 in the softmax layer afterwards
             scores = scores.masked_fill(mask == 0, -1e9)
 
-        # get attn weights
-        self.attention_weights = self.softmax(scores)
+        if self.causal:
+            # hide the subsequent positions: the queries are the last positions of the keys sequence
+            scores = scores.masked_fill(~self._causal_mask(scores.shape[-2], scores.shape[-1], scores.device), -1e9)
+
+        # get attn weights (in full precision), then back to the precision of the values
+        attention_weights = self.softmax(_upcast(scores)).type_as(values)
 
-        self.attention_weights = self.dropout(self.attention_weights)
+        if self.attention_sink is not None:
+            self.attention_sink(attention_weights.detach())
+
+        attention_weights = self.dropout(attention_weights)
         # apply the weights on the values
-        return torch.matmul(self.attention_weights, values)
+        return torch.matmul(attention_weights, values)
+
+    @staticmethod
+    def _causal_mask(n_queries: int, n_keys: int, device: torch.device) -> Tensor:
+        """
+        Returns the boolean mask of shape (n_queries, n_keys) hiding the subsequent positions, for the last
+        ``n_queries`` positions of a sequence of ``n_keys`` positions.
+
+        When compiling (``torch.compile`` / ``torch.export``), the mask is built in the graph from the (symbolic)
+        sequence lengths instead of being sliced from the cached mask, so that the graph is not specialized
+        on the lengths.
+        """
+        if torch.compiler.is_compiling():
+            positions = torch.arange(n_keys, device=device)
+            return positions <= positions[n_keys - n_queries:].unsqueeze(-1)
+
+        return subsequent_mask(n_keys, device)[0, n_keys - n_queries:]
+
+    def _chunked_attention(self, queries: Tensor, keys: Tensor, values: Tensor, mask=None) -> Tensor:
+        """
+        Computes the attention by blocks of ``block_size`` queries (see :py:func:`_streaming_attention`).
+
+        When training, the intermediate results of each block are recomputed during the backward pass instead of
+        being stored, so that the memory used by the attention stays proportional to ``block_size``.
+
+        :param queries: Tensor of shape (..., seq_length, d_k).
+        :param keys: Tensor of shape (..., seq_length, d_k).
+        :param values: Tensor of shape (..., seq_length, d_v).
+        :param mask: If not ``None``, broadcastable to (..., queries seq_length, keys seq_length).
+
+        :return: Tensor of shape (..., queries seq_length, d_v).
+        """
+        # position of the first query in the keys sequence (see causal)
+        offset = keys.shape[-2] - queries.shape[-2]
+
+        outputs = []
+        for start in range(0, queries.shape[-2], self.block_size):
+            end = start + self.block_size
+
+            block_mask = mask
+            if mask is not None and mask.shape[-2] > 1:
+                block_mask = mask[..., start:end, :]
+
+            if torch.is_grad_enabled() and queries.requires_grad:
+                outputs.append(checkpoint(self._streaming_attention, queries[..., start:end, :], keys, values,
+                                          block_mask, offset + start, use_reentrant=False))
+            else:
+                outputs.append(self._streaming_attention(queries[..., start:end, :], keys, values, block_mask,
+                                                         offset + start))
+
+        return torch.cat(outputs, dim=-2)
+
+    def _streaming_attention(self, queries: Tensor, keys: Tensor, values: Tensor, mask=None,
+                             position=0) -> Tensor:
+        """
+        Computes the attention of ``queries`` over blocks of ``block_size`` keys, with a streaming softmax: for each
+        block, the accumulated sum of exponentiated scores and weighted values are rescaled to the new running maximum
+        of the scores before adding the contribution of the block.
+
+        The dropout is applied on the (unnormalized) exponentiated scores used to weight the values, which is
+        equivalent to applying it on the normalized attention weights.
+
+        :param queries: Tensor of shape (..., queries seq_length, d_k).
+        :param keys: Tensor of shape (..., seq_length, d_k).
+        :param values: Tensor of shape (..., seq_length, d_v).
+        :param mask: If not ``None``, broadcastable to (..., queries seq_length, keys seq_length).
+        :param position: Position of the first query in the keys sequence. Only used if ``causal``.
+
+        :return: Tensor of shape (..., queries seq_length, d_v).
+        """
+        d_k, n_queries = queries.shape[-1], queries.shape[-2]
+
+        if self.causal:
+            causal_mask = subsequent_mask(keys.shape[-2], keys.device)[:, position:position + n_queries]
+
+        running_max, running_sum, output = None, None, None
+
+        for start in range(0, keys.shape[-2], self.block_size):
+            end = start + self.block_size
+
+            if self.causal and start >= position + n_queries:
+                # all the remaining keys are subsequent to the queries
+                break
+
+            # compute Q . K^T for the current block of keys & mask it out
+            # (the running statistics are kept in full precision)
+            scores = _upcast(torch.matmul(queries, keys[..., start:end, :].transpose(-2, -1))) / np.sqrt(d_k)
+            if mask is not None:
+                scores = scores.masked_fill(mask[..., start:end] == 0, -1e9)
+            if self.causal:
+                scores = scores.masked_fill(~causal_mask[..., start:end], -1e9)
+
+            # exponentiate the scores relatively to the running maximum
+            block_max = scores.max(dim=-1, keepdim=True)[0]
+            new_max = block_max if running_max is None else torch.max(running_max, block_max)
+            exp_scores = torch.exp(scores - new_max)
+
+            block_sum = exp_scores.sum(dim=-1, keepdim=True)
+            block_output = _upcast(torch.matmul(self.dropout(exp_scores).type_as(values), values[..., start:end, :]))
+
+            if running_max is None:
+                running_sum, output = block_sum, block_output
+            else:
+                # rescale the previous blocks to the new maximum
+                correction = torch.exp(running_max - new_max)
+                running_sum = running_sum * correction + block_sum
+                output = output * correction + block_output
+
+            running_max = new_max
+
+        # normalize by the softmax denominator
+        return (output / running_sum).type_as(values)
 
 
 class MultiHeadAttention(nn.Module):
@@ -102,9 +266,13 @@ class MultiHeadAttention(nn.Module):
 
     The W matrices are linear projections.
 
+    The projections of Q, K, V can be fused into a single matrix product (``fused='qkv'``, for self-attention, where
+    Q = K = V), or only the ones of K, V (``fused='kv'``, for the memory-attention, where K = V).
+
     """
 
-    def __init__(self, n_head: int, d_model: int, d_k: int, d_v: int, dropout=0.1):
+    def __init__(self, n_head: int, d_model: int, d_k: int, d_v: int, dropout=0.1, fused: Optional[str] = None,
+                 block_size: Optional[int] = None, causal=False):
         """
         Constructor for the ``MultiHeadAttention`` class.
 
@@ -118,30 +286,52 @@ class MultiHeadAttention(nn.Module):
 
         :param dropout: dropout probability. Default: 0.1. Passed to :py:class:`ScaledDotProductAttention`.
 
+        :param fused: Layout of the linear projections (prior to the ``ScaledDotProductAttention``):
+
+            - ``None``: 3 separate layers ``w_qs``, ``w_ks``, ``w_vs``,
+            - ``'qkv'``: 1 layer ``w_qkv`` projecting Q, K, V at once (self-attention),
+            - ``'kv'``: 2 layers ``w_qs`` & ``w_kvs``, the latter projecting K, V at once (memory-attention).
+
+            Checkpoints saved with any of these layouts can be loaded in any other.
+
+        :param block_size: If not ``None``, the attention is computed by blocks of ``block_size`` queries & keys.
+            Passed to :py:class:`ScaledDotProductAttention`.
+
+        :param causal: Whether to hide the subsequent positions, e.g. in the self-attention of the ``Decoder``.
+            Passed to :py:class:`ScaledDotProductAttention`.
+
         """
         # call base constructor
         super(MultiHeadAttention, self).__init__()
 
-        assert d_model % n_head == 0, "Should always have d_model % n_head = 0."
         assert d_k == d_v, "Should always have d_k == d_v."
+        assert fused in (None, 'qkv', 'kv'), "Unknown projections layout '{}'.".format(fused)
 
         # get parameter values
         self.n_head = n_head
         self.d_k = d_k
         self.d_v = d_v
+        self.fused = fused
 
         # instantiate the linear layers (prior to the ScaledDotProductAttention)
-        self.w_qs = nn.Linear(d_model, n_head * d_k)
-        self.w_ks = nn.Linear(d_model, n_head * d_k)
-        self.w_vs = nn.Linear(d_model, n_head * d_v)
+        if fused == 'qkv':
+            self.w_qkv = nn.Linear(d_model, n_head * (2 * d_k + d_v))
+        elif fused == 'kv':
+            self.w_qs = nn.Linear(d_model, n_head * d_k)
+            self.w_kvs = nn.Linear(d_model, n_head * (d_k + d_v))
+        else:
+            self.w_qs = nn.Linear(d_model, n_head * d_k)
+            self.w_ks = nn.Linear(d_model, n_head * d_k)
+            self.w_vs = nn.Linear(d_model, n_head * d_v)
 
         # instantiate the attention layer
-        self.attention = ScaledDotProductAttention(attn_dropout=dropout)
+        self.attention = ScaledDotProductAttention(attn_dropout=dropout, block_size=block_size, causal=causal)
 
         # final output linear layer
         self.fc = nn.Linear(n_head * d_v, d_model)
 
-    def forward(self, queries: Tensor, keys: Tensor, values: Tensor, mask=None) -> Tensor:
+    def forward(self, queries: Tensor, keys: Tensor, values: Tensor, mask=None,
+                cache: Optional[dict] = None, static_kv=False) -> Tensor:
         """
         Implements the forward pass of the ``MultiHeadAttention`` class.
 
@@ -166,6 +356,14 @@ class MultiHeadAttention(nn.Module):
         Can be used in the Decoder to avoid a position at index ``i`` in the sequence to attend to positions
         at indices > ``i`` -> prevent a leftward information flow which would be illegal in the Decoder.
 
+        :param cache: If not ``None``, dict holding the projected keys & values of previous calls (incremental decoding).
+        Its ``'keys'`` and ``'values'`` entries have shape (batch_size, n_head, cached_length, d_k) and are updated
+        in place.
+
+        :param static_kv: Whether ``keys`` & ``values`` are the same at every call (e.g. the ``Encoder`` memory).
+        If ``True``, they are only projected once and then read back from ``cache``. Otherwise, the new projected
+        keys & values are appended to the cached ones.
+
         :return: Results of attention weights applied to the values
                 (linear projection of the concatenation of the output of each head).
                 Shape should be (batch_size, seq_length, d_model).
@@ -177,10 +375,26 @@ class MultiHeadAttention(nn.Module):
             mask = mask.unsqueeze(1)
 
         n_batches = queries.shape[0]
+        use_cached_kv = cache is not None and static_kv and 'keys' in cache
 
         # 1) Do all the linear projections in batch from d_model => h x d_k
-        queries, keys, values = [l(x).view(n_batches, -1, self.n_head, self.d_k).transpose(1, 2)
-                                 for l, x in zip((self.w_qs, self.w_ks, self.w_vs), (queries, keys, values))]
+        if self.fused == 'qkv' and queries is keys and keys is values and not use_cached_kv:
+            queries, keys, values = [self._split_heads(x) for x in self.w_qkv(queries).chunk(3, dim=-1)]
+        else:
+            queries = self._split_heads(self._project_queries(queries))
+
+            if use_cached_kv:
+                # the memory has already been projected at a previous step
+                keys, values = cache['keys'], cache['values']
+            else:
+                keys, values = [self._split_heads(x) for x in self._project_keys_values(keys, values)]
+
+        if cache is not None and not use_cached_kv:
+            if not static_kv and 'keys' in cache:
+                # append the keys & values of the new positions along the sequence dimension
+                keys = torch.cat([cache['keys'], keys], dim=2)
+                values = torch.cat([cache['values'], values], dim=2)
+            cache['keys'], cache['values'] = keys, values
 
         # 2) Apply attention on all the projected vectors in batch.
         x = self.attention(queries, keys, values, mask=mask)
@@ -191,6 +405,115 @@ class MultiHeadAttention(nn.Module):
         # final linear layer
         return self.fc(x)
 
+    def _split_heads(self, x: Tensor) -> Tensor:
+        """
+        Reshapes projected vectors of shape (batch_size, seq_length, n_head * d_k) into
+        (batch_size, n_head, seq_length, d_k).
+        """
+        return x.view(x.shape[0], -1, self.n_head, self.d_k).transpose(1, 2)
+
+    def _project_queries(self, queries: Tensor) -> Tensor:
+        """
+        Projects the queries with W^Q.
+        """
+        if self.fused == 'qkv':
+            # use the first third of the fused projection
+            size = self.n_head * self.d_k
+            return F.linear(queries, self.w_qkv.weight[:size], self.w_qkv.bias[:size])
+
+        return self.w_qs(queries)
+
+    def _project_keys_values(self, keys: Tensor, values: Tensor):
+        """
+        Projects the keys with W^K and the values with W^V (as one matrix product if they are the same tensor).
+        """
+        if self.fused is None:
+            return self.w_ks(keys), self.w_vs(values)
+
+        if self.fused == 'kv':
+            layer, offset = self.w_kvs, 0
+        else:
+            layer, offset = self.w_qkv, self.n_head * self.d_k
+
+        if keys is values and offset == 0:
+            return layer(keys).chunk(2, dim=-1)
+
+        weight, bias = layer.weight[offset:], layer.bias[offset:]
+        if keys is values:
+            return F.linear(keys, weight, bias).chunk(2, dim=-1)
+
+        size = self.n_head * self.d_k
+        return (F.linear(keys, weight[:size], bias[:size]),
+                F.linear(values, weight[size:], bias[size:]))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        """
+        Converts the linear projections found in ``state_dict`` to the layout of this module (see ``fused``
+        in :py:func:`__init__`) before loading them, so that checkpoints saved with another layout can be loaded.
+        """
+        for param in ('weight', 'bias'):
+            keys = {name: prefix + name + '.' + param for name in ('w_qs', 'w_ks', 'w_vs', 'w_kvs', 'w_qkv')}
+
+            # 1. Get the Q, K, V projections, whatever the layout of the checkpoint
+            if keys['w_qkv'] in state_dict:
+                q, k, v = state_dict.pop(keys['w_qkv']).chunk(3, dim=0)
+            elif keys['w_qs'] in state_dict and keys['w_kvs'] in state_dict:
+                q = state_dict.pop(keys['w_qs'])
+                k, v = state_dict.pop(keys['w_kvs']).chunk(2, dim=0)
+            elif all(keys[name] in state_dict for name in ('w_qs', 'w_ks', 'w_vs')):
+                q, k, v = [state_dict.pop(keys[name]) for name in ('w_qs', 'w_ks', 'w_vs')]
+            else:
+                continue  # let the base class report the missing keys
+
+            # 2. Store them in the layout of this module
+            if self.fused == 'qkv':
+                state_dict[keys['w_qkv']] = torch.cat([q, k, v], dim=0)
+            elif self.fused == 'kv':
+                state_dict[keys['w_qs']] = q
+                state_dict[keys['w_kvs']] = torch.cat([k, v], dim=0)
+            else:
+                state_dict[keys['w_qs']], state_dict[keys['w_ks']], state_dict[keys['w_vs']] = q, k, v
+
+        super(MultiHeadAttention, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+@contextmanager
+def capture_attention_weights(model: nn.Module, sink: Union[dict, Callable[[str, Tensor], None]]):
+    """
+    Context manager capturing the attention weights of all :py:class:`ScaledDotProductAttention` of ``model``
+    (e.g. for visualization). The weights are not kept otherwise.
+
+    Example:
+
+    >>> attention_weights = {}
+    >>> with capture_attention_weights(model, attention_weights):
+    ...     model.greedy_decode(src, src_mask, trg_vocab)
+    >>> attention_weights['encoder.layers.0.self_attention.attention'].shape  # (batch_size, n_head, seq_len, seq_len)
+
+    :param model: Module containing the attention layers to capture (e.g. a ``Transformer``).
+
+    :param sink: Where to write the attention weights (detached from the graph), at each forward pass of each attention
+        layer. Either a dict, whose keys are the names of the ``ScaledDotProductAttention`` modules in ``model``
+        (the weights of the last forward pass are kept), or a callable taking this name & the weights.
+
+    :return: ``sink``.
+    """
+    write = sink.__setitem__ if isinstance(sink, dict) else sink
+
+    modules = [(name, module) for name, module in model.named_modules()
+               if isinstance(module, ScaledDotProductAttention)]
+
+    def make_sink(module_name):
+        return lambda weights: write(module_name, weights)
+
+    for name, module in modules:
+        module.attention_sink = make_sink(name)
+    try:
+        yield sink
+    finally:
+        for _, module in modules:
+            module.attention_sink = None
+
 
 if __name__ == '__main__':
     batch_size = 64
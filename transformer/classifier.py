@@ -1,4 +1,8 @@
+from functools import partial
+from typing import Callable, Sequence
+
 import torch.nn as nn
+import torch.nn.functional as F
 from torch import Tensor
 
 
@@ -31,3 +35,86 @@ class OutputClassifier(nn.Module):
         :return: Next token raw scores, of shape (batch_size, seq_len, vocab).
         """
         return self.linear1(x)
+
+    def predict(self, x: Tensor) -> Tensor:
+        """
+        Returns the most likely next token for each input vector of ``x``, of shape (..., d_model).
+        """
+        return self(x).argmax(dim=-1)
+
+    def shortlist(self, candidates: Tensor) -> Callable[[Tensor], Tensor]:
+        """
+        Restricts the ``OutputClassifier`` to the ``candidates`` tokens (see :py:class:`Shortlist`): their rows of
+        the weight matrix & bias are gathered once, and the returned function only scores them.
+
+        :param candidates: LongTensor of the candidate token indices in the output vocabulary.
+
+        :return: Function mapping the input Tensor of shape (..., d_model) to the raw scores of the candidates, of
+            shape (..., len(candidates)).
+        """
+        weight = self.linear1.weight.index_select(0, candidates)
+        bias = self.linear1.bias.index_select(0, candidates)
+        return partial(F.linear, weight=weight, bias=bias)
+
+
+class AdaptiveOutputClassifier(nn.Module):
+    """
+    Adaptive softmax (see https://arxiv.org/abs/1609.04309) alternative to the :py:class:`OutputClassifier`, for large
+    output vocabularies: the tokens are split in frequency-sorted clusters. The head cluster contains the most frequent
+    tokens and one entry per tail cluster, the rarer tokens of the tail clusters are scored by smaller projections
+    (of size ``d_model / div_value ** i`` for the i-th tail cluster), only computed for the positions which need them.
+
+    The token indices should be sorted by decreasing frequency, as in the ``torchtext`` vocabularies (after the
+    special tokens).
+
+    The training loss is given by :py:class:`AdaptiveSoftmaxLoss`, which never materializes the
+    (batch_size, seq_len, vocab) scores.
+    """
+    def __init__(self, d_model: int, vocab: int, cutoffs: Sequence[int], div_value=4.0):
+        """
+        Constructor of the ``AdaptiveOutputClassifier`` class.
+
+        :param d_model: size of the input vectors.
+
+        :param vocab: size of the output vocabulary set.
+
+        :param cutoffs: Increasing token indices at which the clusters are split, e.g. ``[2000, 10000]`` for a head
+            cluster of 2000 tokens, and 2 tail clusters.
+
+        :param div_value: Factor by which the projection size decreases from one cluster to the next.
+        """
+        # call base constructor
+        super(AdaptiveOutputClassifier, self).__init__()
+
+        self.adaptive_softmax = nn.AdaptiveLogSoftmaxWithLoss(d_model, vocab, cutoffs=list(cutoffs),
+                                                              div_value=div_value, head_bias=True)
+
+    def forward(self, x: Tensor) -> Tensor:
+        """
+        Forward pass of the ``AdaptiveOutputClassifier``: computes the scores of the whole vocabulary (e.g. for beam
+        search). These are log-probabilities, i.e. already normalized.
+
+        :param x: Input Tensor, of shape (..., d_model).
+
+        :return: Next token log-probabilities, of shape (..., vocab).
+        """
+        return self.adaptive_softmax.log_prob(x.reshape(-1, x.shape[-1])).view(*x.shape[:-1], -1)
+
+    def predict(self, x: Tensor) -> Tensor:
+        """
+        Returns the most likely next token for each input vector of ``x``, of shape (..., d_model). The tail clusters
+        are only scored for the inputs whose best head entry is not a token of the head cluster.
+        """
+        return self.adaptive_softmax.predict(x.reshape(-1, x.shape[-1])).view(x.shape[:-1])
+
+    def loss(self, x: Tensor, targets: Tensor) -> Tensor:
+        """
+        Returns the negative log-likelihood of ``targets``, summed over the positions.
+
+        :param x: Input Tensor, of shape (n_positions, d_model).
+
+        :param targets: Target token indices, of shape (n_positions,).
+        """
+        output = self.adaptive_softmax(x, targets).output
+        # (in full precision, even if the inputs come from a bfloat16 autocast region)
+        return -output.float().sum()
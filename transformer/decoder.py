@@ -1,8 +1,12 @@
+from typing import Iterable, List, Optional, Union
+
+import torch
 import torch.nn as nn
 from torch import Tensor
+from torch.utils.checkpoint import checkpoint
 
 from transformer.layers import LayerNormalization, ResidualConnection
-from transformer.utils import clone
+from transformer.utils import clone, layer_selection
 
 
 class Decoder(nn.Module):
@@ -12,23 +16,73 @@ class Decoder(nn.Module):
     Constituted of a stack of ``N`` identical layers.
     """
 
-    def __init__(self, layer: nn.Module, N: int):
+    def __init__(self, layer: nn.Module, N: int, checkpoint_layers: Union[bool, Iterable[int]] = False):
         """
         Constructor for the global ``Decoder``.
 
         :param layer: layer module to use.
 
         :param N: number of decoder layers to use.
+
+        :param checkpoint_layers: Layers (``True`` for all, or indices) whose activations are recomputed during the
+            backward pass instead of being stored, trading compute for memory (see :py:mod:`torch.utils.checkpoint`).
+            Not used when decoding with a cache.
         """
         # call base constructor
         super(Decoder, self).__init__()
 
         self.layers = clone(layer, N)
 
+        self.checkpoint_layers = layer_selection(checkpoint_layers, N)
+
         self.norm = LayerNormalization(layer.size)
 
+    def init_cache(self) -> List[dict]:
+        """
+        Creates an empty cache for incremental decoding: one dict per layer, with one entry for the self-attention
+        (past keys & values) and one for the memory-attention (projected ``Encoder`` memory).
+
+        :return: List of ``N`` dicts, to be passed as ``cache`` to :py:func:`forward`.
+        """
+        return [{'self_attn': {}, 'memory_attn': {}} for _ in self.layers]
+
+    @staticmethod
+    def reorder_cache(cache: List[dict], indices: Tensor, memory=False) -> None:
+        """
+        Reorders (in place) the cached keys & values along the batch dimension, e.g. to follow the hypotheses
+        selected at each step of a beam search, or to drop the finished sentences.
+
+        :param cache: Cache created by :py:func:`init_cache`.
+
+        :param indices: LongTensor of shape (new_batch_size,): new position ``i`` is taken from old position
+            ``indices[i]``.
+
+        :param memory: Whether to also reorder the memory-attention caches. Can be left to ``False`` when ``indices``
+            only shuffles hypotheses among those sharing the same ``Encoder`` memory.
+        """
+        for layer_cache in cache:
+            for name in ('self_attn', 'memory_attn') if memory else ('self_attn',):
+                for key in ('keys', 'values'):
+                    if key in layer_cache[name]:
+                        layer_cache[name][key] = layer_cache[name][key].index_select(0, indices)
+
+    @staticmethod
+    def truncate_cache(cache: List[dict], length: int) -> None:
+        """
+        Drops (in place) the cached self-attention keys & values of the positions after ``length``, e.g. to discard
+        the positions of rejected draft tokens in speculative decoding.
+
+        :param cache: Cache created by :py:func:`init_cache`.
+
+        :param length: Number of positions to keep.
+        """
+        for layer_cache in cache:
+            for key in ('keys', 'values'):
+                if key in layer_cache['self_attn']:
+                    layer_cache['self_attn'][key] = layer_cache['self_attn'][key][:, :, :length]
+
     def forward(self, x: Tensor, memory: Tensor, self_mask: Tensor, memory_mask: Tensor,
-                verbose=False) -> Tensor:
+                verbose=False, cache: Optional[List[dict]] = None) -> Tensor:
         """
         Forward pass: Relays the output of layer `i` to layer `i+1`.
 
@@ -36,27 +90,32 @@ class Decoder(nn.Module):
 
         :param memory: Output of the ``Encoder`` stack. Should be of same shape as ``x``.
 
-        :param self_mask: Mask hiding both the padding in ``x`` and prevent predictions from attending to subsequent
-        positions.
+        :param self_mask: Mask hiding the padding in ``x``, of shape (batch_size, 1, seq_len), or ``None`` if there is
+        no padding.
 
         .. note::
 
-            This mask prevents predictions from attending to subsequent positions:
-
-            i.e Prediction at position i can depend only on the known outputs at positions less than i.
-
-            This mask also hides padding, i.e. mark the sequence's length padding element so that they can be ignored.
+            The subsequent positions are hidden by the self-attention itself (created with ``causal=True``, see
+            :py:class:`MultiHeadAttention`): prediction at position i can only depend on the known outputs at
+            positions less than i, without combining ``self_mask`` with a `subsequent_mask`.
 
 
         :param memory_mask: Corresponding mask of ``memory``.
 
         :param verbose: Whether to add debug/info messages or not.
+
+        :param cache: If not ``None``, per-layer cache created by :py:func:`init_cache`. ``x`` should then only
+        contain the new positions (e.g. the last predicted token), the previous ones being read from the cache.
         """
 
         for i, layer in enumerate(self.layers):
             if verbose:
                 print(f"Going into layer {i}")
-            x = layer(x, memory, self_mask, memory_mask)
+            if i in self.checkpoint_layers and self.training and torch.is_grad_enabled() and cache is None:
+                x = checkpoint(layer, x, memory, self_mask, memory_mask, use_reentrant=False)
+            else:
+                x = layer(x, memory, self_mask, memory_mask,
+                          cache=cache[i] if cache is not None else None)
 
         return self.norm(x)
 
@@ -106,36 +165,41 @@ class DecoderLayer(nn.Module):
         # residual connections
         self.sublayer = clone(ResidualConnection(size, dropout), 3)
 
-    def forward(self, x: Tensor, memory: Tensor, self_mask: Tensor, memory_mask: Tensor) -> Tensor:
+    def forward(self, x: Tensor, memory: Tensor, self_mask: Tensor, memory_mask: Tensor,
+                cache: Optional[dict] = None) -> Tensor:
         """
         :param x: Input Tensor, should be 3-dimensional: (batch_size, seq_length, d_model).
                 Should represent the output of the previous Decoder layer or teacher-forcing inputs (or start token).
 
         :param memory: Output of the ``Encoder`` stack. Should be of same shape as ``x``.
 
-        :param self_mask: Mask hiding both the padding in ``x`` and prevent predictions from attending to subsequent
-        positions.
+        :param self_mask: Mask hiding the padding in ``x``, of shape (batch_size, 1, seq_len), or ``None`` if there is
+        no padding.
 
         .. note::
 
-            This mask prevents predictions from attending to subsequent positions:
-
-            i.e Prediction at position i can depend only on the known outputs at positions less than i.
-
-            This mask also hides padding, i.e. mark the sequence's length padding element so that they can be ignored.
+            The subsequent positions are hidden by the self-attention itself (created with ``causal=True``, see
+            :py:class:`MultiHeadAttention`): prediction at position i can only depend on the known outputs at
+            positions less than i, without combining ``self_mask`` with a `subsequent_mask`.
 
 
         :param memory_mask: Corresponding mask of ``memory``.
 
+        :param cache: If not ``None``, dict with the ``'self_attn'`` & ``'memory_attn'`` caches of this layer
+        (see :py:func:`Decoder.init_cache`).
+
 
         :return: Output of the ``DecoderLayer``, should be of the same shape as the input.
         """
+        self_cache, memory_cache = (cache['self_attn'], cache['memory_attn']) if cache is not None else (None, None)
 
         # multi-head attention over the input of the decoder
-        out_self_attn = self.sublayer[0](x, lambda y: self.self_attn(y, y, y, self_mask))
+        out_self_attn = self.sublayer[0].add_norm(x, self.self_attn(x, x, x, self_mask, cache=self_cache))
 
         # multi-head attention over the output of the encoder stack
-        out_memory_attn = self.sublayer[1](out_self_attn, lambda y: self.memory_attn(y, memory, memory, memory_mask))
+        out_memory_attn = self.sublayer[1].add_norm(out_self_attn,
+                                                    self.memory_attn(out_self_attn, memory, memory, memory_mask,
+                                                                     cache=memory_cache, static_kv=True))
 
         # final feed forward with residual & norm
-        return self.sublayer[2](out_memory_attn, self.feed_forward)
+        return self.sublayer[2].add_norm(out_memory_attn, self.feed_forward(out_memory_attn))
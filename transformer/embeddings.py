@@ -1,14 +1,6 @@
 import torch
 from torch import nn, Tensor, tensor
 
-# if CUDA available, moves computations to GPU
-if torch.cuda.is_available():
-    device = torch.device('cuda')
-    FloatTensor = torch.cuda.FloatTensor
-else:
-    device = torch.device('cpu')
-    FloatTensor = torch.FloatTensor
-
 
 class Embeddings(nn.Module):
     def __init__(self, d_model: int, vocab_size: int):
@@ -23,7 +15,7 @@ class Embeddings(nn.Module):
         """
         super(Embeddings, self).__init__()
         self.embeddings = nn.Embedding(vocab_size, d_model)
-        self.register_buffer(name='d_model_sqrt', tensor=torch.sqrt(tensor([d_model]).type(FloatTensor)))
+        self.register_buffer(name='d_model_sqrt', tensor=torch.sqrt(tensor([float(d_model)])))
 
     def forward(self, x):
         """
@@ -40,7 +32,7 @@ class Embeddings(nn.Module):
         :return: Embedded x, of shape [x.shape, d_model].
         """
 
-        return self.embeddings(x).type(FloatTensor) * self.d_model_sqrt
+        return self.embeddings(x) * self.d_model_sqrt
 
 
 class PositionalEncoding(nn.Module):
@@ -88,13 +80,13 @@ class PositionalEncoding(nn.Module):
         # dropout layer
         self.dropout = nn.Dropout(p=dropout)
 
-        # Compute the positional encodings once in log space.
-        pos_encoding = torch.zeros(max_len, d_model, device=device)
+        # Compute the positional encodings once in log space (on CPU: the buffer then follows the module with .to()).
+        pos_encoding = torch.zeros(max_len, d_model)
 
-        position = torch.arange(0., max_len, device=device).unsqueeze(1)  # shape will be (max_len, 1)
+        position = torch.arange(0., max_len).unsqueeze(1)  # shape will be (max_len, 1)
 
         # division term: use exponential & log for numerical stability?
-        div_term = torch.exp(torch.arange(0., d_model, 2, device=device) * -(torch.log(tensor([10000.0], device=device)) / d_model))
+        div_term = torch.exp(torch.arange(0., d_model, 2) * -(torch.log(tensor([10000.0])) / d_model))
 
         # even dimension: sinusoid
         pos_encoding[:, 0::2] = torch.sin(position * div_term)
@@ -112,13 +104,16 @@ class PositionalEncoding(nn.Module):
         # indicate positional encoding are not learnable, thus do not need gradients.
         self.pos_encoding.requires_grad = False
 
-    def forward(self, embeddings: Tensor) -> Tensor:
+    def forward(self, embeddings: Tensor, offset=0) -> Tensor:
         """
         Forward pass of the `:py:class:`PositionalEncoding`.
 
         :param embeddings: Input tensor, representing the current word embeddings. Should be of shape (batch_size, seq_len, d_model).
 
+        :param offset: Position of the first element of ``embeddings`` in the sequence. Non-zero when decoding
+            incrementally, i.e. when only the newest positions are embedded.
+
         :return: Sum of embeddings and positional encodings (with dropout applied). Should be the same shape as `embeddings`.
         """
-        # add positional encoding (up to the sequence length) to embeddings
-        return self.dropout(embeddings + self.pos_encoding[:, :embeddings.shape[1]])
+        # add positional encoding (from offset, up to the sequence length) to embeddings
+        return self.dropout(embeddings + self.pos_encoding[:, offset:offset + embeddings.shape[1]])
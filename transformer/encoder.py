@@ -1,8 +1,12 @@
+from typing import Iterable, Union
+
+import torch
 import torch.nn as nn
 from torch import Tensor
+from torch.utils.checkpoint import checkpoint
 
 from transformer.layers import ResidualConnection, LayerNormalization
-from transformer.utils import clone
+from transformer.utils import clone, layer_selection
 
 
 class Encoder(nn.Module):
@@ -12,17 +16,21 @@ class Encoder(nn.Module):
     Constituted of a stack of N identical layers.
     """
 
-    def __init__(self, layer: nn.Module, n_layers: int):
+    def __init__(self, layer: nn.Module, n_layers: int, checkpoint_layers: Union[bool, Iterable[int]] = False):
         """
         Constructor for the global Encoder.
 
         :param layer: layer type to use.
         :param n_layers: Number of layers to use.
+        :param checkpoint_layers: Layers (``True`` for all, or indices) whose activations are recomputed during the
+            backward pass instead of being stored, trading compute for memory (see :py:mod:`torch.utils.checkpoint`).
         """
         # call base constructor
         super(Encoder, self).__init__()
         self.layers = clone(layer, n_layers)
 
+        self.checkpoint_layers = layer_selection(checkpoint_layers, n_layers)
+
         self.norm = LayerNormalization(layer.size)
 
     def forward(self, src: Tensor, mask: Tensor, verbose=False) -> Tensor:
@@ -41,7 +49,10 @@ class Encoder(nn.Module):
         for i, layer in enumerate(self.layers):
             if verbose:
                 print('Going into layer {}'.format(i + 1))
-            src = layer(src, mask)
+            if i in self.checkpoint_layers and self.training and torch.is_grad_enabled():
+                src = checkpoint(layer, src, mask, use_reentrant=False)
+            else:
+                src = layer(src, mask)
 
         return self.norm(src)  # Should not be needed as norm also present at end of EncoderLayer but shouldn't hurt
 
@@ -90,7 +101,7 @@ class EncoderLayer(nn.Module):
 
         """
         # feed input x as key, query, value in self-attention, along with mask
-        attention_out = self.sublayer[0](src, lambda x: self.self_attention(x, x, x, mask))
+        attention_out = self.sublayer[0].add_norm(src, self.self_attention(src, src, src, mask))
 
         # go through feed forward sublayer + residual connection
-        return self.sublayer[1](attention_out, self.feed_forward)
+        return self.sublayer[1].add_norm(attention_out, self.feed_forward(attention_out))
@@ -0,0 +1,130 @@
+from collections import OrderedDict
+
+import torch
+from torch import Tensor
+
+
+class EncoderCache(object):
+    """
+    LRU cache of the ``Encoder`` outputs ("memory") of source sentences, for decoding traffic in which many sentences
+    repeat (e.g. UI strings): the embeddings & ``Encoder`` stack only run for the sentences which are not cached.
+
+    A sentence is keyed by its (non-padding) source token indices, and its memory is stored without the padded
+    positions, so that it can be reused in batches of any padded length. The least recently used sentences are evicted
+    once the stored memories exceed ``max_bytes``.
+
+    The cached memories are only valid for the model (and its weights) they were computed with, in inference mode.
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        Constructor of the :py:class:`EncoderCache` class.
+
+        :param max_bytes: Maximum total size (in bytes) of the cached memories.
+        """
+        self.max_bytes = max_bytes
+        self.bytes = 0
+
+        # sentence key -> memory of the sentence, of shape (n_tokens, d_model), from least to most recently used
+        self.entries = OrderedDict()
+
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    @staticmethod
+    def sentence_key(src: Tensor) -> bytes:
+        """
+        Returns the key of a sentence, from its source tokens (without padding).
+        """
+        return src.cpu().numpy().astype('int32').tobytes()
+
+    def encode(self, model, src: Tensor, src_mask: Tensor) -> Tensor:
+        """
+        Returns the ``Encoder`` output of ``model`` for ``src``, as :py:func:`Transformer.encode`: the cached rows are
+        copied from the cache, the others are encoded together in one smaller batch, and stored in the cache.
+
+        :param model: ``Transformer`` whose memory is cached.
+
+        :param src: Batch of tokenized input sentences. Should be of shape (batch_size, in_seq_len).
+
+        :param src_mask: Mask, hiding the padding in the input batch, of shape (batch_size, 1, in_seq_len).
+
+        :return: Encoder output ("memory"), of shape (batch_size, in_seq_len, d_model). Zeros at the padded positions
+            of the cached rows.
+        """
+        batch_size = src.shape[0]
+        masks = src_mask.view(batch_size, -1)
+        keys = [self.sentence_key(row[mask]) for row, mask in zip(src, masks)]
+
+        # rows to encode: only the first occurrence of each missing sentence
+        cached, missing = {}, {}
+        for i, key in enumerate(keys):
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                cached[i] = self.entries[key]
+                self.hits += 1
+            else:
+                missing.setdefault(key, []).append(i)
+                self.misses += 1
+
+        if not cached:
+            memory = model.encode(src, src_mask)
+        else:
+            memory = None
+            for i, sentence_memory in cached.items():
+                if memory is None:
+                    memory = sentence_memory.new_zeros((batch_size, src.shape[1], sentence_memory.shape[-1]))
+                memory[i, masks[i]] = sentence_memory
+
+            if missing:
+                rows = torch.tensor([indices[0] for indices in missing.values()], device=src.device)
+                memory[rows] = model.encode(src[rows], src_mask[rows])
+
+        for key, indices in missing.items():
+            # duplicates of a missing sentence in the batch share its memory
+            for i in indices[1:]:
+                memory[i] = memory[indices[0]]
+            self.store(key, memory[indices[0], masks[indices[0]]])
+
+        return memory
+
+    def store(self, key: bytes, memory: Tensor) -> None:
+        """
+        Caches the memory of a sentence, evicting the least recently used ones if needed.
+
+        :param key: Key of the sentence, see :py:func:`sentence_key`.
+
+        :param memory: Memory of the sentence (without padding), of shape (n_tokens, d_model).
+        """
+        size = memory.numel() * memory.element_size()
+        if size > self.max_bytes:
+            return
+
+        # copied, so that the memory of the whole batch is not kept alive
+        self.entries[key] = memory.detach().clone()
+        self.bytes += size
+
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted.numel() * evicted.element_size()
+            self.evictions += 1
+
+    def clear(self) -> None:
+        """
+        Empties the cache, e.g. after updating the weights of the model. The counters are kept.
+        """
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self) -> dict:
+        """
+        Returns the counters of the cache: number of hits, misses & evictions (since its creation), number of cached
+        sentences and their total size in bytes.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.entries), 'bytes': self.bytes}
+
+    def __len__(self):
+        """
+        Returns the number of cached sentences.
+        """
+        return len(self.entries)
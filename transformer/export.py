@@ -0,0 +1,78 @@
+import copy
+
+import torch
+import torch.nn as nn
+from torch.export import Dim
+
+from transformer.model import Transformer
+
+
+def compile_model(model: Transformer, dynamic=True, **kwargs) -> Transformer:
+    """
+    Compiles (in place) the layer stacks, embeddings & classifier of ``model`` with ``torch.compile``.
+
+    The compiled modules keep their names & parameters: the model can still be trained, saved and used for decoding
+    (e.g. :py:func:`Transformer.greedy_search`) as usual. The data-dependent logic of the decoding methods stays in
+    eager mode.
+
+    :param model: Model to compile.
+
+    :param dynamic: Whether to compile for dynamic shapes (batch size & sequence lengths vary across batches).
+
+    :param kwargs: Additional arguments for ``torch.compile`` (e.g. ``backend``, ``mode``).
+
+    :return: ``model``.
+    """
+    for module in (model.src_embeddings, model.trg_embeddings, model.encoder, model.decoder, model.classifier):
+        module.compile(dynamic=dynamic, **kwargs)
+
+    return model
+
+
+def export_model(model: Transformer, filename: str) -> str:
+    """
+    Exports the teacher-forcing forward pass of ``model`` (in inference mode, see :py:func:`Transformer.forward`)
+    with ``torch.export``, for dynamic batch size & sequence lengths, and saves it as a standalone artifact: it can
+    be loaded with :py:func:`load_exported` without this code base.
+
+    A decoding step can be computed with the exported model by feeding the whole prefix of the target sequences and
+    keeping the logits of the last position.
+
+    :param model: Model to export. It is not modified.
+
+    :param filename: Path of the artifact to write (usually with a ``.pt2`` extension).
+
+    :return: ``filename``.
+    """
+    model = copy.deepcopy(model).eval()
+    parameter = next(model.parameters())
+
+    # example inputs: the sizes should not be 0 or 1, which would be specialized
+    src = torch.ones((2, 8), dtype=torch.long, device=parameter.device)
+    trg = torch.ones((2, 6), dtype=torch.long, device=parameter.device)
+    src_mask, trg_mask = (src != 0).unsqueeze(-2), (trg != 0).unsqueeze(-2)
+
+    # the sequences can't be longer than the positional encodings: the guard of their `pos_encoding[:, :length]` slice
+    # requires length != pos_encoding.shape[1], hence the upper bound is excluded
+    max_length = model.src_embeddings[1].pos_encoding.shape[1] - 1
+    batch_size = Dim('batch_size')
+    src_length, trg_length = Dim('src_length', max=max_length), Dim('trg_length', max=max_length)
+
+    program = torch.export.export(model, (src, src_mask, trg, trg_mask),
+                                  dynamic_shapes=({0: batch_size, 1: src_length},
+                                                  {0: batch_size, 2: src_length},
+                                                  {0: batch_size, 1: trg_length},
+                                                  {0: batch_size, 2: trg_length}))
+    torch.export.save(program, filename)
+    return filename
+
+
+def load_exported(filename: str) -> nn.Module:
+    """
+    Loads a model exported with :py:func:`export_model`.
+
+    :param filename: Path of the artifact.
+
+    :return: Module computing the logits from ``(src_sequences, src_mask, trg_sequences, trg_mask)``.
+    """
+    return torch.export.load(filename).module()
@@ -5,12 +5,6 @@ import torch.nn.functional as F
 
 from transformer.attention import MultiHeadAttention
 
-# if CUDA available, moves computations to GPU
-if torch.cuda.is_available():
-    device = torch.device('cuda')
-else:
-    device = torch.device('cpu')
-
 
 class PositionwiseFeedForward(nn.Module):
     """
@@ -68,25 +62,35 @@ class LayerNormalization(nn.Module):
 
     .. math::
 
-        h = \\frac{a}{\\sigma} \\cdot (x − \\mu ) + b
+        h = \\frac{a}{\\sigma + \\epsilon} \\cdot (x − \\mu ) + b
+
+    Where a, b are learnable parameters,  \sigma & \mu are the (unbiased) standard deviation & mean of x.
+
+    Two backends are available:
 
-    Where a, b are learnable parameters,  \sigma & \mu are the standard deviation & mean of x.
+        - ``exact`` (default): computes the equation above as is. Reproduces the results of the existing checkpoints.
+        - ``fused``: uses the native (fused) layer norm kernel, which computes :math:`\\sqrt{\\sigma_b^2 + \\epsilon}`
+          with the biased variance :math:`\\sigma_b^2`. The gain ``a`` is rescaled by :math:`\\sqrt{(n-1) / n}` to
+          compensate, so that both backends only differ by the placement of :math:`\\epsilon` and share the same
+          parameters.
     """
 
-    def __init__(self, size: int, eps=1e-6):
+    def __init__(self, size: int, eps=1e-6, fused=False):
         """
         Constructor for the ``LayerNormalization`` class.
 
         :param size: Size of the tensor which will be normalized.
         :param eps: small epsilon value (to avoid ``ZeroDivisionError`` errors)
+        :param fused: Whether to use the fused backend. Can be changed after instantiation.
         """
         super(LayerNormalization, self).__init__()
 
-        # instantiate the learnable parameters, with appropriate device
-        self.a_2 = nn.Parameter(torch.ones(size, device=device))
-        self.b_2 = nn.Parameter(torch.zeros(size, device=device))
+        # instantiate the learnable parameters (moved with the module by ``.to()``)
+        self.a_2 = nn.Parameter(torch.ones(size))
+        self.b_2 = nn.Parameter(torch.zeros(size))
 
         self.eps = eps
+        self.fused = fused
 
     def forward(self, x: Tensor) -> Tensor:
         """
@@ -96,6 +100,11 @@ class LayerNormalization(nn.Module):
 
         :return: normalized x.
         """
+        if self.fused:
+            size = x.shape[-1]
+            # the fused kernel divides by the biased std: rescale the gain to divide by the unbiased one
+            return F.layer_norm(x, (size,), weight=self.a_2 * ((size - 1) / size) ** 0.5, bias=self.b_2, eps=self.eps)
+
         mean, std = x.mean(dim=-1, keepdim=True), x.std(dim=-1, keepdim=True)
 
         return self.a_2 * (x - mean) / (std + self.eps) + self.b_2
@@ -144,8 +153,22 @@ class ResidualConnection(nn.Module):
 
         :return: Normalized tensor after the residual connection.
         """
-        ""
-        return self.norm(x + self.dropout(sublayer(x)))
+        return self.add_norm(x, sublayer(x))
+
+    def add_norm(self, x: Tensor, sublayer_output: Tensor) -> Tensor:
+        """
+        Apply the residual connection to the (already computed) output of a sublayer.
+
+        Equivalent to :py:func:`forward`, without having to wrap the sublayer call in a function, which keeps
+        the layers easy to compile (e.g. with ``torch.compile``).
+
+        :param x: Input tensor of the sublayer, summed with the residual and normalized.
+
+        :param sublayer_output: Output of the sublayer for ``x``.
+
+        :return: Normalized tensor after the residual connection.
+        """
+        return self.norm(x + self.dropout(sublayer_output))
 
 
 if __name__ == '__main__':
@@ -5,25 +5,15 @@ from typing import Optional, Union
 import torch
 import torch.nn as nn
 from datetime import datetime
-from transformer.utils import subsequent_mask
+from transformer.utils import detokenize
 from transformer.encoder import Encoder, EncoderLayer
 from transformer.decoder import Decoder, DecoderLayer
 from transformer.attention import MultiHeadAttention
-from transformer.layers import PositionwiseFeedForward
-from transformer.classifier import OutputClassifier
+from transformer.layers import PositionwiseFeedForward, LayerNormalization
+from transformer.classifier import AdaptiveOutputClassifier, OutputClassifier
 from transformer.embeddings import Embeddings, PositionalEncoding
-
-# if CUDA available, change some tensor types to move computations to GPU
-if torch.cuda.is_available():
-    device = torch.device('cuda')
-    FloatTensor = torch.cuda.FloatTensor
-    LongTensor = torch.cuda.LongTensor
-    IntTensor = torch.cuda.IntTensor
-else:
-    device = torch.device('cpu')
-    FloatTensor = torch.FloatTensor
-    LongTensor = torch.LongTensor
-    IntTensor = torch.IntTensor
+from transformer.encoder_cache import EncoderCache
+from transformer.shortlist import Shortlist
 
 
 class Transformer(nn.Module):
@@ -50,12 +40,44 @@ class Transformer(nn.Module):
                 'attention': {'n_head': 8,
                               'd_k': 64,
                               'd_v': 64,
-                              'dropout': 0.1},
+                              'dropout': 0.1,
+                              'fused_qkv': False,
+                              'block_size': None},
 
                 'feed-forward': {'d_ff': 2048,
                                  'dropout': 0.1},
+
+                'layer_norm': 'exact',
+                'tie_embeddings': False,
+                'classifier': {'type': 'dense'},
+
+                'checkpointing': {'encoder': False,
+                                  'decoder': False},
             }
 
+        Optional parameters:
+
+            - ``params['attention']['fused_qkv']``: Whether to fuse the Q, K, V projections of the self-attentions\
+             (resp. the K, V projections of the memory-attentions) in one matrix product. Default: ``False``.
+            - ``params['attention']['block_size']``: If not ``None``, the attentions are computed by blocks of\
+             ``block_size`` queries & keys, bounding their memory use for long sequences. Default: ``None``.
+            - ``params['layer_norm']``: Backend of the ``LayerNormalization`` layers: ``'exact'`` reproduces the\
+             results of existing checkpoints, ``'fused'`` uses the native layer norm kernel. Default: ``'exact'``.
+            - ``params['tie_embeddings']``: Whether the source embeddings, target embeddings & the weight of the\
+             output classifier share the same matrix. Requires a shared source / target vocabulary (see the\
+             ``shared_vocab`` argument of ``IWSLTDatasetBuilder.build``). Default: ``False``.
+            - ``params['checkpointing']['encoder' | 'decoder']``: Layers of each stack (``True`` for all, or list of\
+             indices) whose activations are recomputed during the backward pass instead of being stored, to reduce\
+             the activation memory when training. Default: ``False``.
+            - ``params['attention']['n_heads']`` & ``params['feed-forward']['d_ffs']``: Per-layer number of heads\
+             (resp. hidden size) of some sublayers, keyed by their name in the layers (e.g.\
+             ``{'encoder.self_attention': [8, 6, 7, 8, 5, 8]}``, ``{'decoder.feed_forward': [...]}``), in place of\
+             ``n_head`` (resp. ``d_ff``). Set when pruning a model, see :py:mod:`transformer.pruning`.
+            - ``params['classifier']``: Output layer: ``{'type': 'dense'}`` for the :py:class:`OutputClassifier`, or\
+             ``{'type': 'adaptive', 'cutoffs': [2000, 10000], 'div_value': 4.0}`` for the\
+             :py:class:`AdaptiveOutputClassifier`, to be trained with ``AdaptiveSoftmaxLoss`` (not compatible with\
+             ``tie_embeddings``). Default: ``{'type': 'dense'}``.
+
         """
         # call base constructor
         super(Transformer, self).__init__()
@@ -63,40 +85,62 @@ class Transformer(nn.Module):
         # Save params for Checkpoint
         self._params = params
 
+        # Symbols of the source & target vocabularies ({'src': itos, 'trg': itos}). Saved in the checkpoints when set,
+        # so that raw text can be translated without rebuilding the dataset (e.g. by the translation server).
+        self.vocabs = None
+
+        fused_qkv = params['attention'].get('fused_qkv', False)
+        block_size = params['attention'].get('block_size', None)
+
+        def attention(n_head: int, fused: Optional[str], causal=False) -> MultiHeadAttention:
+            return MultiHeadAttention(n_head=n_head,
+                                      d_model=params['d_model'],
+                                      d_k=params['attention']['d_k'],
+                                      d_v=params['attention']['d_v'],
+                                      dropout=params['attention']['dropout'],
+                                      fused=fused if fused_qkv else None,
+                                      block_size=block_size, causal=causal)
+
+        def feed_forward(d_ff: int) -> PositionwiseFeedForward:
+            return PositionwiseFeedForward(d_model=params['d_model'],
+                                           d_ff=d_ff,
+                                           dropout=params['feed-forward']['dropout'])
+
         # instantiate Encoder layer
         enc_layer = EncoderLayer(size=params['d_model'],
-                                 self_attention=MultiHeadAttention(n_head=params['attention']['n_head'],
-                                                                   d_model=params['d_model'],
-                                                                   d_k=params['attention']['d_k'],
-                                                                   d_v=params['attention']['d_v'],
-                                                                   dropout=params['attention']['dropout']),
-                                 feed_forward=PositionwiseFeedForward(d_model=params['d_model'],
-                                                                      d_ff=params['feed-forward']['d_ff'],
-                                                                      dropout=params['feed-forward']['dropout']),
+                                 self_attention=attention(params['attention']['n_head'], fused='qkv'),
+                                 feed_forward=feed_forward(params['feed-forward']['d_ff']),
                                  dropout=params['dropout'])
 
         # instantiate Encoder
-        self.encoder = Encoder(layer=enc_layer, n_layers=params['N'])
+        checkpointing = params.get('checkpointing', {})
+        self.encoder = Encoder(layer=enc_layer, n_layers=params['N'],
+                               checkpoint_layers=checkpointing.get('encoder', False))
 
         # instantiate Decoder layer
         decoder_layer = DecoderLayer(size=params['d_model'],
-                                     self_attn=MultiHeadAttention(n_head=params['attention']['n_head'],
-                                                                   d_model=params['d_model'],
-                                                                   d_k=params['attention']['d_k'],
-                                                                   d_v=params['attention']['d_v'],
-                                                                   dropout=params['attention']['dropout']),
-                                     memory_attn=MultiHeadAttention(n_head=params['attention']['n_head'],
-                                                                   d_model=params['d_model'],
-                                                                   d_k=params['attention']['d_k'],
-                                                                   d_v=params['attention']['d_v'],
-                                                                   dropout=params['attention']['dropout']),
-                                     feed_forward=PositionwiseFeedForward(d_model=params['d_model'],
-                                                                      d_ff=params['feed-forward']['d_ff'],
-                                                                      dropout=params['feed-forward']['dropout']),
+                                     self_attn=attention(params['attention']['n_head'], fused='qkv', causal=True),
+                                     memory_attn=attention(params['attention']['n_head'], fused='kv'),
+                                     feed_forward=feed_forward(params['feed-forward']['d_ff']),
                                      dropout=params['dropout'])
 
         # instantiate Decoder
-        self.decoder = Decoder(layer=decoder_layer, N=params['N'])
+        self.decoder = Decoder(layer=decoder_layer, N=params['N'],
+                               checkpoint_layers=checkpointing.get('decoder', False))
+
+        # per-layer sizes (e.g. of a pruned model, see transformer.pruning), replacing the default ones
+        n_heads = params['attention'].get('n_heads', {})
+        d_ffs = params['feed-forward'].get('d_ffs', {})
+        for stack_name, stack in (('encoder', self.encoder), ('decoder', self.decoder)):
+            for i, layer in enumerate(stack.layers):
+                for name, module in list(layer.named_children()):
+                    key = f"{stack_name}.{name}"
+                    if isinstance(module, MultiHeadAttention) and key in n_heads:
+                        setattr(layer, name, attention(n_heads[key][i],
+                                                       fused='kv' if name == 'memory_attn' else 'qkv',
+                                                       causal=module.attention.causal))
+                    elif isinstance(module, PositionwiseFeedForward) and key in d_ffs:
+                        setattr(layer, name, feed_forward(d_ffs[key][i]))
 
         pos_encoding = PositionalEncoding(d_model=params['d_model'], dropout=params['dropout'])
 
@@ -106,13 +150,63 @@ class Transformer(nn.Module):
         self.trg_embeddings = nn.Sequential(Embeddings(d_model=params['d_model'], vocab_size=params['tgt_vocab_size']),
                                             pos_encoding)
 
-        self.classifier = OutputClassifier(d_model=params['d_model'], vocab=params['tgt_vocab_size'])
+        classifier = params.get('classifier', {'type': 'dense'})
+        if classifier['type'] == 'dense':
+            self.classifier = OutputClassifier(d_model=params['d_model'], vocab=params['tgt_vocab_size'])
+        elif classifier['type'] == 'adaptive':
+            self.classifier = AdaptiveOutputClassifier(d_model=params['d_model'], vocab=params['tgt_vocab_size'],
+                                                       cutoffs=classifier['cutoffs'],
+                                                       div_value=classifier.get('div_value', 4.0))
+        else:
+            raise ValueError(f"Unknown classifier type '{classifier['type']}', expected 'dense' or 'adaptive'.")
+
+        # the adaptive softmax scores are only computed by the loss (training) or when decoding
+        self.adaptive_softmax = classifier['type'] == 'adaptive'
+
+        if params.get('tie_embeddings', False):
+            if self.adaptive_softmax:
+                raise ValueError("The embeddings can't be tied with the adaptive softmax classifier.")
+            if params['src_vocab_size'] != params['tgt_vocab_size']:
+                raise ValueError("Tying the embeddings requires a shared source / target vocabulary, got "
+                                 f"src_vocab_size={params['src_vocab_size']} and "
+                                 f"tgt_vocab_size={params['tgt_vocab_size']}.")
+
+            # one (vocab_size, d_model) matrix for the 3 layers: also shared in the optimizer state & checkpoints
+            shared_weight = self.src_embeddings[0].embeddings.weight
+            self.trg_embeddings[0].embeddings.weight = shared_weight
+            self.classifier.linear1.weight = shared_weight
+
+        self.set_layer_norm_backend(params.get('layer_norm', 'exact'))
 
         # Initialize parameters with Glorot / fan_avg.
         for p in self.parameters():
             if p.dim() > 1:
                 nn.init.xavier_uniform_(p)
 
+        # Fused projections are initialized as the separate Q, K, V projections they replace.
+        for module in self.modules():
+            if isinstance(module, MultiHeadAttention) and module.fused is not None:
+                fused = module.w_qkv if module.fused == 'qkv' else module.w_kvs
+                for weight in fused.weight.data.chunk(3 if module.fused == 'qkv' else 2, dim=0):
+                    nn.init.xavier_uniform_(weight)
+
+    def set_layer_norm_backend(self, backend: str) -> None:
+        """
+        Sets the backend of all the ``LayerNormalization`` layers of the model.
+
+        Both backends share the same parameters, so this can be called on a trained model (e.g. to use the fused
+        kernels for decoding). See :py:class:`LayerNormalization`.
+
+        :param backend: ``'exact'`` or ``'fused'``.
+        """
+        if backend not in ('exact', 'fused'):
+            raise ValueError(f"Unknown layer norm backend: {backend}, expected 'exact' or 'fused'.")
+
+        self._params['layer_norm'] = backend
+        for module in self.modules():
+            if isinstance(module, LayerNormalization):
+                module.fused = backend == 'fused'
+
     def forward(self, src_sequences, src_mask, trg_sequences, trg_mask) -> torch.Tensor:
         """
         Main forward pass of the model. Simplified worfklow:
@@ -129,53 +223,447 @@ class Transformer(nn.Module):
 
         :param trg_sequences: Batch of output sentences. Should be of shape (batch_size, out_seq_len).
 
-        :param trg_mask: Mask, hiding the padding in the output batch. Should be the same shape as trg_sequences.
+        :param trg_mask: Mask, hiding the padding in the output batch. Should be of shape (batch_size, 1, out_seq_len).
 
         .. note::
 
-            This mask (which hides padding) will be combined with the `subsequent_mask` which hides subsequent
-            positions in the decoder, to form only one mask.
+            The subsequent positions are hidden by the self-attention of the decoder itself (see the ``causal``
+            argument of :py:class:`MultiHeadAttention`): there is no need to combine this mask with the
+            `subsequent_mask`, which avoids materializing a (batch_size, out_seq_len, out_seq_len) mask per batch.
 
 
-        :return: Logits, of shape (batch_size, out_seq_len, d_model)
+        :return: Logits, of shape (batch_size, out_seq_len, tgt_vocab_size). With the adaptive softmax classifier,\
+            the ``Decoder`` outputs instead, of shape (batch_size, out_seq_len, d_model), from which\
+            ``AdaptiveSoftmaxLoss`` only computes the log-probabilities of the targets.
         """
 
-        # 1. embed the input batch: have to move input sequences to torch.*.LongTensor
-        src_sequences = self.src_embeddings(src_sequences.type(LongTensor))
+        # 1. embed the input batch (the sequences should be on the same device as the model)
+        src_sequences = self.src_embeddings(src_sequences.long())
 
         # 2. encoder stack
         encoder_output = self.encoder(src=src_sequences, mask=src_mask, verbose=False)
 
-        # 3. get subsequent mask to hide subsequent positions in the decoder.
-        # self_mask = subsequent_mask(trg_sequences.shape[1])
-
-        # 3.5 Combine the trg_mask (which hides padding) and self_mask (which hide subsequent positions in the decoder)
-        # as one mask
-
-        # hide_padding_and_future_words_mask = trg_mask.type_as(self_mask.data) & self_mask
+        # 3. embed the output batch
+        trg_sequences = self.trg_embeddings(trg_sequences.long())
 
-        # 4. embed the output batch
-        trg_sequences = self.trg_embeddings(trg_sequences.type(LongTensor))
-
-        # 4. decoder stack
+        # 4. decoder stack: hides the subsequent positions itself
         decoder_output = self.decoder(x=trg_sequences, memory=encoder_output,
                                       self_mask=trg_mask, memory_mask=src_mask)
 
+        if self.adaptive_softmax:
+            return decoder_output
+
         # 5. classifier
         logits = self.classifier(decoder_output)
 
         return logits
 
-    def greedy_decode(self, src: torch.Tensor, src_mask: torch.Tensor, trg_vocab, start_symbol="<s>", stop_symbol="</s>", max_length=100) -> torch.Tensor:
+    def encode(self, src: torch.Tensor, src_mask: torch.Tensor) -> torch.Tensor:
         """
-        Returns the prediction for `src` using greedy decoding for simplicity:
+        Embeds ``src`` and feeds it through the ``Encoder`` stack.
 
-            - Feed `src` (after embedding) in the Encoder to get the "memory",
-            - Feed an initial tensor (filled with start_symbol) in the Decoder, with the "memory" and the appropriate corresponding mask
-            - Get the predictions of the model, makes a max to get the next token, cat it to the previous prediction and iterate
+        :param src: Batch of tokenized input sentences. Should be of shape (batch_size, in_seq_len).
 
+        :param src_mask: Mask, hiding the padding in the input batch.
 
-        :param src: sample for which to produce predictions.
+        :return: Encoder output ("memory"), of shape (batch_size, in_seq_len, d_model).
+        """
+        embedded = self.src_embeddings(src.long())
+        return self.encoder(src=embedded, mask=src_mask)
+
+    def embed_target(self, trg: torch.Tensor, offset=0) -> torch.Tensor:
+        """
+        Embeds a batch of target tokens, starting at position ``offset`` for the positional encodings.
+
+        :param trg: Batch of target tokens, of shape (batch_size, seq_len).
+
+        :param offset: Position of ``trg[:, 0]`` in the target sequence (non-zero when decoding incrementally).
+
+        :return: Embedded ``trg``, of shape (batch_size, seq_len, d_model).
+        """
+        embeddings, pos_encoding = self.trg_embeddings
+        return pos_encoding(embeddings(trg.long()), offset=offset)
+
+    @torch.no_grad()
+    def greedy_search(self, src: torch.Tensor, src_mask: torch.Tensor, start_index: int,
+                      stop_index: Optional[int] = None, pad_index: Optional[int] = None, max_length=100,
+                      max_length_ratio: Optional[float] = None, max_length_offset=10,
+                      use_cache=True, shortlist: Optional[Shortlist] = None,
+                      encoder_cache: Optional[EncoderCache] = None) -> torch.Tensor:
+        """
+        Greedily predicts the target tokens for ``src``: at each step, the most likely token is appended to
+        the previous predictions.
+
+        With ``use_cache=True``, the ``Decoder`` keeps the keys & values of the previous positions (and the projected
+        ``Encoder`` memory) of each layer, so that only the newest token goes through the stack at each step.
+        Otherwise, the whole prefix is re-embedded and fed through the ``Decoder`` at every step.
+
+        A sentence is finished once it predicts ``stop_index`` or reaches its maximum length: it is then removed
+        from the batch fed to the ``Decoder``, and decoding stops once all sentences are finished.
+
+        :param src: Batch of tokenized input sentences. Should be of shape (batch_size, in_seq_len).
+
+        :param src_mask: Associated `src` mask.
+
+        :param start_index: Index of the start symbol in the target vocab, used as initial value for the Decoder.
+
+        :param stop_index: Index of the end of sentence symbol in the target vocab. If ``None``, sentences are only
+            finished when reaching their maximum length.
+
+        :param pad_index: Index used to pad the finished sentences. Defaults to ``stop_index``.
+
+        :param max_length: Maximum number of tokens to predict.
+
+        :param max_length_ratio: If not ``None``, the maximum number of tokens to predict for a sentence is
+            further capped to ``ceil(max_length_ratio * src_length) + max_length_offset``.
+
+        :param max_length_offset: See ``max_length_ratio``.
+
+        :param use_cache: Whether to decode incrementally (see above).
+
+        :param shortlist: If not ``None``, the ``OutputClassifier`` only scores the candidate tokens of the batch
+            given by this :py:class:`Shortlist` (plus ``stop_index``), instead of the whole target vocabulary.
+
+        :param encoder_cache: If not ``None``, the ``Encoder`` outputs of the sentences already in this
+            :py:class:`EncoderCache` are reused, and the other sentences are encoded and cached.
+
+        :return: Predicted tokens, of shape (batch_size, seq_len), starting with ``start_index``.\
+            ``seq_len`` is at most ``max_length + 1``.
+        """
+        batch_size = src.shape[0]
+
+        # 1. Embed & encode src
+        src_mask = src_mask.view(batch_size, 1, -1)
+        memory = self.encode(src, src_mask) if encoder_cache is None else encoder_cache.encode(self, src, src_mask)
+
+        # 2. Get the maximum number of tokens to predict for each sentence
+        limits = torch.full((batch_size,), max_length, dtype=torch.long, device=memory.device)
+        if max_length_ratio is not None:
+            src_lengths = src_mask.view(batch_size, -1).sum(dim=-1)
+            limits = torch.min(limits, (src_lengths.float() * max_length_ratio).ceil().long() + max_length_offset)
+        n_steps = int(limits.max())
+
+        # 3. Create the output tensor, and the initial input for decoder
+        if pad_index is None:
+            pad_index = stop_index if stop_index is not None else start_index
+        tokens = torch.full((batch_size, n_steps + 1), pad_index, dtype=torch.long, device=memory.device)
+        tokens[:, 0] = start_index
+        decoder_in = tokens[:, :1]
+
+        # indices (in the batch) of the sentences still being decoded
+        active = torch.arange(batch_size, device=memory.device)
+
+        cache = self.decoder.init_cache() if use_cache else None
+
+        if shortlist is not None:
+            if self.adaptive_softmax:
+                raise ValueError("The vocabulary shortlist requires the dense classifier.")
+            candidates = shortlist.candidates(src, required=[stop_index] if stop_index is not None else [])
+            classifier = self.classifier.shortlist(candidates)
+
+        for i in range(n_steps):
+
+            # 4. Go through decoder
+            if use_cache:
+                # only the last predicted token is new, the previous positions are cached
+                out = self.decoder(x=self.embed_target(decoder_in[:, -1:], offset=i), memory=memory,
+                                   self_mask=None, memory_mask=src_mask, cache=cache)
+            else:
+                out = self.decoder(x=self.embed_target(decoder_in), memory=memory,
+                                   self_mask=None, memory_mask=src_mask)
+
+            # 5. classifier: only the last position is used to predict the next token
+            if shortlist is not None:
+                next_token = candidates[classifier(out[:, -1]).argmax(dim=-1)]
+            else:
+                next_token = self.classifier.predict(out[:, -1])
+
+            # 6. Save the predicted token of each active sentence & concatenate it with previous predictions
+            tokens[active, i + 1] = next_token
+            decoder_in = torch.cat([decoder_in, next_token.unsqueeze(1)], dim=1)
+
+            # 7. Remove the finished sentences from the batch
+            finished = limits[active] <= i + 1
+            if stop_index is not None:
+                finished |= next_token == stop_index
+
+            if finished.any():
+                keep = (~finished).nonzero().squeeze(1)
+                if keep.numel() == 0:
+                    return tokens[:, :i + 2]
+
+                active, memory, src_mask, decoder_in = [t.index_select(0, keep)
+                                                        for t in (active, memory, src_mask, decoder_in)]
+                if use_cache:
+                    self.decoder.reorder_cache(cache, keep, memory=True)
+
+        return tokens
+
+    @torch.no_grad()
+    def speculative_search(self, src: torch.Tensor, src_mask: torch.Tensor, draft: 'Transformer', start_index: int,
+                           stop_index: Optional[int] = None, pad_index: Optional[int] = None, max_length=100,
+                           n_draft_tokens=4, statistics: Optional[dict] = None) -> torch.Tensor:
+        """
+        Greedy search accelerated by speculative decoding (see https://arxiv.org/abs/2211.17192): at each step, a
+        smaller ``draft`` model greedily proposes ``n_draft_tokens`` tokens, which this model checks in a single
+        pass of its ``Decoder`` over all of them. The longest prefix of the proposals matching its own greedy
+        predictions is accepted, followed by its prediction at the first mismatch (or after the last proposal).
+        The predictions are thus the same as :py:func:`greedy_search`, with fewer passes of the large ``Decoder``.
+
+        The sentences of a batch advance together: the number of accepted proposals is the smallest one among the
+        unfinished sentences, so the speed-up is the largest for small batches.
+
+        :param src: Batch of tokenized input sentences. Should be of shape (batch_size, in_seq_len).
+
+        :param src_mask: Associated `src` mask.
+
+        :param draft: Draft model, sharing the target vocabulary of this model.
+
+        :param start_index: Index of the start symbol in the target vocab, used as initial value for the Decoders.
+
+        :param stop_index: Index of the end of sentence symbol in the target vocab. If ``None``, sentences are only
+            finished when reaching ``max_length``.
+
+        :param pad_index: Index used to pad the finished sentences. Defaults to ``stop_index``.
+
+        :param max_length: Maximum number of tokens to predict.
+
+        :param n_draft_tokens: Number of tokens proposed by the draft model at each step.
+
+        :param statistics: If not ``None``, dict in which the numbers of proposed (``'drafted'``) & accepted
+            (``'accepted'``) tokens of the sentences, and the number of passes of the ``Decoder`` (``'passes'``)
+            are accumulated.
+
+        :return: Predicted tokens, of shape (batch_size, seq_len), starting with ``start_index``.\
+            ``seq_len`` is at most ``max_length + 1``.
+        """
+        if draft._params['tgt_vocab_size'] != self._params['tgt_vocab_size']:
+            raise ValueError(f"The draft model has a target vocabulary of {draft._params['tgt_vocab_size']} tokens, "
+                             f"expected {self._params['tgt_vocab_size']}.")
+
+        batch_size = src.shape[0]
+
+        # 1. Embed & encode src, with both models
+        src_mask = src_mask.view(batch_size, 1, -1)
+        memory, draft_memory = self.encode(src, src_mask), draft.encode(src, src_mask)
+
+        # 2. Create the output tensor, and the committed tokens of the sentences being decoded
+        if pad_index is None:
+            pad_index = stop_index if stop_index is not None else start_index
+        tokens = torch.full((batch_size, max_length + 1), pad_index, dtype=torch.long, device=memory.device)
+        tokens[:, 0] = start_index
+        decoder_in = tokens[:, :1]
+
+        active = torch.arange(batch_size, device=memory.device)
+
+        # the cache of this model holds all the committed positions but the last one, the draft cache may lag behind
+        cache, draft_cache = self.decoder.init_cache(), draft.decoder.init_cache()
+        draft_length = 0
+
+        while decoder_in.shape[1] <= max_length:
+            length = decoder_in.shape[1]
+            # the verification pass always commits one more token than the accepted proposals
+            n_proposals = min(n_draft_tokens, max_length - length)
+
+            # 3. The draft model proposes n_proposals tokens (after catching up with the committed ones)
+            proposals = decoder_in[:, length:]
+            draft_in = decoder_in[:, draft_length:]
+            for _ in range(n_proposals):
+                out = draft.decoder(x=draft.embed_target(draft_in, offset=draft_length), memory=draft_memory,
+                                    self_mask=None, memory_mask=src_mask, cache=draft_cache)
+                draft_length += draft_in.shape[1]
+                draft_in = draft.classifier.predict(out[:, -1]).unsqueeze(1)
+                proposals = torch.cat([proposals, draft_in], dim=1)
+
+            # 4. This model predicts the token following the last committed one & each proposal, in one pass
+            out = self.decoder(x=self.embed_target(torch.cat([decoder_in[:, -1:], proposals], dim=1),
+                                                   offset=length - 1),
+                               memory=memory, self_mask=None, memory_mask=src_mask, cache=cache)
+            predictions = self.classifier.predict(out)
+
+            # 5. Number of accepted proposals: those matching the predictions, up to the first mismatch
+            accepted = (proposals == predictions[:, :n_proposals]).long().cumprod(dim=1).sum(dim=1)
+            n_accepted = accepted
+            if stop_index is not None:
+                # a sentence finished within its accepted tokens does not hold the others back
+                is_stop = predictions == stop_index
+                first_stop = torch.where(is_stop.any(dim=1), is_stop.long().argmax(dim=1), n_proposals + 1)
+                n_accepted = torch.where(first_stop <= accepted, n_proposals, accepted)
+            n_accepted = int(n_accepted.min())
+
+            if statistics is not None:
+                statistics['drafted'] = statistics.get('drafted', 0) + n_proposals * decoder_in.shape[0]
+                statistics['accepted'] = statistics.get('accepted', 0) + int(accepted.sum())
+                statistics['passes'] = statistics.get('passes', 0) + 1
+
+            # 6. Commit the accepted proposals & the following prediction, i.e. the first n_accepted + 1 predictions
+            committed = predictions[:, :n_accepted + 1]
+            tokens[active, length:length + n_accepted + 1] = committed
+            decoder_in = torch.cat([decoder_in, committed], dim=1)
+
+            # the positions of the rejected proposals are dropped from the caches
+            self.decoder.truncate_cache(cache, length + n_accepted)
+            draft_length = min(draft_length, length + n_accepted)
+            draft.decoder.truncate_cache(draft_cache, draft_length)
+
+            # 7. Remove the finished sentences from the batch
+            if stop_index is not None:
+                finished = (committed == stop_index).any(dim=1)
+                if finished.any():
+                    keep = (~finished).nonzero().squeeze(1)
+                    if keep.numel() == 0:
+                        break
+
+                    active, memory, draft_memory, src_mask, decoder_in = [
+                        t.index_select(0, keep) for t in (active, memory, draft_memory, src_mask, decoder_in)]
+                    self.decoder.reorder_cache(cache, keep, memory=True)
+                    draft.decoder.reorder_cache(draft_cache, keep, memory=True)
+
+        tokens = tokens[:, :decoder_in.shape[1]]
+
+        # 8. Pad the tokens committed after the stop symbol (in the same step as it)
+        if stop_index is not None:
+            is_stop = tokens[:, 1:] == stop_index
+            after_stop = is_stop.long().cumsum(dim=1) - is_stop.long() > 0
+            tokens[:, 1:].masked_fill_(after_stop, pad_index)
+
+            # as greedy_search, up to the last predicted stop symbol
+            tokens = tokens[:, :1 + int((~after_stop).sum(dim=1).max())]
+
+        return tokens
+
+    @staticmethod
+    def length_penalty(lengths: torch.Tensor, alpha: float) -> torch.Tensor:
+        """
+        Length normalization term of https://arxiv.org/abs/1609.08144:
+
+        .. math::
+
+            lp(Y) = \\frac{(5 + |Y|)^{\\alpha}}{(5 + 1)^{\\alpha}}
+
+        :param lengths: Number of predicted tokens of each hypothesis.
+
+        :param alpha: Strength of the normalization. ``0`` means no normalization.
+
+        :return: Tensor of same shape as ``lengths``, by which to divide the log-probabilities.
+        """
+        return ((5. + lengths.float()) / 6.) ** alpha
+
+    @torch.no_grad()
+    def beam_search(self, src: torch.Tensor, src_mask: torch.Tensor, start_index: int, stop_index: int,
+                    beam_size=4, max_length=100, length_penalty=0.6, n_best=1,
+                    encoder_cache: Optional[EncoderCache] = None):
+        """
+        Predicts the target tokens for ``src`` with beam search.
+
+        The whole batch is decoded at once: the ``beam_size`` hypotheses of each sentence are stacked along the batch
+        dimension, so that each step is a single (incremental) pass through the ``Decoder`` for
+        ``batch_size * beam_size`` hypotheses.
+
+            - Hypotheses are ranked by their log-probability divided by :py:func:`length_penalty`,
+            - A hypothesis is finished once it predicts ``stop_index``: it then keeps its score and length,
+            - Decoding stops once all hypotheses are finished, or after ``max_length`` steps.
+
+        :param src: Batch of tokenized input sentences. Should be of shape (batch_size, in_seq_len).
+
+        :param src_mask: Associated `src` mask.
+
+        :param start_index: Index of the start symbol in the target vocab, used as initial value for the Decoder.
+
+        :param stop_index: Index of the end of sentence symbol in the target vocab.
+
+        :param beam_size: Number of hypotheses kept for each sentence.
+
+        :param max_length: Maximum number of tokens to predict.
+
+        :param length_penalty: ``alpha`` parameter of :py:func:`length_penalty`.
+
+        :param n_best: Number of hypotheses to return for each sentence (should be <= ``beam_size``).
+
+        :param encoder_cache: If not ``None``, cache of the ``Encoder`` outputs, see :py:func:`greedy_search`.
+
+        :return: tuple (tokens, scores):
+
+            - tokens: LongTensor of shape (batch_size, n_best, seq_len), starting with ``start_index``.\
+              Finished hypotheses are padded with ``stop_index``.
+            - scores: Normalized log-probabilities of the hypotheses, of shape (batch_size, n_best), sorted in\
+              decreasing order.
+        """
+        assert n_best <= beam_size, "Cannot return more than beam_size={} hypotheses.".format(beam_size)
+
+        batch_size = src.shape[0]
+
+        # 1. Embed & encode src
+        src_mask = src_mask.view(batch_size, 1, -1)
+        memory = self.encode(src, src_mask) if encoder_cache is None else encoder_cache.encode(self, src, src_mask)
+
+        # 2. Expand memory & mask: hypotheses (batch_idx, beam_idx) are stored at index batch_idx * beam_size + beam_idx
+        memory = memory.repeat_interleave(beam_size, dim=0)
+        src_mask = src_mask.repeat_interleave(beam_size, dim=0)
+        beam_offsets = (torch.arange(batch_size, device=memory.device) * beam_size).unsqueeze(1)
+
+        tokens = torch.full((batch_size * beam_size, 1), start_index, dtype=torch.long, device=memory.device)
+
+        # Only the first hypothesis is alive at the start: the others would be duplicates of it
+        scores = torch.full((batch_size, beam_size), -float('inf'), device=memory.device)
+        scores[:, 0] = 0.
+        lengths = torch.zeros((batch_size, beam_size), dtype=torch.long, device=memory.device)
+        finished = torch.zeros((batch_size, beam_size), dtype=torch.bool, device=memory.device)
+
+        cache = self.decoder.init_cache()
+
+        for i in range(max_length):
+
+            # 3. Go through decoder with the last predicted tokens
+            out = self.decoder(x=self.embed_target(tokens[:, -1:], offset=i), memory=memory,
+                               self_mask=None, memory_mask=src_mask, cache=cache)
+
+            log_probs = torch.log_softmax(self.classifier(out[:, -1]).float(), dim=-1)
+            vocab_size = log_probs.shape[-1]
+            log_probs = log_probs.view(batch_size, beam_size, vocab_size)
+
+            # 4. Finished hypotheses can only be extended with the stop symbol, at no cost
+            log_probs.masked_fill_(finished.unsqueeze(-1), -float('inf'))
+            log_probs[..., stop_index].masked_fill_(finished, 0.)
+
+            candidates = scores.unsqueeze(-1) + log_probs
+            candidate_lengths = (lengths + (~finished).long()).unsqueeze(-1)
+
+            # 5. Keep the best beam_size candidates of each sentence, in terms of normalized score
+            normalized = candidates / self.length_penalty(candidate_lengths, length_penalty)
+            _, best = normalized.view(batch_size, -1).topk(beam_size, dim=-1)
+
+            beam_idx, next_token = best // vocab_size, best % vocab_size
+
+            scores = candidates.view(batch_size, -1).gather(1, best)
+            lengths = candidate_lengths.squeeze(-1).gather(1, beam_idx)
+            finished = finished.gather(1, beam_idx) | (next_token == stop_index)
+
+            # 6. Reorder the hypotheses (and their cached keys & values) according to the selected beams
+            reorder = (beam_offsets + beam_idx).view(-1)
+            tokens = torch.cat([tokens.index_select(0, reorder), next_token.view(-1, 1)], dim=1)
+            self.decoder.reorder_cache(cache, reorder)
+
+            if finished.all():
+                break
+
+        # 7. Return the n_best hypotheses of each sentence
+        normalized = scores / self.length_penalty(lengths, length_penalty)
+        best_scores, best = normalized.topk(n_best, dim=-1)
+
+        tokens = tokens.view(batch_size, beam_size, -1)
+        tokens = tokens.gather(1, best.unsqueeze(-1).expand(-1, -1, tokens.shape[-1]))
+
+        return tokens, best_scores
+
+    def greedy_decode_batch(self, src: torch.Tensor, src_mask: torch.Tensor, trg_vocab, start_symbol="<s>",
+                            stop_symbol="</s>", pad_symbol="<blank>", max_length=100,
+                            max_length_ratio: Optional[float] = None, max_length_offset=10, use_cache=True,
+                            shortlist: Optional[Shortlist] = None, encoder_cache: Optional[EncoderCache] = None):
+        """
+        Translates a batch of sentences using greedy decoding (see :py:func:`greedy_search`).
+
+        :param src: Batch of tokenized input sentences. Should be of shape (batch_size, in_seq_len).
 
         :param src_mask: Associated `src` mask
 
@@ -186,53 +674,73 @@ class Transformer(nn.Module):
 
         :param stop_symbol: Symbol used to represent an end of sentence, e.g. "</s>" (in the dataset vocab).
 
-        :param max_length: Maximum sequence length of the prediction.
+        :param pad_symbol: Symbol used to pad the finished sentences, e.g. "<blank>" (in the dataset vocab).
+
+        :param max_length: Maximum sequence length of the predictions.
+
+        :param max_length_ratio: If not ``None``, caps the length of each prediction relatively to the length of the
+            corresponding input sentence. See :py:func:`greedy_search`.
+
+        :param max_length_offset: See :py:func:`greedy_search`.
 
+        :param use_cache: Whether to decode incrementally, i.e. only feed the newest token to the Decoder at each step.
+
+        :param shortlist: If not ``None``, vocabulary shortlist restricting the scored target tokens, see
+            :py:func:`greedy_search`.
+
+        :param encoder_cache: If not ``None``, cache of the ``Encoder`` outputs, see :py:func:`greedy_search`.
+
+        :return: tuple (tokens, translations): the predicted tokens, of shape (batch_size, seq_len), and the list of
+            the corresponding ``batch_size`` sentences.
         """
         # 0. Ensure inference mode
         self.eval()
 
-        # 1. Embed src
-        embedded = self.src_embeddings(src.type(LongTensor))
+        # 1-7. Predict the target tokens
+        tokens = self.greedy_search(src, src_mask, start_index=trg_vocab.stoi[start_symbol],
+                                    stop_index=trg_vocab.stoi[stop_symbol], pad_index=trg_vocab.stoi[pad_symbol],
+                                    max_length=max_length, max_length_ratio=max_length_ratio,
+                                    max_length_offset=max_length_offset, use_cache=use_cache,
+                                    shortlist=shortlist, encoder_cache=encoder_cache)
 
-        # 2. Encode embedded inputs
-        memory = self.encoder(src=embedded, mask=src_mask)
+        # 8. retrieve words from tokens in the target vocab
+        translations = detokenize(tokens, trg_vocab, stop_symbol=stop_symbol,
+                                  ignored_symbols=(start_symbol, pad_symbol))
 
-        # 3. Create initial input for decoder
-        decoder_in = torch.ones(src.shape[0], 1).type(FloatTensor) * trg_vocab.stoi[start_symbol]
+        return tokens, translations
 
-        for i in range(max_length):
+    def greedy_decode(self, src: torch.Tensor, src_mask: torch.Tensor, trg_vocab, start_symbol="<s>", stop_symbol="</s>",
+                      max_length=100, use_cache=True) -> str:
+        """
+        Returns the prediction for `src` using greedy decoding for simplicity:
+
+            - Feed `src` (after embedding) in the Encoder to get the "memory",
+            - Feed an initial tensor (filled with start_symbol) in the Decoder, with the "memory" and the appropriate corresponding mask
+            - Get the predictions of the model, makes a max to get the next token, cat it to the previous prediction and iterate
 
-            # 4. Embed decoder_in
-            decoder_in_embed = self.trg_embeddings(decoder_in.type(LongTensor))
+        Only the translation of the first sentence in `src` is returned: use :py:func:`greedy_decode_batch` to get
+        all of them.
+
+        :param src: sample for which to produce predictions.
 
-            # 5. Go through decoder
-            out = self.decoder(x=decoder_in_embed, memory=memory,
-                               self_mask=subsequent_mask(decoder_in.shape[1]),
-                               memory_mask=src_mask)
+        :param src_mask: Associated `src` mask
 
-            # 6. classifier: TODO: Why only last word?
-            logits = self.classifier(out[:, -1])
+        :param trg_vocab: Vocabulary set of the target sentences.
+        :type trg_vocab: torchtext.vocab.Vocab
 
-            # 7. Get predicted token for each sample in the batch
-            _, next_token = logits.max(dim=1, keepdim=True)
+        :param start_symbol: Symbol used as initial value for the Decoder. Should correspond to start_token="<s>" in the dataset vocab).
 
-            # 8. Concatenate predicted token with previous predictions
-            decoder_in = torch.cat([decoder_in, next_token.type(FloatTensor)], dim=1)
+        :param stop_symbol: Symbol used to represent an end of sentence, e.g. "</s>" (in the dataset vocab).
 
-        # cast to int tensors
-        decoder_in = decoder_in.type(IntTensor)
-        # 9. retrieve words from tokens in the target vocab
-        translation = ""
-        for i in range( decoder_in.shape[1]):
-            sym = trg_vocab.itos[decoder_in[0, i]]
-            translation += sym + " "
+        :param max_length: Maximum sequence length of the prediction.
 
-            if sym == trg_vocab.stoi[stop_symbol]:
-                break
+        :param use_cache: Whether to decode incrementally, i.e. only feed the newest token to the Decoder at each step.
 
-        # 10. return prediction
-        return translation
+        """
+        _, translations = self.greedy_decode_batch(src, src_mask, trg_vocab, start_symbol=start_symbol,
+                                                   stop_symbol=stop_symbol, max_length=max_length,
+                                                   use_cache=use_cache)
+        return translations[0]
 
     def save(self, model_dir: str, epoch_idx: int, loss_value: float, model_name: str = None) -> str:
         """
@@ -258,6 +766,8 @@ class Transformer(nn.Module):
             'epoch': epoch_idx,
             'loss': loss_value,
         }
+        if self.vocabs is not None:
+            chkpt['vocabs'] = self.vocabs
 
         if model_name is None:
             model_name = f"model_epoch_{epoch_idx}.pt"
@@ -285,6 +795,7 @@ class Transformer(nn.Module):
 
         # Load model.
         self.load_state_dict(checkpoint['state_dict'])
+        self.vocabs = checkpoint.get('vocabs', self.vocabs)
 
         # Print statistics.
         if logger is not None:
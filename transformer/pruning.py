@@ -0,0 +1,251 @@
+import copy
+import math
+from typing import Dict, Iterable, Iterator, Tuple
+
+import torch
+import torch.nn as nn
+from torch import Tensor
+
+from transformer.attention import MultiHeadAttention, capture_attention_weights
+from transformer.layers import PositionwiseFeedForward
+from transformer.model import Transformer
+
+
+def prunable_sublayers(model: Transformer) -> Iterator[Tuple[str, int, str, nn.Module]]:
+    """
+    Iterates over the ``MultiHeadAttention`` & ``PositionwiseFeedForward`` sublayers of the encoder & decoder layers.
+
+    :return: Iterator of (key, layer index, full module name, module), where key is the name of the sublayer in
+        its stack (e.g. ``'decoder.memory_attn'``, as in ``params['attention']['n_heads']``).
+    """
+    for stack_name, stack in (('encoder', model.encoder), ('decoder', model.decoder)):
+        for i, layer in enumerate(stack.layers):
+            for name, module in layer.named_children():
+                if isinstance(module, (MultiHeadAttention, PositionwiseFeedForward)):
+                    yield f"{stack_name}.{name}", i, f"{stack_name}.layers.{i}.{name}", module
+
+
+def compute_importance(model: Transformer, batches: Iterable, loss_fn: nn.Module,
+                       max_batches=None) -> Dict[str, Dict[str, Tensor]]:
+    """
+    Scores the heads of each ``MultiHeadAttention`` & the hidden neurons of each ``PositionwiseFeedForward`` of
+    ``model`` on held-out batches:
+
+        - ``'gradient'``: Gradient-based importance (see https://arxiv.org/abs/1905.10650): each head output (resp.
+          neuron) is multiplied by a gate equal to 1, and the importance is the accumulated absolute value of the
+          gradient of the loss w.r.t. this gate, i.e. the estimated loss variation when removing it.
+        - ``'entropy'`` (heads only): Average entropy of the attention weights of each head, normalized by the
+          log of the number of keys (1 for uniform attention, which tends to carry little information).
+
+    :param model: Model to score. Its parameters are not modified (and get no gradient).
+
+    :param batches: Iterable of masked batches (see ``IWSLTDatasetBuilder.masked``), on the device of the model.
+
+    :param loss_fn: Loss function, taking the logits & the shifted targets.
+
+    :param max_batches: If not ``None``, maximum number of batches to use.
+
+    :return: Dict {full module name: {'gradient': Tensor, 'entropy': Tensor}}, with tensors of shape (n_head,) for
+        the attentions and (d_ff,) for the feed-forwards (without entropy).
+    """
+    model.eval()
+    device = next(model.parameters()).device
+
+    importance = {}
+    gates, hooks = {}, []
+    for _, _, name, module in prunable_sublayers(model):
+        if isinstance(module, MultiHeadAttention):
+            gate = torch.ones(module.n_head, device=device, requires_grad=True)
+            hooks.append(module.fc.register_forward_pre_hook(_gate_heads(gate)))
+            importance[name] = {'gradient': torch.zeros(module.n_head, device=device),
+                                'entropy': torch.zeros(module.n_head, device=device)}
+        else:
+            gate = torch.ones(module.linear_2.in_features, device=device, requires_grad=True)
+            hooks.append(module.linear_2.register_forward_pre_hook(_gate_neurons(gate)))
+            importance[name] = {'gradient': torch.zeros(module.linear_2.in_features, device=device)}
+        gates[name] = gate
+
+    def accumulate_entropy(attention_name: str, weights: Tensor) -> None:
+        # entropy of the attention distribution of each query, normalized by its maximum: log(n_keys)
+        entropy = -(weights * weights.clamp_min(1e-12).log()).sum(dim=-1) / math.log(max(weights.shape[-1], 2))
+        # average over the batch & the queries: (n_head,)
+        importance[attention_name[:-len('.attention')]]['entropy'] += entropy.mean(dim=(0, 2))
+
+    # only the gradients w.r.t. the gates are needed
+    requires_grad = [p.requires_grad for p in model.parameters()]
+    for p in model.parameters():
+        p.requires_grad_(False)
+
+    n_batches = 0
+    try:
+        with capture_attention_weights(model, accumulate_entropy):
+            for batch in batches:
+                if max_batches is not None and n_batches >= max_batches:
+                    break
+
+                logits = model(batch.src, batch.src_mask, batch.trg, batch.trg_mask)
+                loss_fn(logits, batch.trg_shifted).backward()
+
+                for name, gate in gates.items():
+                    importance[name]['gradient'] += gate.grad.abs()
+                    gate.grad = None
+                n_batches += 1
+    finally:
+        for hook in hooks:
+            hook.remove()
+        for p, flag in zip(model.parameters(), requires_grad):
+            p.requires_grad_(flag)
+
+    for scores in importance.values():
+        for key in scores:
+            scores[key] /= max(n_batches, 1)
+
+    return importance
+
+
+def _gate_heads(gate: Tensor):
+    """
+    Forward pre-hook of the output layer of a ``MultiHeadAttention``, multiplying the output of each head by ``gate``.
+    """
+    def hook(module, inputs):
+        x = inputs[0]
+        return (x.view(*x.shape[:-1], gate.shape[0], -1) * gate.unsqueeze(-1)).flatten(-2)
+
+    return hook
+
+
+def _gate_neurons(gate: Tensor):
+    """
+    Forward pre-hook of the second layer of a ``PositionwiseFeedForward``, multiplying each hidden neuron by ``gate``.
+    """
+    def hook(module, inputs):
+        return inputs[0] * gate
+
+    return hook
+
+
+def combined_scores(importance: Dict[str, Dict[str, Tensor]], entropy_weight=0.5) -> Dict[str, Tensor]:
+    """
+    Combines the importance measures of :py:func:`compute_importance` into one score per head / neuron (the higher,
+    the more important).
+
+    In each sublayer, the gradient-based importance is normalized by its maximum. For the heads, it is then mixed
+    with ``1 - entropy``: ``score = (1 - entropy_weight) * gradient + entropy_weight * (1 - entropy)``.
+
+    :return: Dict {full module name: scores}.
+    """
+    scores = {}
+    for name, measures in importance.items():
+        gradient = measures['gradient'] / measures['gradient'].max().clamp_min(1e-12)
+        if 'entropy' in measures:
+            scores[name] = (1 - entropy_weight) * gradient + entropy_weight * (1 - measures['entropy'])
+        else:
+            scores[name] = gradient
+
+    return scores
+
+
+def prune_heads(attention: MultiHeadAttention, heads: Tensor) -> MultiHeadAttention:
+    """
+    Builds a smaller copy of ``attention``, only keeping ``heads``: the rows of the Q, K, V projections and the columns
+    of the output layer ``fc`` corresponding to the other heads are removed.
+
+    :param attention: ``MultiHeadAttention`` to prune (not modified), with any layout of its projections.
+
+    :param heads: LongTensor of the indices of the heads to keep.
+
+    :return: New ``MultiHeadAttention`` with ``len(heads)`` heads, and the same layout.
+    """
+    d_model, device = attention.fc.out_features, attention.fc.weight.device
+    heads = heads.sort()[0].cpu()
+
+    # get the separate Q, K, V projections, whatever the layout of attention
+    separate = MultiHeadAttention(attention.n_head, d_model, attention.d_k, attention.d_v)
+    separate.load_state_dict(attention.state_dict())
+    separate_state = separate.state_dict()
+
+    def rows(d: int) -> Tensor:
+        return (heads.unsqueeze(1) * d + torch.arange(d)).flatten()
+
+    state = {}
+    for name, d in (('w_qs', attention.d_k), ('w_ks', attention.d_k), ('w_vs', attention.d_v)):
+        for param in ('weight', 'bias'):
+            state[f"{name}.{param}"] = separate_state[f"{name}.{param}"][rows(d)]
+    state['fc.weight'] = separate_state['fc.weight'][:, rows(attention.d_v)]
+    state['fc.bias'] = separate_state['fc.bias']
+
+    pruned = MultiHeadAttention(len(heads), d_model, attention.d_k, attention.d_v,
+                                dropout=attention.attention.dropout.p, fused=attention.fused,
+                                block_size=attention.attention.block_size, causal=attention.attention.causal)
+    # converted to the layout of pruned when loading
+    pruned.load_state_dict(state)
+
+    return pruned.to(device)
+
+
+def prune_neurons(feed_forward: PositionwiseFeedForward, neurons: Tensor) -> PositionwiseFeedForward:
+    """
+    Builds a smaller copy of ``feed_forward``, only keeping the hidden ``neurons``: the corresponding rows of
+    ``linear_1`` and columns of ``linear_2`` are kept.
+
+    :param feed_forward: ``PositionwiseFeedForward`` to prune (not modified).
+
+    :param neurons: LongTensor of the indices of the hidden neurons to keep.
+
+    :return: New ``PositionwiseFeedForward``, of hidden size ``len(neurons)``.
+    """
+    neurons = neurons.sort()[0].to(feed_forward.linear_1.weight.device)
+
+    pruned = PositionwiseFeedForward(d_model=feed_forward.linear_1.in_features, d_ff=len(neurons),
+                                     dropout=feed_forward.dropout.p)
+    pruned.load_state_dict({'linear_1.weight': feed_forward.linear_1.weight[neurons],
+                            'linear_1.bias': feed_forward.linear_1.bias[neurons],
+                            'linear_2.weight': feed_forward.linear_2.weight[:, neurons],
+                            'linear_2.bias': feed_forward.linear_2.bias})
+
+    return pruned.to(feed_forward.linear_1.weight.device)
+
+
+def prune_model(model: Transformer, scores: Dict[str, Tensor], head_ratio=0., neuron_ratio=0.) -> Transformer:
+    """
+    Builds a smaller copy of ``model``, removing the least important heads & hidden neurons of each sublayer.
+
+    The per-layer numbers of heads & hidden neurons are recorded in the params of the returned model
+    (``params['attention']['n_heads']`` & ``params['feed-forward']['d_ffs']``), so that its checkpoints can be
+    loaded with ``Transformer.load_model_from_file``.
+
+    :param model: Model to prune (not modified).
+
+    :param scores: Importance scores of the heads & neurons, see :py:func:`combined_scores`.
+
+    :param head_ratio: Fraction of the heads to remove in each attention (at least one head is kept).
+
+    :param neuron_ratio: Fraction of the hidden neurons to remove in each feed-forward (at least one is kept).
+
+    :return: The pruned model, in the same (training or evaluation) mode as ``model``.
+    """
+    pruned = copy.deepcopy(model)
+    params = copy.deepcopy(model._params)
+    n_heads, d_ffs = {}, {}
+
+    for key, i, name, module in list(prunable_sublayers(pruned)):
+        layer = (pruned.encoder if key.startswith('encoder') else pruned.decoder).layers[i]
+        sublayer_name = key.split('.')[1]
+
+        ratio = head_ratio if isinstance(module, MultiHeadAttention) else neuron_ratio
+        n_keep = max(1, len(scores[name]) - int(ratio * len(scores[name])))
+        keep = scores[name].topk(n_keep)[1]
+
+        if isinstance(module, MultiHeadAttention):
+            setattr(layer, sublayer_name, prune_heads(module, keep))
+            n_heads.setdefault(key, []).append(n_keep)
+        else:
+            setattr(layer, sublayer_name, prune_neurons(module, keep))
+            d_ffs.setdefault(key, []).append(n_keep)
+
+    params['attention']['n_heads'] = n_heads
+    params['feed-forward']['d_ffs'] = d_ffs
+    pruned._params = params
+
+    # the new sublayers are created in training mode
+    return pruned.train(model.training)
@@ -0,0 +1,107 @@
+import copy
+import logging
+from datetime import datetime
+from typing import List, Optional
+
+import torch
+import torch.nn as nn
+import torch.ao.nn.quantized.dynamic as nnqd
+from torch.ao.quantization import quantize_dynamic
+
+from transformer.attention import MultiHeadAttention
+from transformer.classifier import OutputClassifier
+from transformer.layers import PositionwiseFeedForward
+from transformer.model import Transformer
+
+# modules whose nn.Linear layers are quantized
+QUANTIZED_MODULES = (MultiHeadAttention, PositionwiseFeedForward, OutputClassifier)
+
+
+def quantizable_layers(model: nn.Module) -> List[str]:
+    """
+    Returns the names of the linear layers (float or already quantized) of ``model`` which are part of a
+    ``MultiHeadAttention``, ``PositionwiseFeedForward`` or ``OutputClassifier`` module.
+    """
+    names = []
+    for module_name, module in model.named_modules():
+        if isinstance(module, QUANTIZED_MODULES):
+            names += [f"{module_name}.{name}" for name, child in module.named_children()
+                      if isinstance(child, (nn.Linear, nnqd.Linear))]
+
+    return names
+
+
+def quantize_model(model: Transformer) -> Transformer:
+    """
+    Builds an inference (CPU only) copy of ``model``, whose ``nn.Linear`` layers (see :py:func:`quantizable_layers`)
+    are replaced by int8 dynamically quantized layers: the weights are stored in int8, the activations are quantized
+    on the fly, per batch.
+
+    .. note::
+
+        The quantized layers do not expose their weights as ``Parameter``: the fused Q, K, V projections of the
+        self-attentions are only usable when the queries, keys & values are the same tensor, which is always the
+        case in the ``Transformer``.
+
+    :param model: Float ``Transformer`` to quantize. It is not modified.
+
+    :return: The quantized ``Transformer``, in inference mode.
+    """
+    float_model = copy.deepcopy(model).cpu().eval()
+
+    return quantize_dynamic(float_model, qconfig_spec=set(quantizable_layers(float_model)), dtype=torch.qint8,
+                            inplace=True)
+
+
+def save_quantized(model: Transformer, filename: str, source: Optional[str] = None) -> str:
+    """
+    Saves a model quantized with :py:func:`quantize_model`. The checkpoint can only be loaded back with
+    :py:func:`load_quantized`, as its ``state_dict`` contains packed int8 weights.
+
+    :param model: Quantized model.
+
+    :param filename: Path of the checkpoint to write.
+
+    :param source: Path of the float checkpoint ``model`` was quantized from, kept for information.
+
+    :return: ``filename``.
+    """
+    chkpt = {
+        'name': 'QuantizedTransformer',
+        'params': model._params,
+        'quantization': {'dtype': 'qint8', 'layers': quantizable_layers(model)},
+        'state_dict': model.state_dict(),
+        'model_timestamp': datetime.now(),
+        'source': source,
+    }
+
+    torch.save(chkpt, filename)
+    return filename
+
+
+def load_quantized(checkpoint_file: str, logger: Optional[logging.Logger] = None) -> Transformer:
+    """
+    Loads a model saved with :py:func:`save_quantized`.
+
+    :param checkpoint_file: The path to the checkpoint file.
+
+    :param logger: An optional logger to log information about the checkpoint.
+
+    :return: The quantized ``Transformer``, in inference mode.
+    """
+    checkpoint = torch.load(checkpoint_file, map_location='cpu')
+    if checkpoint.get('name') != 'QuantizedTransformer':
+        raise ValueError(f"{checkpoint_file} is not a quantized checkpoint, "
+                         "please use `Transformer.load_model_from_file` instead.")
+
+    # create the quantized layers, then load their int8 weights
+    model = Transformer(checkpoint['params'])
+    model.eval()
+    model = quantize_dynamic(model, qconfig_spec=set(checkpoint['quantization']['layers']), dtype=torch.qint8)
+    model.load_state_dict(checkpoint['state_dict'])
+
+    if logger is not None:
+        logger.info(f"Imported quantized Transformer from checkpoint from {checkpoint['model_timestamp']} "
+                    f"(source: {checkpoint['source']})")
+
+    return model
@@ -0,0 +1,182 @@
+from typing import Iterable, Sequence, Tuple
+
+import numpy as np
+import torch
+from torch import Tensor
+
+
+class Shortlist(object):
+    """
+    Vocabulary shortlist for the output projection during decoding (see e.g. https://arxiv.org/abs/1606.08584): the
+    target tokens of a batch are very likely to be among
+
+        - the likely translations of its source tokens, given by a lexical translation table, and
+        - the most frequent target tokens (punctuation, articles, ...),
+
+    so that the ``OutputClassifier`` only needs to score these candidate rows, instead of the whole vocabulary.
+
+    The lexical table is built from the co-occurrences of the source & target tokens in the sentence pairs of the
+    training corpus: the translations of a source token are the target tokens with the highest Dice coefficient
+    ``2 * count(s, t) / (count(s) + count(t))``, where the counts are numbers of sentence pairs.
+    """
+
+    def __init__(self, translations: Tensor, frequent: Tensor):
+        """
+        Constructor of the :py:class:`Shortlist` class. See :py:func:`build` to create it from a corpus.
+
+        :param translations: LongTensor of shape (src_vocab_size, n_translations), the translations of each source
+            token (padded with -1 when there are fewer).
+
+        :param frequent: LongTensor of the most frequent target tokens.
+        """
+        self.translations = translations
+        self.frequent = frequent
+
+    @classmethod
+    def build(cls, pairs: Iterable[Tuple[Sequence[int], Sequence[int]]], src_vocab_size: int, trg_vocab_size: int,
+              n_translations=10, n_frequent=100, chunk_size=10000) -> 'Shortlist':
+        """
+        Builds the shortlist from a parallel corpus.
+
+        :param pairs: Iterable of (source token indices, target token indices), e.g. the numericalized training set.
+
+        :param src_vocab_size: Size of the source vocabulary.
+
+        :param trg_vocab_size: Size of the target vocabulary.
+
+        :param n_translations: Number of translations kept per source token, among the target tokens which are not
+            in the most frequent ones.
+
+        :param n_frequent: Number of most frequent target tokens, always in the candidates.
+
+        :param chunk_size: Number of sentence pairs whose co-occurrences are counted at once (bounds the memory use).
+        """
+        src_counts = np.zeros(src_vocab_size, dtype=np.int64)
+        trg_counts = np.zeros(trg_vocab_size, dtype=np.int64)
+        trg_frequencies = np.zeros(trg_vocab_size, dtype=np.int64)
+
+        # sparse co-occurrence counts, as sorted keys (src * trg_vocab_size + trg) & their counts
+        keys, counts = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        chunk = []
+
+        def merge(keys: np.ndarray, counts: np.ndarray, chunk: list) -> Tuple[np.ndarray, np.ndarray]:
+            all_keys = np.concatenate([keys] + chunk)
+            all_counts = np.concatenate([counts, np.ones(len(all_keys) - len(keys), dtype=np.int64)])
+            merged_keys, inverse = np.unique(all_keys, return_inverse=True)
+            return merged_keys, np.bincount(inverse, weights=all_counts).astype(np.int64)
+
+        for src, trg in pairs:
+            trg = np.asarray(trg, dtype=np.int64)
+            np.add.at(trg_frequencies, trg, 1)
+
+            # each pair counts once per (source token, target token) type
+            src, trg = np.unique(np.asarray(src, dtype=np.int64)), np.unique(trg)
+            src_counts[src] += 1
+            trg_counts[trg] += 1
+            chunk.append((src[:, None] * trg_vocab_size + trg[None, :]).ravel())
+
+            if len(chunk) >= chunk_size:
+                keys, counts = merge(keys, counts, chunk)
+                chunk = []
+
+        if chunk:
+            keys, counts = merge(keys, counts, chunk)
+
+        frequent = np.argsort(-trg_frequencies, kind='stable')[:n_frequent]
+
+        # the frequent tokens are always candidates: the translations are chosen among the other ones
+        src_tokens, trg_tokens = keys // trg_vocab_size, keys % trg_vocab_size
+        not_frequent = ~np.isin(trg_tokens, frequent)
+        src_tokens, trg_tokens, counts = src_tokens[not_frequent], trg_tokens[not_frequent], counts[not_frequent]
+        dice = 2 * counts / (src_counts[src_tokens] + trg_counts[trg_tokens])
+
+        # sort by source token, then by decreasing score (ties: rarer target token first, then lower index), and keep
+        # the first n_translations of each source token
+        order = np.lexsort((trg_tokens, trg_counts[trg_tokens], -dice, src_tokens))
+        src_tokens, trg_tokens = src_tokens[order], trg_tokens[order]
+        starts = np.searchsorted(src_tokens, src_tokens, side='left')
+        ranks = np.arange(len(src_tokens)) - starts
+        kept = ranks < n_translations
+
+        translations = np.full((src_vocab_size, n_translations), -1, dtype=np.int64)
+        translations[src_tokens[kept], ranks[kept]] = trg_tokens[kept]
+
+        return cls(torch.from_numpy(translations), torch.from_numpy(frequent))
+
+    def candidates(self, src: Tensor, required: Iterable[int] = ()) -> Tensor:
+        """
+        Returns the candidate target tokens for a batch: the union of the translations of its source tokens, the
+        most frequent target tokens and the ``required`` ones (e.g. the end of sentence token).
+
+        :param src: Source token indices, of any shape (padding tokens only add their translations, if any).
+
+        :param required: Target tokens to always include.
+
+        :return: Sorted LongTensor of the candidate target tokens, on the device of ``src``.
+        """
+        # gathered on the device of the table, only the candidates are moved to the device of src
+        device = self.translations.device
+        candidates = torch.cat([self.translations[src.unique().to(device)].flatten(),
+                                self.frequent,
+                                torch.tensor(list(required), dtype=torch.long, device=device)])
+
+        return candidates[candidates >= 0].unique().to(src.device)
+
+    def to(self, device) -> 'Shortlist':
+        """
+        Moves the tables of the shortlist to ``device`` (e.g. the device of the model), in place.
+        """
+        self.translations, self.frequent = self.translations.to(device), self.frequent.to(device)
+        return self
+
+    def save(self, filename: str) -> None:
+        """
+        Saves the shortlist to ``filename``.
+        """
+        torch.save({'translations': self.translations, 'frequent': self.frequent}, filename)
+
+    @classmethod
+    def load(cls, filename: str) -> 'Shortlist':
+        """
+        Loads a shortlist saved with :py:func:`save`.
+        """
+        saved = torch.load(filename)
+        return cls(saved['translations'], saved['frequent'])
+
+
+def shortlist_recall(model, batches: Iterable, shortlist: Shortlist, padding_token: int,
+                     required: Iterable[int] = ()) -> Tuple[float, float]:
+    """
+    Measures how often the full-vocabulary argmax of ``model`` is among the candidates of ``shortlist``, on the
+    (teacher-forced) target positions of ``batches``: when it is, decoding with the shortlist predicts the same token.
+
+    :param model: ``Transformer`` to evaluate.
+
+    :param batches: Iterable of masked batches (see ``IWSLTDatasetBuilder.masked``), on the device of the model.
+
+    :param shortlist: Shortlist to evaluate.
+
+    :param padding_token: Padding token of the target sentences, whose positions are ignored.
+
+    :param required: Target tokens always included in the candidates, see :py:func:`Shortlist.candidates`.
+
+    :return: (recall, average number of candidates per batch).
+    """
+    model.eval()
+    n_hits, n_positions, n_candidates, n_batches = 0, 0, 0, 0
+    with torch.no_grad():
+        for batch in batches:
+            predictions = model(batch.src, batch.src_mask, batch.trg, batch.trg_mask).argmax(dim=-1)
+            candidates = shortlist.candidates(batch.src, required)
+
+            # candidates is sorted: a prediction is a candidate iff it is found at its insertion position
+            positions = torch.searchsorted(candidates, predictions).clamp_max(len(candidates) - 1)
+            hits = candidates[positions] == predictions
+
+            mask = batch.trg_shifted != padding_token
+            n_hits += int((hits & mask).sum())
+            n_positions += int(mask.sum())
+            n_candidates += len(candidates)
+            n_batches += 1
+
+    return n_hits / max(n_positions, 1), n_candidates / max(n_batches, 1)
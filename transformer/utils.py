@@ -1,15 +1,10 @@
 import copy
+from typing import Iterable, List, Set, Union
 
 import numpy as np
 import torch
 import torch.nn as nn
 
-# if CUDA available, moves computations to GPU
-if torch.cuda.is_available():
-    device = torch.device('cuda')
-else:
-    device = torch.device('cpu')
-
 
 def clone(module, N) -> nn.ModuleList:
     """
@@ -18,21 +13,91 @@ def clone(module, N) -> nn.ModuleList:
     return nn.ModuleList([copy.deepcopy(module) for _ in range(N)])
 
 
-def subsequent_mask(size):
+def layer_selection(layers: Union[bool, Iterable[int]], n_layers: int) -> Set[int]:
+    """
+    Converts a selection of layers of a stack (e.g. the layers to checkpoint) to a set of layer indices.
+
+    :param layers: ``True`` for all the layers, ``False`` (or ``None``) for none of them, or indices of layers\
+     (negative indices count from the end of the stack).
+    :param n_layers: Number of layers in the stack.
+    :return: Set of layer indices, in ``[0, n_layers)``.
+    """
+    if layers is None or layers is False:
+        return set()
+    if layers is True:
+        return set(range(n_layers))
+
+    indices = set()
+    for index in layers:
+        if not -n_layers <= index < n_layers:
+            raise IndexError(f"Layer index {index} out of range for a stack of {n_layers} layers.")
+        indices.add(index % n_layers)
+
+    return indices
+
+
+# device -> boolean mask of shape (1, max_size, max_size) hiding subsequent positions, see subsequent_mask
+_subsequent_masks = {}
+
+
+def subsequent_mask(size: int, device=None) -> torch.Tensor:
     """
     Masks out subsequent positions.
 
     The mask shows the position each tgt word (row) is allowed to look at (column).
     Words are blocked for attending to future words during training.
 
+    The mask is only created once per device (and grown when a larger size is requested): the returned tensor is a
+    view on it, which should not be modified in place.
+
     :param size: Input size
-    :return: Tensor with boolean mask on subsequent position
+    :param device: Device on which to return the mask (e.g. the device of the sequences to mask). Default: CPU.
+    :return: Boolean Tensor of shape (1, size, size), ``True`` where attending is allowed (i.e. on & below the diagonal)
+    """
+    device = torch.device(device if device is not None else 'cpu')
+
+    mask = _subsequent_masks.get(device)
+    if mask is None or mask.shape[-1] < size:
+        # grow geometrically to avoid re-creating the mask for slightly longer sequences
+        max_size = max(size, 2 * mask.shape[-1] if mask is not None else 128)
+        mask = torch.ones((1, max_size, max_size), dtype=torch.bool, device=device).tril()
+        _subsequent_masks[device] = mask
+
+    return mask[:, :size, :size]
+
+
+def detokenize(tokens: torch.Tensor, vocab, stop_symbol="</s>", ignored_symbols: Iterable[str] = ("<s>", "<blank>")) -> List[str]:
     """
-    attn_shape = (1, size, size)
-    # pylint: disable=no-member
-    subsequent_mask = np.triu(np.ones(attn_shape), k=1)  # Upper triangle of an array.
+    Retrieves the sentences corresponding to a batch of tokens.
+
+    All tokens are looked up in ``vocab.itos`` at once, then each sentence is cut at its first ``stop_symbol``.
+
+    :param tokens: Tensor of shape (batch_size, seq_len), e.g. the output of
+        :py:func:`transformer.model.Transformer.greedy_search`.
+
+    :param vocab: Vocabulary set of the tokens.
+    :type vocab: torchtext.vocab.Vocab
+
+    :param stop_symbol: Symbol used to represent an end of sentence (excluded from the returned sentences).
+
+    :param ignored_symbols: Symbols left out of the returned sentences (e.g. start & padding symbols).
+
+    :return: List of ``batch_size`` sentences, whose words are separated by spaces.
+    """
+    # array of the symbols, to look up whole batches of tokens at once
+    itos = np.array(vocab.itos, dtype=object)
+
+    tokens = tokens.cpu().numpy()
+
+    # position of the first stop symbol of each sentence (or its length if there is none)
+    is_stop = tokens == vocab.stoi[stop_symbol]
+    lengths = np.where(is_stop.any(axis=1), is_stop.argmax(axis=1), tokens.shape[1])
+
+    # look up all words at once & hide the ignored ones
+    words = itos[tokens]
+    keep = ~np.isin(tokens, [vocab.stoi[symbol] for symbol in ignored_symbols])
 
-    return torch.from_numpy(subsequent_mask).to(device) == 0
+    return [' '.join(words[i, :length][keep[i, :length]]) for i, length in enumerate(lengths)]
 
 
 class BColors:
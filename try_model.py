@@ -1,4 +1,5 @@
 import argparse
+from collections import defaultdict
 
 import torch
 
@@ -18,18 +19,11 @@ def get_args():
     return args
 
 
-if __name__ == '__main__':
-    args = get_args()
-    batch_size = 1024
-    smoothing = 0.
-    print("Loading dataset...")
-    _, val_iterator, _, src_vocab, trg_vocab = (
-        IWSLTDatasetBuilder.build(language_pair=LanguagePair.fr_en,
-                                  split=Split.Validation,
-                                  max_length=40, batch_size_train=batch_size)
-    )
-    print(f"Loading model from '{args.model_path}'...")
-    model = Transformer.load_model_from_file(args.model_path, params={
+def default_params(src_vocab, trg_vocab) -> dict:
+    """
+    Model params used when the checkpoint does not contain them.
+    """
+    return {
         'd_model': 512,
         'N': 6,
         'dropout': 0.1,
@@ -46,12 +40,54 @@ if __name__ == '__main__':
             'd_ff': 2048,
             'dropout': 0.1
         }
-    })
+    }
 
-    print("Computing loss on validation set...")
-    loss_fn = LabelSmoothingLoss(size=len(trg_vocab),
-                                 padding_token=src_vocab.stoi['<blank>'],
-                                 smoothing=smoothing)
+
+def load_checkpoint(model_path: str) -> dict:
+    """
+    Loads a checkpoint on CPU.
+
+    The checkpoints without vocabularies (``'vocabs'``) were trained on the NLTK tokenization: the dataset should
+    then be built with ``use_nltk=True``, to get the same vocabularies.
+    """
+    return torch.load(model_path, map_location=lambda storage, loc: storage)
+
+
+def restore_vocabs(checkpoint: dict, src_vocab, trg_vocab) -> None:
+    """
+    Replaces, in place, the symbols of the vocabularies rebuilt with the dataset by the ones stored in the checkpoint
+    (if any), i.e. the ones the model was trained with: the batches of the iterators built with these vocabularies
+    are then numericalized with the same indices as during training (the symbols unknown to the model become
+    ``<unk>``), even if the tokenization changed since.
+    """
+    vocabs = checkpoint.get('vocabs')
+    if vocabs is None:
+        return
+
+    for vocab, itos in ((src_vocab, vocabs['src']), (trg_vocab, vocabs['trg'])):
+        vocab.itos = list(itos)
+        vocab.stoi = defaultdict(vocab.stoi.default_factory, {symbol: i for i, symbol in enumerate(itos)})
+
+
+def load_model(checkpoint: dict, src_vocab, trg_vocab) -> Transformer:
+    """
+    Loads the model of a checkpoint, with the params stored in it (e.g. of a pruned or adaptive softmax model), or
+    the :py:func:`default_params` if it does not contain them. The vocabularies are first restored to the ones of the
+    checkpoint, see :py:func:`restore_vocabs`.
+    """
+    restore_vocabs(checkpoint, src_vocab, trg_vocab)
+    model = Transformer(checkpoint.get('params', default_params(src_vocab, trg_vocab)))
+    model.load(checkpoint)
+    return model
+
+
+def validation_loss(model, val_iterator, loss_fn, use_cuda=torch.cuda.is_available()):
+    """
+    Computes the average loss of ``model`` over the batches of ``val_iterator``.
+
+    :return: (average loss, number of batches)
+    """
+    model.eval()
     val_loss = 0.
     with torch.no_grad():
         for i, batch in enumerate(
@@ -61,7 +97,7 @@ if __name__ == '__main__':
                 ))):
 
             # Convert batch to CUDA.
-            if torch.cuda.is_available():
+            if use_cuda:
                 batch.cuda()
 
             # 1. Perform forward pass.
@@ -73,6 +109,30 @@ if __name__ == '__main__':
             # Accumulate loss
             val_loss += loss.item()
 
+    return val_loss / (i + 1), i + 1
+
+
+if __name__ == '__main__':
+    args = get_args()
+    batch_size = 1024
+    smoothing = 0.
+    checkpoint = load_checkpoint(args.model_path)
+    print("Loading dataset...")
+    _, val_iterator, _, src_vocab, trg_vocab = (
+        IWSLTDatasetBuilder.build(language_pair=LanguagePair.fr_en,
+                                  split=Split.Validation,
+                                  max_length=40, batch_size_train=batch_size,
+                                  use_nltk='vocabs' not in checkpoint)
+    )
+    print(f"Loading model from '{args.model_path}'...")
+    model = load_model(checkpoint, src_vocab, trg_vocab)
+
+    print("Computing loss on validation set...")
+    loss_fn = LabelSmoothingLoss(size=len(trg_vocab),
+                                 padding_token=src_vocab.stoi['<blank>'],
+                                 smoothing=smoothing)
+    val_loss, n_batches = validation_loss(model, val_iterator, loss_fn)
+
     print("Done.")
     print(f"Batch size: {batch_size} | Smoothing = {smoothing}")
-    print(f"Validation Loss: {val_loss} / {(i+1)} = {val_loss/(i+1)}")
+    print(f"Validation Loss: {val_loss * n_batches} / {n_batches} = {val_loss}")